@@ -0,0 +1,216 @@
+#! /usr/bin/env python
+
+# Purpose:  Times the stages of the data analyzer (reading, spatial binning, merging, re-mapping to the user
+#       defined diameter bins and the Sauter mean diameter) on synthetic spray snapshots of increasing size, and
+#       appends the results, tagged with the git commit, to a JSON lines file so that runs on different commits
+#       can be compared.
+#
+# Usage:    python benchmark.py --parcels 1e4 1e5 1e6 --compare <commit>
+#
+########################################################################
+import argparse
+import datetime
+import json
+import logging
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import h5py
+import numpy as np
+
+import bin_accumulators
+import input_parser as ip
+import lagrangian_analyzer as analyzers
+import synthetic_snapshot_generator
+
+logger = logging.getLogger(__name__)
+
+#Binning settings of the benchmark runs, taken from sample_input_file.txt
+benchmark_input = """mode smd
+case_name benchmark
+diameter_bin_flag 1
+d_min 0.0
+d_max 120e-6
+num_dia_bins 120
+radial_bin_flag 1
+d_liq 0.0105
+i_start %d
+i_step %d
+i_end %d
+num_x_bins 7
+x_min 0.0
+x_max 0.3675
+num_y_bins 10
+y_min 0.0
+y_max 10.5e-3
+"""
+
+
+def get_git_commit():
+    """Return the commit hash of the working tree, with a -dirty suffix if there are uncommitted changes."""
+    script_directory = os.path.dirname(os.path.abspath(__file__))
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=script_directory).decode().strip()
+        status = subprocess.check_output(['git', 'status', '--porcelain', '--untracked-files=no', '.'], cwd=script_directory).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+    return commit + '-dirty' if status else commit
+
+
+def time_function(function, repeats):
+    """Run function repeats times and return the best and median wall times."""
+    wall_times = []
+    for n in range(repeats):
+        start = time.perf_counter()
+        function()
+        wall_times.append(time.perf_counter() - start)
+    return {'best': min(wall_times), 'median': float(np.median(wall_times))}
+
+
+class AnalyzerBenchmark(object):
+    """Times the analyzer stages on one synthetic time series of num_parcels parcels per time step."""
+    def __init__(self, num_parcels, num_time_steps, work_directory, repeats=3, seed=0):
+        self.num_parcels = num_parcels
+        self.time_stamps = [1000 + 100 * n for n in range(num_time_steps)]
+        self.work_directory = work_directory
+        self.repeats = repeats
+        self.seed = seed
+
+    def setup(self):
+        synthetic_snapshot_generator.write_time_series(self.num_parcels, self.time_stamps, 'benchmark', self.work_directory,
+                                                       self.seed, write_temperature=False)
+        input_file_name = os.path.join(self.work_directory, 'benchmark_input.txt')
+        with open(input_file_name, 'w') as f:
+            f.write(benchmark_input%(self.time_stamps[0], 100, self.time_stamps[-1] + 100))
+        self.analyzer = analyzers.LagrangianParticleSMDDataAnalyzer(ip.InputFileParser(input_file_name))
+        self.analyzer.particle_bin_domain = self.analyzer.create_particle_bin_domain()
+
+    def run(self):
+        """Return the timings of every stage, keyed by stage name."""
+        analyzer = self.analyzer
+        total_parcels = self.num_parcels * len(self.time_stamps)
+        results = {}
+
+        def read_all():
+            return [analyzer.create_hdf5_reader(time_stamp).read_hdf_particle_data() for time_stamp in self.time_stamps]
+        results['read'] = time_function(read_all, self.repeats)
+        results['read']['parcels'] = total_parcels
+
+        def read_filtered():
+            return [analyzer.read_snapshot(time_stamp) for time_stamp in self.time_stamps]
+        results['read_filtered'] = time_function(read_filtered, self.repeats)
+        results['read_filtered']['parcels'] = total_parcels
+
+        snapshots = read_filtered()
+        binned_parcels_in_domain = sum(len(particle_data) for particle_data, parcel_y in snapshots)
+
+        def bin_snapshots():
+            return [analyzer.place_parcels_into_spatial_bins(particle_data, parcel_y) for particle_data, parcel_y in snapshots]
+        results['bin'] = time_function(bin_snapshots, self.repeats)
+        results['bin']['parcels'] = binned_parcels_in_domain
+
+        binned_parcels = bin_snapshots()
+        results['merge'] = time_function(lambda: analyzer.inplace_merge_particle_data_over_all_files(binned_parcels), self.repeats)
+        results['merge']['parcels'] = binned_parcels_in_domain
+
+        merged_parcels = analyzer.inplace_merge_particle_data_over_all_files(binned_parcels)
+        results['smd'] = time_function(lambda: analyzer.compute_sauter_mean_diameter(merged_parcels), self.repeats)
+        results['smd']['parcels'] = binned_parcels_in_domain
+
+        #custom_bins replaces the parcels of the bins, so every repeat works on its own merged copy
+        wall_times = []
+        for n in range(self.repeats):
+            merged_parcels = analyzer.inplace_merge_particle_data_over_all_files(binned_parcels)
+            start = time.perf_counter()
+            analyzer.remap_particle_diameters_to_custom_bins(merged_parcels)
+            wall_times.append(time.perf_counter() - start)
+        results['custom_bins'] = {'best': min(wall_times), 'median': float(np.median(wall_times)), 'parcels': binned_parcels_in_domain}
+
+        def accumulate_moments():
+            moments = bin_accumulators.DiameterMomentAccumulator(analyzer.particle_bin_domain.num_x_bins, analyzer.particle_bin_domain.num_y_bins)
+            for particle_data, parcel_y in snapshots:
+                bin_indices = analyzer.particle_bin_domain.compute_flat_bin_indices(particle_data['x'], parcel_y)
+                inside = bin_indices >= 0
+                moments.add_parcels(bin_indices[inside], particle_data['diameter'][inside], particle_data['particles_per_parcel'][inside])
+            return moments.compute_sauter_mean_diameter()
+        results['streamed_moments'] = time_function(accumulate_moments, self.repeats)
+        results['streamed_moments']['parcels'] = binned_parcels_in_domain
+
+        for stage in results.values():
+            stage['parcels_per_second'] = stage['parcels'] / stage['best'] if stage['best'] > 0 else 0.0
+        return results
+
+
+def load_results(results_file_name):
+    if not os.path.exists(results_file_name):
+        return []
+    with open(results_file_name) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def compare_results(record, previous_record):
+    """Print the speedup of every stage of record over previous_record (> 1 means record is faster)."""
+    print("Speedup of %s over %s (best times):"%(record['commit'][:12], previous_record['commit'][:12]))
+    print("%12s %-18s %12s %12s %8s"%('parcels', 'stage', 'before [s]', 'after [s]', 'speedup'))
+    for num_parcels, stages in sorted(record['results'].items(), key=lambda item: int(item[0])):
+        previous_stages = previous_record['results'].get(num_parcels, {})
+        for stage_name, stage in sorted(stages.items()):
+            if stage_name not in previous_stages:
+                continue
+            before = previous_stages[stage_name]['best']
+            after = stage['best']
+            print("%12s %-18s %12.4f %12.4f %8.2f"%(num_parcels, stage_name, before, after, before / after if after > 0 else float('inf')))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark the data analyzer stages on synthetic particle snapshots')
+    parser.add_argument('--parcels', type=float, nargs='+', default=[1e4, 1e5, 1e6], help='parcels per time step of each benchmark, e.g. 1e4 1e5 1e6 1e7')
+    parser.add_argument('--time-steps', type=int, default=3, help='number of time steps of each benchmark')
+    parser.add_argument('--repeats', type=int, default=3, help='number of times every stage is timed')
+    parser.add_argument('--results', default='benchmark_results.jsonl', help='JSON lines file the results are appended to')
+    parser.add_argument('--work-directory', default=None, help='directory for the synthetic files (default: a temporary directory)')
+    parser.add_argument('--compare', default=None, help='commit (or prefix) in the results file to compare this run against')
+    args = parser.parse_args()
+
+    #The synthetic sprays have a few droplets above d_max, so only errors are logged to keep the timings readable
+    logging.basicConfig(level=logging.ERROR, format='%(name)-12s: %(levelname)-8s %(message)s')
+    results_file_name = os.path.abspath(args.results)
+    original_directory = os.getcwd()
+
+    record = {'commit': get_git_commit(),
+              'date': datetime.datetime.now().isoformat(),
+              'host': platform.node(),
+              'python': platform.python_version(),
+              'numpy': np.__version__,
+              'h5py': h5py.__version__,
+              'time_steps': args.time_steps,
+              'repeats': args.repeats,
+              'results': {}}
+    for num_parcels in [int(n) for n in args.parcels]:
+        work_directory = os.path.abspath(tempfile.mkdtemp(prefix='benchmark_', dir=args.work_directory))
+        try:
+            #The readers open the particle files relative to the working directory
+            os.chdir(work_directory)
+            benchmark = AnalyzerBenchmark(num_parcels, args.time_steps, work_directory, args.repeats)
+            benchmark.setup()
+            record['results'][str(num_parcels)] = benchmark.run()
+        finally:
+            os.chdir(original_directory)
+            shutil.rmtree(work_directory)
+        for stage_name, stage in sorted(record['results'][str(num_parcels)].items()):
+            print("%12d %-18s best %10.4f s  median %10.4f s  %14.0f parcels/s"%(num_parcels, stage_name, stage['best'], stage['median'], stage['parcels_per_second']))
+
+    with open(results_file_name, 'a') as f:
+        f.write(json.dumps(record, sort_keys=True) + '\n')
+    print("Appended the results of commit %s to %s"%(record['commit'], results_file_name))
+
+    if args.compare is not None:
+        previous_records = [previous for previous in load_results(results_file_name)[:-1] if previous['commit'].startswith(args.compare)]
+        if not previous_records:
+            print("No results of commit %s in %s"%(args.compare, results_file_name))
+            sys.exit(1)
+        compare_results(record, previous_records[-1])
@@ -0,0 +1,463 @@
+import json
+import logging
+import numpy as np
+
+import particle_bins
+
+logger = logging.getLogger(__name__)
+
+
+class SpatialBinAccumulator(object):
+    """Running per spatial bin statistics that are updated one snapshot at a time.
+
+    Parcels are folded in with add_parcels() and then dropped by the caller, so the memory used by an accumulator
+    only depends on the number of spatial bins. Accumulators of the same kind can be merged by addition, which is
+    how snapshots that were processed separately (e.g. by different workers) are combined.
+    """
+    def __init__(self, num_x_bins, num_y_bins):
+        self.num_x_bins = num_x_bins
+        self.num_y_bins = num_y_bins
+
+    @property
+    def num_bins(self):
+        return self.num_x_bins * self.num_y_bins
+
+    def add_parcels(self, bin_indices, diameters, particles_per_parcel):
+        """
+        Fold a group of parcels into the running statistics.
+
+        Args:
+            bin_indices: flat spatial bin index (x_index*num_y_bins + y_index) of every parcel. Only parcels that
+                         are inside of the spatial domain may be passed in.
+            diameters: parcel diameters
+            particles_per_parcel: number of particles in each parcel, used as the parcel weight
+        """
+        raise NotImplementedError
+
+    def merge(self, other):
+        raise NotImplementedError
+
+    #Names of the constructor arguments and of the array attributes that make up the state of the accumulator
+    constructor_fields = ['num_x_bins', 'num_y_bins']
+    state_fields = []
+
+    def get_state(self):
+        """Dictionary of NumPy arrays that fully describes the accumulator, e.g. for saving it to disk."""
+        state = {}
+        for field in self.constructor_fields + self.state_fields:
+            state[field] = np.asarray(getattr(self, field))
+        return state
+
+    @classmethod
+    def from_state(cls, state):
+        """Rebuild an accumulator from the output of get_state."""
+        constructor_arguments = []
+        for field in cls.constructor_fields:
+            value = np.asarray(state[field])
+            constructor_arguments.append(value.item() if value.ndim == 0 else value)
+        accumulator = cls(*constructor_arguments)
+        for field in cls.state_fields:
+            setattr(accumulator, field, np.array(state[field]))
+        return accumulator
+
+    def check_compatible(self, other):
+        if type(self) is not type(other) or self.num_x_bins != other.num_x_bins or self.num_y_bins != other.num_y_bins:
+            raise ValueError('Unable to merge accumulators that were built for different spatial bins')
+
+    def __iadd__(self, other):
+        self.merge(other)
+        return self
+
+
+class DiameterHistogramAccumulator(SpatialBinAccumulator):
+    """Running histogram of the particles per parcel in each diameter bin of every spatial bin."""
+    constructor_fields = ['num_x_bins', 'num_y_bins', 'diameter_bin_edges']
+    state_fields = ['counts', 'out_of_range_counts']
+
+    def __init__(self, num_x_bins, num_y_bins, diameter_bin_edges):
+        super(DiameterHistogramAccumulator, self).__init__(num_x_bins, num_y_bins)
+        self.diameter_bin_edges = np.asarray(diameter_bin_edges, dtype=np.float64)
+        self.num_diameter_bins = len(self.diameter_bin_edges) - 1
+        self.counts = np.zeros((num_x_bins, num_y_bins, self.num_diameter_bins))
+        self.out_of_range_counts = np.zeros((num_x_bins, num_y_bins))
+
+    def compute_diameter_bin_centers(self):
+        return 0.5*(self.diameter_bin_edges[:-1] + self.diameter_bin_edges[1:])
+
+    def add_parcels(self, bin_indices, diameters, particles_per_parcel):
+        diameter_indices = particle_bins.compute_diameter_bin_indices(diameters, self.diameter_bin_edges)
+        in_range = diameter_indices >= 0
+        weights = np.asarray(particles_per_parcel, dtype=np.float64)
+
+        flat_indices = bin_indices[in_range] * self.num_diameter_bins + diameter_indices[in_range]
+        self.counts += np.bincount(flat_indices, weights=weights[in_range],
+                                   minlength=self.counts.size).reshape(self.counts.shape)
+
+        out_of_range = ~in_range
+        self.out_of_range_counts += np.bincount(bin_indices[out_of_range], weights=weights[out_of_range],
+                                                minlength=self.num_bins).reshape(self.out_of_range_counts.shape)
+
+    def merge(self, other):
+        self.check_compatible(other)
+        if not np.array_equal(self.diameter_bin_edges, other.diameter_bin_edges):
+            raise ValueError('Unable to merge diameter histograms with different diameter bins')
+        self.counts += other.counts
+        self.out_of_range_counts += other.out_of_range_counts
+
+    def log_out_of_range_counts(self):
+        for j, k in zip(*np.nonzero(self.out_of_range_counts)):
+            logger.warning("Warning - %10.6E particles in X Bin(%d) & Y Bin(%d) were unable to be placed into the user defined bins"%(self.out_of_range_counts[j][k], j + 1, k + 1))
+
+    def compute_sauter_mean_diameter(self):
+        """D32 of every spatial bin, using the center of each diameter bin as the diameter of its particles."""
+        centers = self.compute_diameter_bin_centers()
+        numerator = np.dot(self.counts, centers**3)
+        denominator = np.dot(self.counts, centers**2)
+        smd = np.zeros((self.num_x_bins, self.num_y_bins))
+        np.divide(numerator, denominator, out=smd, where=denominator > 0)
+        return smd
+
+
+class DiameterHistogramCubeAccumulator(SpatialBinAccumulator):
+    """
+    The diameter histogram of every spatial bin kept separately for each time step, as a dense time steps x nXBins x
+    nYBins x nDiameterBins array of weighted counts. An accumulator is created for a single time step, and merging
+    stacks the time steps of both accumulators in time step order, so the convergence of the time average can be
+    studied after the run without the parcels (see histogram_cube).
+    """
+    constructor_fields = ['num_x_bins', 'num_y_bins', 'diameter_bin_edges']
+    state_fields = ['time_steps', 'counts']
+
+    def __init__(self, num_x_bins, num_y_bins, diameter_bin_edges, time_step=None):
+        super(DiameterHistogramCubeAccumulator, self).__init__(num_x_bins, num_y_bins)
+        self.diameter_bin_edges = np.asarray(diameter_bin_edges, dtype=np.float64)
+        self.num_diameter_bins = len(self.diameter_bin_edges) - 1
+        self.time_steps = np.array([] if time_step is None else [int(time_step)], dtype=np.int64)
+        self.counts = np.zeros((len(self.time_steps), num_x_bins, num_y_bins, self.num_diameter_bins))
+
+    def add_parcels(self, bin_indices, diameters, particles_per_parcel):
+        if len(self.time_steps) != 1:
+            raise ValueError('Parcels can only be added to the histogram cube of a single time step')
+        diameter_indices = particle_bins.compute_diameter_bin_indices(diameters, self.diameter_bin_edges)
+        in_range = diameter_indices >= 0
+        flat_indices = bin_indices[in_range] * self.num_diameter_bins + diameter_indices[in_range]
+        self.counts[0] += np.bincount(flat_indices, weights=np.asarray(particles_per_parcel, dtype=np.float64)[in_range],
+                                      minlength=self.counts[0].size).reshape(self.counts[0].shape)
+
+    def merge(self, other):
+        self.check_compatible(other)
+        if not np.array_equal(self.diameter_bin_edges, other.diameter_bin_edges):
+            raise ValueError('Unable to merge histogram cubes with different diameter bins')
+        if len(np.intersect1d(self.time_steps, other.time_steps)) > 0:
+            raise ValueError('Unable to merge histogram cubes that hold the same time steps')
+        time_steps = np.concatenate([self.time_steps, other.time_steps])
+        order = np.argsort(time_steps, kind='stable')
+        self.time_steps = time_steps[order]
+        self.counts = np.concatenate([self.counts, other.counts])[order]
+
+
+class DiameterMomentAccumulator(SpatialBinAccumulator):
+    """
+    Running sums of particles_per_parcel * d**p for p = 0..4 in every spatial bin, along with the number of parcels
+    and the smallest and largest diameter seen. This is enough to give the standard mean diameters D10, D20, D30,
+    D32 and D43 without keeping any parcels.
+    """
+    max_power = 4
+    state_fields = ['moment_sums', 'parcel_counts', 'min_diameters', 'max_diameters']
+
+    def __init__(self, num_x_bins, num_y_bins):
+        super(DiameterMomentAccumulator, self).__init__(num_x_bins, num_y_bins)
+        self.moment_sums = np.zeros((self.max_power + 1, num_x_bins, num_y_bins))
+        self.parcel_counts = np.zeros((num_x_bins, num_y_bins), dtype=np.int64)
+        self.min_diameters = np.full((num_x_bins, num_y_bins), np.inf)
+        self.max_diameters = np.full((num_x_bins, num_y_bins), -np.inf)
+
+    def add_parcels(self, bin_indices, diameters, particles_per_parcel):
+        diameters = np.asarray(diameters, dtype=np.float64)
+        weighted_powers = np.asarray(particles_per_parcel, dtype=np.float64)
+        for p in range(0, self.max_power + 1):
+            self.moment_sums[p] += np.bincount(bin_indices, weights=weighted_powers,
+                                               minlength=self.num_bins).reshape(self.num_x_bins, self.num_y_bins)
+            weighted_powers = weighted_powers * diameters
+        self.parcel_counts += np.bincount(bin_indices, minlength=self.num_bins).reshape(self.num_x_bins, self.num_y_bins)
+        np.minimum.at(self.min_diameters.reshape(-1), bin_indices, diameters)
+        np.maximum.at(self.max_diameters.reshape(-1), bin_indices, diameters)
+
+    def merge(self, other):
+        self.check_compatible(other)
+        self.moment_sums += other.moment_sums
+        self.parcel_counts += other.parcel_counts
+        np.minimum(self.min_diameters, other.min_diameters, out=self.min_diameters)
+        np.maximum(self.max_diameters, other.max_diameters, out=self.max_diameters)
+
+    def compute_mean_diameter(self, p, q):
+        """
+        Mean diameter Dpq = (sum(n*d**p) / sum(n*d**q))**(1/(p - q)) of every spatial bin. Bins without particles
+        are given a value of 0.
+        """
+        ratio = np.zeros((self.num_x_bins, self.num_y_bins))
+        np.divide(self.moment_sums[p], self.moment_sums[q], out=ratio, where=self.moment_sums[q] > 0)
+        return ratio**(1.0/(p - q))
+
+    def compute_mean_diameters(self):
+        """Dictionary of the standard mean diameters D10, D20, D30, D32 and D43 of every spatial bin."""
+        return {'D10': self.compute_mean_diameter(1, 0),
+                'D20': self.compute_mean_diameter(2, 0),
+                'D30': self.compute_mean_diameter(3, 0),
+                'D32': self.compute_mean_diameter(3, 2),
+                'D43': self.compute_mean_diameter(4, 3)}
+
+    def compute_sauter_mean_diameter(self):
+        """D32 of every spatial bin. Bins without particles are given a value of 0."""
+        return self.compute_mean_diameter(3, 2)
+
+
+class DiameterQuantileSketchAccumulator(SpatialBinAccumulator):
+    """
+    Number and volume weighted diameter quantiles (e.g. Dv50) of every spatial bin from a fixed resolution log
+    histogram. Diameters fall into the bins [min_diameter*gamma**m, min_diameter*gamma**(m+1)) with
+    gamma = (1 + relative_accuracy)/(1 - relative_accuracy), so every quantile inside of [min_diameter, max_diameter]
+    is answered with a relative error of at most relative_accuracy and the memory used per spatial bin is fixed.
+    Diameters outside of the range are counted in the first or last bin.
+    """
+    constructor_fields = ['num_x_bins', 'num_y_bins', 'relative_accuracy', 'min_diameter', 'max_diameter']
+    state_fields = ['number_weights', 'volume_weights']
+
+    def __init__(self, num_x_bins, num_y_bins, relative_accuracy=0.01, min_diameter=1e-7, max_diameter=1e-2):
+        super(DiameterQuantileSketchAccumulator, self).__init__(num_x_bins, num_y_bins)
+        self.relative_accuracy = float(relative_accuracy)
+        self.min_diameter = float(min_diameter)
+        self.max_diameter = float(max_diameter)
+        self.gamma = (1.0 + self.relative_accuracy) / (1.0 - self.relative_accuracy)
+        self.num_diameter_bins = max(int(np.ceil(np.log(self.max_diameter / self.min_diameter) / np.log(self.gamma))), 1)
+        self.number_weights = np.zeros((num_x_bins, num_y_bins, self.num_diameter_bins))
+        self.volume_weights = np.zeros((num_x_bins, num_y_bins, self.num_diameter_bins))
+
+    def compute_diameter_bin_indices(self, diameters):
+        with np.errstate(divide='ignore'):
+            diameter_indices = np.floor(np.log(np.asarray(diameters, dtype=np.float64) / self.min_diameter) / np.log(self.gamma))
+        return np.clip(diameter_indices, 0, self.num_diameter_bins - 1).astype(np.int64)
+
+    def compute_representative_diameters(self):
+        """The diameter of every log bin with the smallest largest relative error, 2*gamma/(gamma + 1) times its lower edge."""
+        return self.min_diameter * self.gamma**np.arange(self.num_diameter_bins) * 2.0 * self.gamma / (self.gamma + 1.0)
+
+    def add_parcels(self, bin_indices, diameters, particles_per_parcel):
+        diameters = np.asarray(diameters, dtype=np.float64)
+        weights = np.asarray(particles_per_parcel, dtype=np.float64)
+        flat_indices = bin_indices * self.num_diameter_bins + self.compute_diameter_bin_indices(diameters)
+        self.number_weights += np.bincount(flat_indices, weights=weights, minlength=self.number_weights.size).reshape(self.number_weights.shape)
+        self.volume_weights += np.bincount(flat_indices, weights=weights * diameters**3, minlength=self.volume_weights.size).reshape(self.volume_weights.shape)
+
+    def merge(self, other):
+        self.check_compatible(other)
+        if (self.relative_accuracy, self.min_diameter, self.max_diameter) != (other.relative_accuracy, other.min_diameter, other.max_diameter):
+            raise ValueError('Unable to merge quantile sketches with different diameter bins')
+        self.number_weights += other.number_weights
+        self.volume_weights += other.volume_weights
+
+    def compute_quantile(self, q, volume_weighted=True):
+        """
+        Diameter below which the fraction q of the particles (or of the particle volume with volume_weighted) of
+        every spatial bin lies. Bins without particles are given a value of 0.
+        """
+        weights = self.volume_weights if volume_weighted else self.number_weights
+        cumulative_weights = np.cumsum(weights, axis=-1)
+        totals = cumulative_weights[..., -1]
+        diameter_indices = np.argmax(cumulative_weights >= q * totals[..., np.newaxis], axis=-1)
+        quantiles = self.compute_representative_diameters()[diameter_indices]
+        quantiles[totals <= 0] = 0.0
+        return quantiles
+
+    def compute_percentile_diameters(self):
+        """Dictionary of the number weighted Dn10, Dn50, Dn90 and volume weighted Dv10, Dv50, Dv90 of every spatial bin."""
+        percentile_diameters = {}
+        for percentile in [10, 50, 90]:
+            percentile_diameters['Dn%d'%(percentile)] = self.compute_quantile(percentile / 100.0, volume_weighted=False)
+            percentile_diameters['Dv%d'%(percentile)] = self.compute_quantile(percentile / 100.0, volume_weighted=True)
+        return percentile_diameters
+
+
+class JointHistogramAccumulator(SpatialBinAccumulator):
+    """
+    Weighted joint histogram of the diameter and a second parcel variable (e.g. the temperature) in every spatial
+    bin, binned with a single np.bincount pass over flat (spatial bin, diameter, variable) indices per group of
+    parcels. Both variables use the half-open bins edge[m] <= v < edge[m+1] of the other accumulators.
+    The weighted sums of the variable and of its square in every diameter bin are kept as well, for the conditional
+    mean and standard deviation of the variable per diameter class.
+    """
+    constructor_fields = ['num_x_bins', 'num_y_bins', 'diameter_bin_edges', 'value_bin_edges']
+    state_fields = ['counts', 'value_weights', 'value_sums', 'value_square_sums', 'out_of_range_counts']
+
+    def __init__(self, num_x_bins, num_y_bins, diameter_bin_edges, value_bin_edges):
+        super(JointHistogramAccumulator, self).__init__(num_x_bins, num_y_bins)
+        self.diameter_bin_edges = np.asarray(diameter_bin_edges, dtype=np.float64)
+        self.value_bin_edges = np.asarray(value_bin_edges, dtype=np.float64)
+        self.num_diameter_bins = len(self.diameter_bin_edges) - 1
+        self.num_value_bins = len(self.value_bin_edges) - 1
+        self.counts = np.zeros((num_x_bins, num_y_bins, self.num_diameter_bins, self.num_value_bins))
+        self.value_weights = np.zeros((num_x_bins, num_y_bins, self.num_diameter_bins))
+        self.value_sums = np.zeros((num_x_bins, num_y_bins, self.num_diameter_bins))
+        self.value_square_sums = np.zeros((num_x_bins, num_y_bins, self.num_diameter_bins))
+        self.out_of_range_counts = np.zeros((num_x_bins, num_y_bins))
+
+    def add_parcels(self, bin_indices, diameters, particles_per_parcel, values):
+        weights = np.asarray(particles_per_parcel, dtype=np.float64)
+        values = np.asarray(values, dtype=np.float64)
+        diameter_indices = particle_bins.compute_diameter_bin_indices(diameters, self.diameter_bin_edges)
+        value_indices = particle_bins.compute_diameter_bin_indices(values, self.value_bin_edges)
+        in_range = diameter_indices >= 0
+        in_joint_range = in_range & (value_indices >= 0)
+
+        flat_indices = (bin_indices[in_joint_range] * self.num_diameter_bins + diameter_indices[in_joint_range]) * self.num_value_bins + value_indices[in_joint_range]
+        self.counts += np.bincount(flat_indices, weights=weights[in_joint_range], minlength=self.counts.size).reshape(self.counts.shape)
+        out_of_range = ~in_joint_range
+        self.out_of_range_counts += np.bincount(bin_indices[out_of_range], weights=weights[out_of_range],
+                                                minlength=self.num_bins).reshape(self.out_of_range_counts.shape)
+
+        #Conditional sums of every parcel with a diameter inside of the bins, whatever its value
+        flat_indices = bin_indices[in_range] * self.num_diameter_bins + diameter_indices[in_range]
+        weights = weights[in_range]
+        values = values[in_range]
+        for sums, parcel_values in [(self.value_weights, weights), (self.value_sums, weights * values), (self.value_square_sums, weights * values**2)]:
+            sums += np.bincount(flat_indices, weights=parcel_values, minlength=sums.size).reshape(sums.shape)
+
+    def merge(self, other):
+        self.check_compatible(other)
+        if not np.array_equal(self.diameter_bin_edges, other.diameter_bin_edges) or not np.array_equal(self.value_bin_edges, other.value_bin_edges):
+            raise ValueError('Unable to merge joint histograms with different bins')
+        self.counts += other.counts
+        self.value_weights += other.value_weights
+        self.value_sums += other.value_sums
+        self.value_square_sums += other.value_square_sums
+        self.out_of_range_counts += other.out_of_range_counts
+
+    def compute_joint_pdfs(self):
+        """Joint PDF (per unit diameter and value) of every spatial bin. Bins without particles are given a PDF of 0."""
+        bin_areas = np.outer(np.diff(self.diameter_bin_edges), np.diff(self.value_bin_edges))
+        totals = self.counts.sum(axis=(2, 3), keepdims=True)
+        joint_pdfs = np.zeros(self.counts.shape)
+        np.divide(self.counts, totals * bin_areas, out=joint_pdfs, where=totals > 0)
+        return joint_pdfs
+
+    def compute_conditional_means(self):
+        """Mean value of the particles of every diameter bin of every spatial bin, 0 where there are none."""
+        conditional_means = np.zeros(self.value_sums.shape)
+        np.divide(self.value_sums, self.value_weights, out=conditional_means, where=self.value_weights > 0)
+        return conditional_means
+
+    def compute_conditional_standard_deviations(self):
+        conditional_means = self.compute_conditional_means()
+        mean_squares = np.zeros(self.value_square_sums.shape)
+        np.divide(self.value_square_sums, self.value_weights, out=mean_squares, where=self.value_weights > 0)
+        return np.sqrt(np.maximum(mean_squares - conditional_means**2, 0.0))
+
+
+class FineDiameterHistogramAccumulator(SpatialBinAccumulator):
+    """
+    Sparse histogram of the particles per parcel of every spatial bin on a fixed grid of fine diameter bins
+    [m*diameter_resolution, (m+1)*diameter_resolution). Only the occupied (spatial bin, diameter bin) pairs are
+    stored. Since the grid does not depend on the user's diameter bins, any coarser histogram can be rebuilt from
+    it, exactly when the coarse bin edges are multiples of the resolution.
+    """
+    constructor_fields = ['num_x_bins', 'num_y_bins', 'diameter_resolution']
+    state_fields = ['keys', 'weights']
+
+    def __init__(self, num_x_bins, num_y_bins, diameter_resolution):
+        super(FineDiameterHistogramAccumulator, self).__init__(num_x_bins, num_y_bins)
+        self.diameter_resolution = float(diameter_resolution)
+        self.keys = np.zeros(0, dtype=np.int64) #spatial bin index << 32 | fine diameter bin index
+        self.weights = np.zeros(0)
+
+    def add_parcels(self, bin_indices, diameters, particles_per_parcel):
+        fine_indices = np.clip(np.floor(np.asarray(diameters, dtype=np.float64) / self.diameter_resolution), 0, 2**32 - 1).astype(np.int64)
+        keys = (np.asarray(bin_indices, dtype=np.int64) << 32) | fine_indices
+        self.add_weighted_keys(keys, np.asarray(particles_per_parcel, dtype=np.float64))
+
+    def add_weighted_keys(self, keys, weights):
+        self.keys, inverse = np.unique(np.concatenate([self.keys, keys]), return_inverse=True)
+        self.weights = np.bincount(inverse.reshape(-1), weights=np.concatenate([self.weights, weights]), minlength=len(self.keys))
+
+    def merge(self, other):
+        self.check_compatible(other)
+        if self.diameter_resolution != other.diameter_resolution:
+            raise ValueError('Unable to merge fine diameter histograms with different resolutions')
+        self.add_weighted_keys(other.keys, other.weights)
+
+    def get_fine_parcels(self):
+        """Return (bin_indices, diameters, particles_per_parcel) with one pseudo-parcel at the center of every occupied fine bin."""
+        bin_indices = self.keys >> 32
+        diameters = ((self.keys & (2**32 - 1)) + 0.5) * self.diameter_resolution
+        return bin_indices, diameters, self.weights
+
+
+#Name of the metadata entry in the files written by BinAccumulatorSet.save
+metadata_key = '__metadata__'
+
+
+class BinAccumulatorSet(object):
+    """A named collection of accumulators that are all updated with the same parcels."""
+    def __init__(self, accumulators=None):
+        self.accumulators = {} if accumulators is None else dict(accumulators)
+
+    def __getitem__(self, name):
+        return self.accumulators[name]
+
+    def __contains__(self, name):
+        return name in self.accumulators
+
+    def add_parcels(self, bin_indices, diameters, particles_per_parcel):
+        for accumulator in self.accumulators.values():
+            accumulator.add_parcels(bin_indices, diameters, particles_per_parcel)
+
+    def merge(self, other):
+        if set(self.accumulators) != set(other.accumulators):
+            raise ValueError('Unable to merge accumulator sets holding different statistics')
+        for name, accumulator in self.accumulators.items():
+            accumulator.merge(other.accumulators[name])
+
+    def __iadd__(self, other):
+        self.merge(other)
+        return self
+
+    def save(self, file_name, metadata=None):
+        """Write all accumulators into one .npz file, with an optional JSON serializable metadata dictionary."""
+        arrays = {}
+        for name, accumulator in self.accumulators.items():
+            arrays[name + '.class'] = np.array(type(accumulator).__name__)
+            for field, value in accumulator.get_state().items():
+                arrays[name + '.' + field] = value
+        if metadata is not None:
+            arrays[metadata_key] = np.array(json.dumps(metadata, sort_keys=True))
+        with open(file_name, 'wb') as f:
+            np.savez(f, **arrays)
+
+    @staticmethod
+    def load(file_name):
+        """Read accumulators written by save."""
+        states = {}
+        with np.load(file_name) as data:
+            for key in data.files:
+                if key == metadata_key:
+                    continue
+                name, field = key.rsplit('.', 1)
+                states.setdefault(name, {})[field] = data[key]
+        accumulators = {}
+        for name, state in states.items():
+            accumulator_class = ACCUMULATOR_CLASSES[str(state['class'])]
+            accumulators[name] = accumulator_class.from_state(state)
+        return BinAccumulatorSet(accumulators)
+
+    @staticmethod
+    def load_metadata(file_name):
+        """Read the metadata dictionary written by save, or None if it was saved without one."""
+        with np.load(file_name) as data:
+            if metadata_key not in data.files:
+                return None
+            return json.loads(str(data[metadata_key]))
+
+
+#Accumulator types that can be rebuilt by BinAccumulatorSet.load
+ACCUMULATOR_CLASSES = dict((accumulator_class.__name__, accumulator_class) for accumulator_class in
+                           [DiameterHistogramAccumulator, DiameterHistogramCubeAccumulator, DiameterMomentAccumulator,
+                            DiameterQuantileSketchAccumulator, FineDiameterHistogramAccumulator, JointHistogramAccumulator])
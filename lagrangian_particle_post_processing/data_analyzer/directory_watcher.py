@@ -0,0 +1,73 @@
+import logging
+import time
+
+import utilities
+
+try:
+    import inotify_simple
+except ImportError:
+    inotify_simple = None
+
+logger = logging.getLogger(__name__)
+
+
+class DirectoryWatcher(object):
+    """
+    Waits for files in a directory to be written. With the inotify_simple package (Linux) the wait ends as soon as a
+    file is closed after writing or moved into the directory, otherwise the directory is polled.
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        self.inotify = None
+        if inotify_simple is None:
+            logger.info("inotify_simple is not installed. Polling %s for new files."%(directory))
+            return
+        try:
+            self.inotify = inotify_simple.INotify()
+            watch_flags = inotify_simple.flags.CLOSE_WRITE | inotify_simple.flags.MOVED_TO
+            self.inotify.add_watch(directory, watch_flags)
+            logger.info("Watching %s for new files with inotify"%(directory))
+        except OSError as e:
+            logger.warning("Unable to watch %s with inotify (%s). Polling it for new files."%(directory, str(e)))
+            self.close()
+
+    def wait(self, timeout):
+        """Return after timeout seconds, or earlier when inotify reports that a file of the directory was written."""
+        if self.inotify is None:
+            time.sleep(timeout)
+            return
+        #Collect the events of files written shortly after each other in a single wake up
+        self.inotify.read(timeout=int(timeout * 1000), read_delay=100)
+
+    def close(self):
+        if self.inotify is not None:
+            self.inotify.close()
+            self.inotify = None
+
+
+class FileCompletionTracker(object):
+    """
+    Decides when a set of files that is still being written is complete: all files exist and their sizes and
+    modification times have not changed for settle_time seconds.
+    """
+    def __init__(self, settle_time):
+        self.settle_time = settle_time
+        self.pending = {} #key -> (signature, time the signature was first seen)
+
+    def is_complete(self, key, file_names):
+        try:
+            signature = utilities.get_file_signature(file_names)
+        except OSError:
+            self.pending.pop(key, None)
+            return False
+
+        now = time.time()
+        if key not in self.pending or self.pending[key][0] != signature:
+            self.pending[key] = (signature, now)
+        if now - self.pending[key][1] < self.settle_time:
+            return False
+        del self.pending[key]
+        return True
+
+    def has_pending(self):
+        return len(self.pending) > 0
@@ -0,0 +1,112 @@
+import logging
+import math
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+#Upper limit of the bootstrap resamples held in memory at once
+max_resample_bytes = 2**26
+
+
+def normalize_histograms(counts, diameter_bin_widths):
+    """
+    PDFs (per unit diameter) of weighted diameter histograms along the last axis of counts. Histograms without any
+    particles are given a PDF of 0.
+    """
+    totals = counts.sum(axis=-1, keepdims=True)
+    pdfs = np.zeros(counts.shape)
+    np.divide(counts, totals * diameter_bin_widths, out=pdfs, where=totals > 0)
+    return pdfs
+
+
+def compute_running_means(counts):
+    """Mean weighted counts per time step over the first n time steps of the cube, for every n."""
+    num_time_steps = np.arange(1, counts.shape[0] + 1).reshape((-1,) + (1,) * (counts.ndim - 1))
+    return np.cumsum(counts, axis=0) / num_time_steps
+
+
+def compute_running_mean_pdfs(counts, diameter_bin_widths):
+    """Time averaged PDF of every spatial bin over the first n time steps of the cube, for every n."""
+    return normalize_histograms(np.cumsum(counts, axis=0), diameter_bin_widths)
+
+
+def compute_default_block_length(num_time_steps):
+    """Bootstrap block length of about num_time_steps**(1/3), the usual choice for the moving block bootstrap."""
+    return max(1, int(round(num_time_steps**(1.0/3.0))))
+
+
+def compute_block_bootstrap_intervals(counts, diameter_bin_widths, block_length=None, num_resamples=1000, confidence=0.95, seed=0):
+    """
+    Moving block bootstrap confidence intervals of the time averaged PDF of every spatial and diameter bin.
+
+    Every resample is made of n // block_length blocks of block_length consecutive time steps with random starts,
+    so the correlation between neighbouring time steps is kept within the blocks. The time averaged PDF of a
+    resample is the normalized sum of its counts, like the PDF of the whole run.
+
+    Returns:
+        Tuple (lower, upper) of nXBins x nYBins x nDiameterBins arrays with the bounds of the interval.
+    """
+    num_time_steps = counts.shape[0]
+    if block_length is None:
+        block_length = compute_default_block_length(num_time_steps)
+    block_length = min(max(int(block_length), 1), num_time_steps)
+    num_blocks = max(num_time_steps // block_length, 1)
+
+    #Counts of every block of consecutive time steps, from the cumulative sums of the cube
+    spatial_shape = counts.shape[1:-1]
+    flat_counts = counts.reshape(num_time_steps, -1, counts.shape[-1])
+    cumulative_counts = np.concatenate([np.zeros((1,) + flat_counts.shape[1:]), np.cumsum(flat_counts, axis=0)])
+    block_counts = cumulative_counts[block_length:] - cumulative_counts[:-block_length]
+
+    rng = np.random.default_rng(seed)
+    block_starts = rng.integers(0, len(block_counts), size=(num_resamples, num_blocks))
+    alpha = 0.5*(1.0 - confidence)
+    lower = np.zeros(flat_counts.shape[1:])
+    upper = np.zeros(flat_counts.shape[1:])
+    #Spatial bins are resampled a group at a time to limit the memory held by the resamples
+    bins_per_group = max(1, max_resample_bytes // (8 * num_resamples * counts.shape[-1]))
+    for first_bin in range(0, flat_counts.shape[1], bins_per_group):
+        group = slice(first_bin, first_bin + bins_per_group)
+        resampled_counts = np.zeros((num_resamples,) + block_counts[:, group].shape[1:])
+        for n in range(0, num_blocks):
+            resampled_counts += block_counts[block_starts[:, n], group]
+        resampled_pdfs = normalize_histograms(resampled_counts, diameter_bin_widths)
+        lower[group], upper[group] = np.quantile(resampled_pdfs, [alpha, 1.0 - alpha], axis=0)
+    return lower.reshape(spatial_shape + (-1,)), upper.reshape(spatial_shape + (-1,))
+
+
+def compute_convergence_metric(counts, diameter_bin_widths, window_fraction=0.25):
+    """
+    How much the time averaged PDF of every spatial bin still changed over the last window_fraction of the time
+    steps: the largest L1 distance, sum(|pdf_n - pdf_N| * width), between the running mean PDF after n time steps
+    and the final one, over the last ceil(window_fraction*N) values of n. 0 means that the PDF stopped changing,
+    and the largest possible value is 2.
+    """
+    running_mean_pdfs = compute_running_mean_pdfs(counts, diameter_bin_widths)
+    num_time_steps = counts.shape[0]
+    window = min(max(int(math.ceil(window_fraction * num_time_steps)), 1), num_time_steps)
+    distances = np.sum(np.abs(running_mean_pdfs[num_time_steps - window:] - running_mean_pdfs[-1]) * diameter_bin_widths, axis=-1)
+    return distances.max(axis=0)
+
+
+def create_histogram_cube_datasets(cube, block_length=None, num_resamples=1000, confidence=0.95, window_fraction=0.25):
+    """The cube of a DiameterHistogramCubeAccumulator and the statistics computed from it, for a result file."""
+    diameter_bin_widths = np.diff(cube.diameter_bin_edges)
+    num_time_steps = len(cube.time_steps)
+    if block_length is None:
+        block_length = compute_default_block_length(num_time_steps)
+    lower, upper = compute_block_bootstrap_intervals(cube.counts, diameter_bin_widths, block_length, num_resamples, confidence)
+    convergence_metric = compute_convergence_metric(cube.counts, diameter_bin_widths, window_fraction)
+    logger.info("Largest change of a time averaged PDF over the last %d of %d time steps: %10.6E"
+                %(min(max(int(math.ceil(window_fraction * num_time_steps)), 1), num_time_steps), num_time_steps, convergence_metric.max()))
+    return {'time_steps': cube.time_steps,
+            'diameter_bin_edges': cube.diameter_bin_edges,
+            'histogram_cube': cube.counts,
+            'pdf': normalize_histograms(cube.counts.sum(axis=0), diameter_bin_widths),
+            'pdf_ci_lower': lower,
+            'pdf_ci_upper': upper,
+            'convergence_metric': convergence_metric,
+            'bootstrap_block_length': min(max(int(block_length), 1), num_time_steps),
+            'bootstrap_resamples': num_resamples,
+            'bootstrap_confidence': confidence,
+            'convergence_window_fraction': window_fraction}
@@ -0,0 +1,97 @@
+import contextlib
+import json
+import logging
+import resource
+import sys
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+def get_peak_rss_bytes():
+    """Peak resident set size of this process and of its finished child processes (e.g. pool workers)."""
+    #ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    scale = 1 if sys.platform == 'darwin' else 1024
+    own_peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+    children_peak = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale
+    return own_peak, children_peak
+
+
+class PipelineInstrumentation(object):
+    """
+    Wall time, parcel and byte counts of the stages of an analysis run (read, bin, merge, remap, write, ...).
+
+    Every timed stage adds to the totals of the stage, and stages that work on one time step also add a per-file
+    record. Recording is thread safe, so the prefetch thread can time its reads, and the records of worker processes
+    are folded in with merge. write_report saves everything as JSON.
+    """
+    def __init__(self):
+        self.start_time = time.time()
+        self.stages = {}
+        self.file_records = []
+        self.lock = threading.Lock()
+
+    def __getstate__(self):
+        #Locks can not be pickled, which is needed to send the analyzer to worker processes
+        state = dict(self.__dict__)
+        del state['lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def time_stage(self, stage_name, time_stamp=None):
+        """
+        Time the enclosed block as one call of the named stage. The block can fill in the parcels and bytes_read
+        entries of the yielded dictionary.
+        """
+        counts = {'parcels': 0, 'bytes_read': 0}
+        start = time.time()
+        try:
+            yield counts
+        finally:
+            self.add_record(stage_name, time.time() - start, counts['parcels'], counts['bytes_read'], time_stamp)
+
+    def add_record(self, stage_name, wall_time, parcels=0, bytes_read=0, time_stamp=None):
+        with self.lock:
+            stage = self.stages.setdefault(stage_name, {'calls': 0, 'wall_time': 0.0, 'parcels': 0, 'bytes_read': 0})
+            stage['calls'] += 1
+            stage['wall_time'] += wall_time
+            stage['parcels'] += int(parcels)
+            stage['bytes_read'] += int(bytes_read)
+            if time_stamp is not None:
+                self.file_records.append({'time_stamp': str(time_stamp), 'stage': stage_name, 'wall_time': wall_time,
+                                          'parcels': int(parcels), 'bytes_read': int(bytes_read)})
+
+    def merge(self, other):
+        """Add the records of another instrumentation object, e.g. the one of a worker process."""
+        with self.lock:
+            for stage_name, other_stage in other.stages.items():
+                stage = self.stages.setdefault(stage_name, {'calls': 0, 'wall_time': 0.0, 'parcels': 0, 'bytes_read': 0})
+                for key in stage:
+                    stage[key] += other_stage[key]
+            self.file_records.extend(other.file_records)
+
+    def create_report(self):
+        stages = {}
+        for stage_name, stage in self.stages.items():
+            stages[stage_name] = dict(stage)
+            stages[stage_name]['parcels_per_second'] = stage['parcels'] / stage['wall_time'] if stage['wall_time'] > 0 else 0.0
+        own_peak, children_peak = get_peak_rss_bytes()
+        return {'total_wall_time': time.time() - self.start_time,
+                'peak_rss_bytes': own_peak,
+                'peak_rss_bytes_children': children_peak,
+                'stages': stages,
+                'files': sorted(self.file_records, key=lambda record: (record['time_stamp'], record['stage']))}
+
+    def write_report(self, file_name):
+        report = self.create_report()
+        with open(file_name, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+        logger.info("Wrote the instrumentation report to: %s"%(file_name))
+        for stage_name in sorted(report['stages']):
+            stage = report['stages'][stage_name]
+            logger.info("Stage %-8s %6d calls %10.3f s %12.0f parcels/s"%(stage_name, stage['calls'], stage['wall_time'], stage['parcels_per_second']))
@@ -16,51 +16,147 @@
 #   Updated: 05/11/2016
 #
 ########################################################################
+import concurrent.futures
+import h5py
+import itertools
+import json
 import logging
 import os #OS specific commands forreading and writing files
 import sys #For parsing user input to the script
-import math
 import numpy as np
 import time #For deubbging
-import matplotlib
-matplotlib.use('Agg')
-import matplotlib.pyplot as plt
 
 import particle_statistics
 import particle_data_reader 
 import particle_bins
+import parcel_table
+import parcel_store
+import plot_renderer
+import result_file
+import bin_accumulators
+import histogram_cube
+import directory_watcher
+import mpi_distribution
+import snapshot_cache as snapshot_cache_module
+import snapshot_prefetcher
 import utilities
 import input_parser as ip
+import instrumentation
 
 logger = logging.getLogger(__name__)
 
+#Version of the manifest in the state files written by accumulate_snapshots
+state_file_version = 1
+
+#Rough peak memory per parcel row of a chunk while it is read, filtered and folded into the accumulators, including
+#the compound position rows, the copies made by the filter and the temporaries of the binning
+parcel_row_bytes = 256
+#Smallest chunk that a memory budget is turned into, below which the per chunk overhead dominates
+min_memory_budget_chunk_rows = 4096
+
+#Read buffers of a worker process in the snapshot process pool
+_worker_buffer_pool = None
+
+def _initialize_worker(buffer_pool):
+    global _worker_buffer_pool
+    _worker_buffer_pool = buffer_pool
+
+def _process_snapshot_in_worker(analyzer, snapshot_function_name, time_stamp):
+    #Record the timings of this time step on their own, so that they can be merged into the ones of the main process
+    analyzer.instrumentation = instrumentation.PipelineInstrumentation()
+    result = getattr(analyzer, snapshot_function_name)(time_stamp, _worker_buffer_pool)
+    return result, analyzer.instrumentation
+
+
 class LagrangianParticleDataAnalyzer(object):
-    def __init__(self, input_parser):
+    #Read and process steps of the per time step functions run by iterate_snapshots. Only the read step touches the
+    #disk, so it can run ahead on a prefetch thread while the previous time step is processed
+    snapshot_steps = {'read_and_bin_snapshot': ('read_snapshot_for_binning', 'bin_snapshot'),
+                      'read_and_accumulate_snapshot': ('read_snapshot_for_accumulation', 'accumulate_snapshot')}
+    #Files that every time step needs, <prefix>.<time step>_<case name>
+    particle_file_prefixes = ['ptdia_ptsca', 'particle_pos', 'ptnump_ptsca']
+    #Whether the analyzer reads the temperature of the parcels along with their diameter and position
+    include_temperature = False
+
+    def __init__(self, input_parser, num_workers=1):
         self.user_input_data = input_parser.user_input_data
+        self.num_workers = num_workers
+        self.instrumentation = instrumentation.PipelineInstrumentation()
+        self.run_directory = os.getcwd() #The output writers change the working directory
+        self.followed_time_steps = None #Time steps folded in so far in follow mode
+        self.communicator = None #MPI communicator when the time steps are split over MPI ranks
     
     def process_data(self):
         raise NotImplementedError
 
     def get_file_indices(self):
+        """
+        The time steps to analyze: the time steps of the parcel store if the user gave one, and the time steps that
+        have a complete set of lagrangian files on disk otherwise. i_start, i_end and i_step optionally narrow them
+        down to a range.
+        """
+        parcel_store_file_name = self.get_parcel_store_file_name()
+        if parcel_store_file_name is None:
+            return self.discover_file_time_steps()
+
+        i_start, i_end, i_step = self.get_time_step_range()
+        parcel_store_file_name = os.path.join(self.run_directory, parcel_store_file_name)
+        time_steps = utilities.select_time_steps(parcel_store.ParcelStore(parcel_store_file_name).get_time_steps(), i_start, i_end, i_step)
+        if not time_steps:
+            logger.error('No time steps in the selected range in the parcel store %s. Run the analyzer in ingest mode to add them.'%(parcel_store_file_name))
+            raise ValueError('No time steps to analyze in the parcel store %s'%(parcel_store_file_name))
+        return time_steps
+
+    def is_root_rank(self):
+        """Whether this process writes the results: always without MPI, and on rank 0 with it."""
+        return self.communicator is None or self.communicator.Get_rank() == mpi_distribution.root_rank
+
+    def get_rank_time_steps(self, time_steps):
+        """The share of the time steps that this MPI rank processes, or all of them without MPI."""
+        if self.communicator is None:
+            return time_steps
+        return mpi_distribution.split_time_steps(time_steps, self.communicator.Get_rank(), self.communicator.Get_size())
+
+    def get_distributed_file_indices(self):
+        """get_file_indices of the root rank, sent to every rank so that they all see the same time steps."""
+        if self.communicator is None:
+            return self.get_file_indices()
+        file_indices = self.get_file_indices() if self.is_root_rank() else None
+        return self.communicator.bcast(file_indices, root=mpi_distribution.root_rank)
+
+    def discover_file_time_steps(self):
         try:
-            i_start = int(self.user_input_data['i_start'])
-        except KeyError:
-            logger.error('i_start missing from input file. Needed for reading time series of files.')
-            raise 
-        
-        try:
-            i_end = int(self.user_input_data['i_end'])
-        except KeyError:
-            logger.error('i_end missing from input file. Needed for reading time series of files.')
-            raise 
-        
-        try:
-            i_step = int(self.user_input_data['i_step'])
+            case_name = self.user_input_data['case_name']
         except KeyError:
-            logger.error('i_step missing from input file. Needed for reading time series of files.')
+            logger.error('case_name missing from input file. The prefix on the lagrangian files that signify the case name that generated them.')
             raise 
 
-        return utilities.compute_filename_numbers(i_start, i_end, i_step)
+        i_start, i_end, i_step = self.get_time_step_range()
+        time_steps = utilities.discover_time_steps(case_name, self.particle_file_prefixes, i_start, i_end, i_step, self.run_directory)
+        if None not in (i_start, i_end, i_step):
+            missing_time_steps = sorted(set(range(i_start, i_end, i_step)) - set(time_steps))
+            if missing_time_steps:
+                logger.warning('Skipping the time steps without a complete set of lagrangian files: %s'%(missing_time_steps))
+        if not time_steps:
+            logger.error('No lagrangian files of case %s found in %s'%(case_name, self.run_directory))
+            raise ValueError('No time steps to analyze')
+        return time_steps
+
+    def get_time_step_range(self):
+        """
+        The optional i_start, i_end and i_step settings, or None for the ones that are missing. i_end is moved down to
+        the end of the last whole i_step, so the range holds the same time steps as before the files were discovered.
+        """
+        time_step_range = []
+        for key in ['i_start', 'i_end', 'i_step']:
+            try:
+                time_step_range.append(int(self.user_input_data[key]))
+            except KeyError:
+                time_step_range.append(None)
+        i_start, i_end, i_step = time_step_range
+        if None not in time_step_range:
+            i_end = i_start + ((i_end - i_start)//i_step)*i_step
+        return i_start, i_end, i_step
 
     def create_particle_bin_domain(self):
         try:
@@ -101,14 +197,47 @@ class LagrangianParticleDataAnalyzer(object):
 
         return particle_bins.ParticleBinDomain(x_max, x_min, y_max, y_min, num_x_bins, num_y_bins)
 
-    def create_hdf5_reader(self, time_stamp):
+    def create_hdf5_reader(self, time_stamp, buffer_pool=None):
+        """Reader of one time step, from the parcel store if the user gave one and from the Loci-Stream files otherwise."""
+        parcel_store_file_name = self.get_parcel_store_file_name()
+        if parcel_store_file_name is not None:
+            return parcel_store.ParcelStoreReader(parcel_store_file_name, time_stamp, self.get_parcel_dtype(), self.include_temperature)
+        return self.create_loci_stream_reader(time_stamp, buffer_pool, include_temperature=self.include_temperature)
+
+    def create_loci_stream_reader(self, time_stamp, buffer_pool=None, dtype=None, include_temperature=False):
         try:
             case_name = self.user_input_data['case_name']
         except KeyError:
             logger.error('case_name missing from input file. The prefix on the lagrangian files that signify the case name that generated them.')
             raise 
         
-        return particle_data_reader.HDF5ParticlePDFPlotterDataReader(case_name, time_stamp)
+        if dtype is None:
+            dtype = self.get_parcel_dtype()
+        return particle_data_reader.HDF5ParticlePDFPlotterDataReader(case_name, time_stamp, dtype, buffer_pool, include_temperature)
+
+    def get_parcel_store_file_name(self):
+        try:
+            parcel_store_file_name = self.user_input_data['parcel_store']
+        except KeyError:
+            parcel_store_file_name = None
+        return parcel_store_file_name
+
+    def get_parcel_dtype(self):
+        try:
+            parcel_precision = self.user_input_data['parcel_precision']
+        except KeyError:
+            parcel_precision = 'float64'
+        return parcel_table.get_parcel_dtype(parcel_precision)
+
+    def create_read_buffer_pool(self):
+        """Buffers that are reused by the readers of every time step, if the user asked for them."""
+        try:
+            reuse_read_buffers = int(self.user_input_data['reuse_read_buffers'])
+        except KeyError:
+            reuse_read_buffers = 0
+        if reuse_read_buffers == 1:
+            return particle_data_reader.ReadBufferPool()
+        return None
 
     def initialize_particle_data_structure(self):
         """Initialize 3D array of objects to hold particle data for all bins in each data file. 
@@ -118,7 +247,8 @@ class LagrangianParticleDataAnalyzer(object):
         file_indices = self.get_file_indices()
         num_x_bins = self.particle_bin_domain.num_x_bins
         num_y_bins = self.particle_bin_domain.num_y_bins
-        data = [[[particle_bins.ParticleBinCell() for k in range(num_y_bins)] for j in range(num_x_bins)] for i in range(len(file_indices))]
+        parcel_dtype = self.get_parcel_dtype()
+        data = [[[particle_bins.ParticleBinCell(dtype=parcel_dtype) for k in range(num_y_bins)] for j in range(num_x_bins)] for i in range(len(file_indices))]
         """
         #Check to make sure data structure is initialized correctly
         count_i = 0
@@ -139,93 +269,781 @@ class LagrangianParticleDataAnalyzer(object):
 
     def read_data_and_place_parcels_into_spatial_bins(self):
         #Initialize 3D array of objects to hold particle data for all bins in each data file. Creates NumFiles x nXBins x nYBins array
+        file_indices = self.get_distributed_file_indices()
+        if self.get_memory_budget() is not None:
+            logger.warning('memory_budget_mb only limits the rows read at a time here. The parcels of every time step are kept in memory; use streaming_flag 1 to process the time steps out of core.')
+        if self.communicator is not None:
+            return self.gather_binned_parcels(file_indices)
+
         spatially_binned_parcels = self.initialize_particle_data_structure()     
-        file_indices = self.get_file_indices()
         logger.info('Reading Data from timesteps:')
         logger.info(file_indices)
-        for i, time_stamp in enumerate(file_indices):
-            #Read particle data from HDF5 data files
-            logger.info("Reading Data from file: %d"%(i + 1))
-            data_reader = self.create_hdf5_reader(time_stamp)
-            particle_data = data_reader.read_hdf_particle_data()
-            logger.info("Number of parcels in dataset %d :\t%d"%(i + 1, len(particle_data)))
+        for i, binned_parcels in enumerate(self.iterate_snapshots(file_indices, 'read_and_bin_snapshot')):
+            spatially_binned_parcels[i] = binned_parcels
+        return spatially_binned_parcels      
+
+    def gather_binned_parcels(self, file_indices):
+        """
+        MPI version of read_data_and_place_parcels_into_spatial_bins: every rank bins its share of the time steps and
+        the binned parcels are gathered on the root rank. Returns None on the other ranks.
+        """
+        positions = self.get_rank_time_steps(list(range(0, len(file_indices))))
+        rank_file_indices = [file_indices[i] for i in positions]
+        logger.info('Reading Data from timesteps on MPI rank %d:'%(self.communicator.Get_rank()))
+        logger.info(rank_file_indices)
+        rank_binned_parcels = list(zip(positions, self.iterate_snapshots(rank_file_indices, 'read_and_bin_snapshot')))
+        with self.instrumentation.time_stage('mpi_gather'):
+            gathered_binned_parcels = self.communicator.gather(rank_binned_parcels, root=mpi_distribution.root_rank)
+        if not self.is_root_rank():
+            return None
+
+        spatially_binned_parcels = self.initialize_particle_data_structure()
+        for rank_binned_parcels in gathered_binned_parcels:
+            for i, binned_parcels in rank_binned_parcels:
+                spatially_binned_parcels[i] = binned_parcels
+        return spatially_binned_parcels
+
+    def iterate_snapshots(self, file_indices, snapshot_function_name):
+        """
+        Yield the result of the named per time step function (read_and_bin_snapshot or read_and_accumulate_snapshot)
+        for every time step in order. With more than one worker the time steps are processed in a process pool,
+        and only the compact per-bin results are sent back.
+        """
+        if self.num_workers <= 1:
+            prefetch_depth = self.get_prefetch_depth()
+            if prefetch_depth > 0 and len(file_indices) > 1:
+                for result in self.iterate_prefetched_snapshots(file_indices, snapshot_function_name, prefetch_depth):
+                    yield result
+                return
+            buffer_pool = self.create_read_buffer_pool()
+            for time_stamp in file_indices:
+                yield getattr(self, snapshot_function_name)(time_stamp, buffer_pool)
+            return
+
+        logger.info("Processing time steps with %d worker processes"%(self.num_workers))
+        with concurrent.futures.ProcessPoolExecutor(max_workers=self.num_workers, initializer=_initialize_worker,
+                                                    initargs=(self.create_read_buffer_pool(),)) as executor:
+            for result, worker_instrumentation in executor.map(_process_snapshot_in_worker, itertools.repeat(self),
+                                                               itertools.repeat(snapshot_function_name), file_indices):
+                self.instrumentation.merge(worker_instrumentation)
+                yield result
+
+    def iterate_prefetched_snapshots(self, file_indices, snapshot_function_name, prefetch_depth):
+        """
+        Serial version of iterate_snapshots that reads the next prefetch_depth time steps on a background thread while
+        the current one is processed. Up to prefetch_depth + 2 time steps are in memory at once, and each of them gets
+        its own read buffers so that a prefetched time step never overwrites the one being processed.
+        """
+        read_function_name, process_function_name = self.snapshot_steps[snapshot_function_name]
+        read_function = getattr(self, read_function_name)
+        process_function = getattr(self, process_function_name)
+        buffer_pools = [self.create_read_buffer_pool() for n in range(prefetch_depth + 2)]
+
+        def read_time_step(indexed_time_stamp):
+            n, time_stamp = indexed_time_stamp
+            return read_function(time_stamp, buffer_pools[n % len(buffer_pools)])
+
+        logger.info("Prefetching up to %d time steps on a background thread"%(prefetch_depth))
+        snapshots = snapshot_prefetcher.PrefetchingIterator(read_time_step, enumerate(file_indices), prefetch_depth)
+        try:
+            for snapshot in snapshots:
+                yield process_function(snapshot)
+        finally:
+            snapshots.close()
+
+    def get_prefetch_depth(self):
+        try:
+            prefetch_depth = int(self.user_input_data['prefetch_depth'])
+        except KeyError:
+            #A prefetched time step would be held in memory next to the one being processed
+            prefetch_depth = 0 if self.get_memory_budget() is not None else 1
+        return prefetch_depth
+
+    def get_instrumentation_report_file_name(self):
+        try:
+            report_file_name = self.user_input_data['instrumentation_report']
+        except KeyError:
+            report_file_name = 'instrumentation_report.json'
+        return report_file_name
+
+    def write_instrumentation_report(self):
+        """
+        Save the stage timings of the run as JSON, unless the user set instrumentation_report to none. With MPI the
+        timings of all ranks are collected and written by the root rank.
+        """
+        if self.communicator is not None:
+            rank_instrumentations = self.communicator.gather(self.instrumentation, root=mpi_distribution.root_rank)
+            if not self.is_root_rank():
+                return
+            for rank, rank_instrumentation in enumerate(rank_instrumentations):
+                if rank != mpi_distribution.root_rank:
+                    self.instrumentation.merge(rank_instrumentation)
+        report_file_name = self.get_instrumentation_report_file_name()
+        if report_file_name.lower() != 'none':
+            self.instrumentation.write_report(os.path.join(self.run_directory, report_file_name))
+
+    def create_plot_renderer(self):
+        """
+        Renderer of the output plots. plot_flag 0 skips the plots and max_plots limits the number of plots of each
+        kind, for runs where only the data files are needed. The plots are rendered by the --workers processes.
+        """
+        try:
+            plot_flag = int(self.user_input_data['plot_flag'])
+        except KeyError:
+            plot_flag = 1
+        try:
+            max_plots = int(self.user_input_data['max_plots'])
+        except KeyError:
+            max_plots = None
+        if plot_flag == 0:
+            max_plots = 0
+        return plot_renderer.PlotRenderer(self.num_workers, max_plots)
+
+    def get_output_format(self):
+        """text for the per-station text files, hdf5 for a single result file, or both."""
+        try:
+            output_format = self.user_input_data['output_format'].lower()
+        except KeyError:
+            output_format = 'both'
+        if output_format not in ('text', 'hdf5', 'both'):
+            raise ValueError('output_format must be text, hdf5 or both, not: %s'%(output_format))
+        return output_format
+
+    def create_result_metadata(self, analysis_name):
+        return {'analysis': analysis_name,
+                'input_settings': json.dumps(self.user_input_data, sort_keys=True),
+                'time_steps': np.array(self.get_file_indices() if self.followed_time_steps is None else self.followed_time_steps, dtype=np.int64)}
+
+    def create_spatial_bin_datasets(self):
+        """The spatial bin layout of the results, for the result file."""
+        try:
+            d_liq = float(self.user_input_data['d_liq'])
+        except KeyError:
+            logger.error('d_liq missing from input file. Needed to nondimensionalize data.')
+            raise KeyError
+        return {'x_bin_edges': self.particle_bin_domain.compute_x_bin_edges(),
+                'y_bin_edges': self.particle_bin_domain.compute_y_bin_edges(),
+                'x_bin_centers': self.particle_bin_domain.compute_x_bin_center_coords(),
+                'y_bin_centers': self.particle_bin_domain.compute_y_bin_center_coords(),
+                'd_liq': d_liq,
+                'radial_bin_flag': self.get_radial_bin_flag()}
+
+    def get_radial_bin_flag(self):
+        try:
+            radial_bin_flag = int(self.user_input_data['radial_bin_flag'])
+        except KeyError:
+            logger.error('radial_bin_flag missing from input file. 0 for cartesian y bins, 1 for cylindrical R bins. If 1, treats y variable as r in code. Defaulting to 0 .')
+            radial_bin_flag = 0
+        return radial_bin_flag
+
+    def get_read_chunk_size(self):
+        """
+        Number of rows read at a time: read_chunk_size when it is given, otherwise the number of rows that fit into
+        the memory budget of every worker, and 0 (whole datasets) without either.
+        """
+        try:
+            read_chunk_size = int(self.user_input_data['read_chunk_size'])
+        except KeyError:
+            memory_budget = self.get_memory_budget()
+            if memory_budget is None:
+                return 0
+            read_chunk_size = max(memory_budget // (max(self.num_workers, 1) * parcel_row_bytes), min_memory_budget_chunk_rows)
+        return read_chunk_size
+
+    def get_memory_budget(self):
+        """Memory in bytes that the parcels being processed may take up (memory_budget_mb), or None without a budget."""
+        try:
+            memory_budget = int(float(self.user_input_data['memory_budget_mb']) * 2**20)
+        except KeyError:
+            return None
+        if memory_budget <= 0:
+            raise ValueError('memory_budget_mb must be positive, not: %s'%(self.user_input_data['memory_budget_mb']))
+        return memory_budget
+
+    def is_out_of_core(self):
+        """
+        With a memory budget every chunk of a time step is folded into the accumulators as soon as it is read, so a
+        time step never has to fit into memory as a whole.
+        """
+        return self.get_memory_budget() is not None
+
+    def compute_parcel_y(self, particle_data):
+        """Coordinates of the parcels used for the y bins, the radius when the bins are radial."""
+        if self.get_radial_bin_flag() == 1:
+            return np.sqrt(particle_data['y']**2 + particle_data['z']**2)
+        return particle_data['y']
+
+    def read_snapshot(self, time_stamp, buffer_pool=None):
+        """
+        Read the parcel data of one time step and return it with the coordinates used for the y bins. Parcels outside
+        of the binning domain are dropped by a bounding box filter while the data is read.
+        """
+        radial_bin_flag = self.get_radial_bin_flag()
+
+        #Read particle data from HDF5 data files
+        logger.info("Reading Data from time step: %s"%(str(time_stamp)))
+        with self.instrumentation.time_stage('read', time_stamp) as counts:
+            data_reader = self.create_hdf5_reader(time_stamp, buffer_pool)
+            parcel_filter = particle_bins.BoundingBoxFilter(self.particle_bin_domain, radial_bin_flag)
+            particle_data = data_reader.read_hdf_particle_data(parcel_filter, self.get_read_chunk_size())
+            counts['parcels'] = data_reader.num_parcels
+            counts['bytes_read'] = data_reader.bytes_read
+        logger.info("Number of parcels inside of the binning domain in time step %s :\t%d"%(str(time_stamp), len(particle_data)))
+        return particle_data, self.compute_parcel_y(particle_data)
+
+    def iterate_snapshot_chunks(self, time_stamp, buffer_pool=None):
+        """
+        Out of core version of read_snapshot that yields the parcels of a time step (and the coordinates used for the
+        y bins) a chunk of get_read_chunk_size rows at a time. The read and bin stages of the time step are recorded
+        once each when the chunks have been processed.
+        """
+        logger.info("Reading Data from time step %s in chunks of %d parcels"%(str(time_stamp), self.get_read_chunk_size()))
+        data_reader = self.create_hdf5_reader(time_stamp, buffer_pool)
+        parcel_filter = particle_bins.BoundingBoxFilter(self.particle_bin_domain, self.get_radial_bin_flag())
+        chunks = data_reader.iterate_particle_data_chunks(parcel_filter, self.get_read_chunk_size())
+        read_time = 0.0
+        num_kept_parcels = 0
+        try:
+            while True:
+                start = time.time()
+                particle_data = next(chunks, None)
+                read_time += time.time() - start
+                if particle_data is None:
+                    break
+                num_kept_parcels += len(particle_data)
+                yield particle_data, self.compute_parcel_y(particle_data)
+        finally:
+            chunks.close()
+            self.instrumentation.add_record('read', read_time, data_reader.num_parcels, data_reader.bytes_read, time_stamp)
+        logger.info("Number of parcels inside of the binning domain in time step %s :\t%d"%(str(time_stamp), num_kept_parcels))
+
+    def read_and_bin_snapshot(self, time_stamp, buffer_pool=None):
+        """Read the data of one time step and return a nXBins x nYBins nested list of ParticleBinCell objects."""
+        return self.bin_snapshot(self.read_snapshot_for_binning(time_stamp, buffer_pool))
+
+    def read_snapshot_for_binning(self, time_stamp, buffer_pool=None):
+        snapshot = {'time_stamp': time_stamp}
+        snapshot['particle_data'], snapshot['parcel_y'] = self.read_snapshot(time_stamp, buffer_pool)
+        return snapshot
+
+    def bin_snapshot(self, snapshot):
+        """Place the parcels of a time step returned by read_snapshot_for_binning into a nXBins x nYBins nested list of ParticleBinCell objects."""
+        with self.instrumentation.time_stage('bin', snapshot['time_stamp']) as counts:
+            counts['parcels'] = len(snapshot['particle_data'])
+            return self.place_parcels_into_spatial_bins(snapshot['particle_data'], snapshot['parcel_y'])
+
+    def place_parcels_into_spatial_bins(self, particle_data, parcel_y):
+        #Compute the bin of every parcel once and group the parcels of each bin together
+        logger.info("Counting Particles in the spatial bins")
+        num_x_bins = self.particle_bin_domain.num_x_bins
+        num_y_bins = self.particle_bin_domain.num_y_bins
+        diameters = particle_data['diameter']
+        particles_per_parcel = particle_data['particles_per_parcel']
 
+        binned_parcels = [[particle_bins.ParticleBinCell(dtype=particle_data.dtype) for k in range(num_y_bins)] for j in range(num_x_bins)]
+        order, bin_offsets = self.particle_bin_domain.group_parcels_by_bin(particle_data['x'], parcel_y)
+        for n in range(0, len(bin_offsets) - 1):
+            j, k = divmod(n, num_y_bins)
+            in_bin = order[bin_offsets[n]:bin_offsets[n + 1]]
+            binned_parcels[j][k].add_parcels(diameters[in_bin], particles_per_parcel[in_bin])
+            logger.debug("Number of Parcels in X Bin(%d) & Y Bin(%d) is:\t %d"%(j + 1, k + 1, len(in_bin)))
+        return binned_parcels
+
+    def get_streaming_flag(self):
+        try:
+            streaming_flag = int(self.user_input_data['streaming_flag'])
+        except KeyError:
+            streaming_flag = 0
+        return streaming_flag
+
+    def get_diameter_bin_flag(self):
+        try:
+            diameter_bin_flag = int(self.user_input_data['diameter_bin_flag'])
+        except KeyError:
+            logger.error('diameter_bin_flag missing from input file. #1 for using diameter bins and 0 for no diameter bins. Defaulting to 0 .')
+            diameter_bin_flag = 0
+        return diameter_bin_flag
+
+    def is_streaming(self):
+        """
+        Time steps are folded into running statistics when streaming is asked for, a snapshot cache is used, the
+        statistics are kept in a state file between runs or the histogram cube is kept.
+        """
+        return (self.get_streaming_flag() == 1 or 'cache_directory' in self.user_input_data or 'state_file' in self.user_input_data
+                or self.get_histogram_cube_flag() == 1)
+
+    def create_bin_accumulators(self, time_stamp=None):
+        """
+        The set of running per-bin statistics that the analyzer needs when streaming over the time steps. The
+        time_stamp is given when the accumulators are filled with the parcels of a single time step.
+        """
+        raise NotImplementedError
+
+    def get_histogram_cube_flag(self):
+        try:
+            histogram_cube_flag = int(self.user_input_data['histogram_cube_flag'])
+        except KeyError:
+            histogram_cube_flag = 0
+        return histogram_cube_flag
+
+    def add_histogram_cube_accumulator(self, accumulators, time_stamp=None):
+        """Add the per time step diameter histograms of the user defined bins if the user asked for the histogram cube."""
+        if self.get_histogram_cube_flag() == 1:
+            diameter_bin_edges = particle_bins.compute_diameter_bin_edges(self.compute_user_defined_bins())
+            accumulators['histogram_cube'] = bin_accumulators.DiameterHistogramCubeAccumulator(self.particle_bin_domain.num_x_bins,
+                                                                                              self.particle_bin_domain.num_y_bins,
+                                                                                              diameter_bin_edges, time_stamp)
+
+    def write_histogram_cube_file(self, accumulators):
+        """
+        Write the histogram cube with the bootstrap confidence intervals and the convergence metric of the time
+        averaged PDFs into <case>_HistogramCube.h5 in the run directory.
+        """
+        if 'histogram_cube' not in accumulators:
+            return
+        try:
+            case_name = self.user_input_data['case_name']
+        except KeyError:
+            logger.error('case_name missing from input file. The prefix on the lagrangian files that signify the case name that generated them.')
+            raise KeyError
+        try:
+            block_length = int(self.user_input_data['bootstrap_block_length'])
+        except KeyError:
+            block_length = None
+        try:
+            num_resamples = int(self.user_input_data['bootstrap_resamples'])
+        except KeyError:
+            num_resamples = 1000
+        try:
+            confidence = float(self.user_input_data['bootstrap_confidence'])
+        except KeyError:
+            confidence = 0.95
+        try:
+            window_fraction = float(self.user_input_data['convergence_window'])
+        except KeyError:
+            window_fraction = 0.25
+
+        with self.instrumentation.time_stage('histogram_cube'):
+            datasets = self.create_spatial_bin_datasets()
+            datasets.update(histogram_cube.create_histogram_cube_datasets(accumulators['histogram_cube'], block_length, num_resamples,
+                                                                          confidence, window_fraction))
+            metadata = self.create_result_metadata('histogram_cube')
+            metadata['time_steps'] = datasets['time_steps']
+            result_file.write_result_file(os.path.join(self.run_directory, case_name + '_HistogramCube.h5'), datasets, metadata)
+
+    def read_and_accumulate_snapshot(self, time_stamp, buffer_pool=None):
+        """
+        Read the data of one time step and fold it into a new set of per-bin accumulators. When a snapshot cache is
+        used the cached summary of the time step is used instead of the particle files, if there is one.
+        """
+        return self.accumulate_snapshot(self.read_snapshot_for_accumulation(time_stamp, buffer_pool))
+
+    def read_snapshot_for_accumulation(self, time_stamp, buffer_pool=None):
+        """Read the cached summary of a time step if there is one, and its parcels otherwise."""
+        snapshot = {'time_stamp': time_stamp, 'summary': None}
+        snapshot_cache = self.create_snapshot_cache()
+        if snapshot_cache is not None:
+            with self.instrumentation.time_stage('cache_load', time_stamp):
+                snapshot['summary'] = snapshot_cache.load(time_stamp, self.get_snapshot_signature(time_stamp))
+        if snapshot['summary'] is None:
+            if self.is_out_of_core():
+                #Only read when the time step is folded into the accumulators
+                snapshot['particle_chunks'] = self.iterate_snapshot_chunks(time_stamp, buffer_pool)
+            else:
+                snapshot['particle_data'], snapshot['parcel_y'] = self.read_snapshot(time_stamp, buffer_pool)
+        return snapshot
+
+    def accumulate_snapshot(self, snapshot):
+        """Fold a time step returned by read_snapshot_for_accumulation into a new set of per-bin accumulators."""
+        if 'particle_chunks' in snapshot:
+            #The read and bin stages are timed chunk by chunk
+            return self.fold_snapshot_into_accumulators(snapshot)
+        with self.instrumentation.time_stage('bin', snapshot['time_stamp']) as counts:
+            if snapshot['summary'] is None:
+                counts['parcels'] = len(snapshot['particle_data'])
+            return self.fold_snapshot_into_accumulators(snapshot)
+
+    def fold_snapshot_into_accumulators(self, snapshot):
+        snapshot_cache = self.create_snapshot_cache()
+        if snapshot_cache is None:
+            accumulators = self.create_bin_accumulators(snapshot['time_stamp'])
+            self.add_snapshot_to_accumulators(snapshot, accumulators)
+            return accumulators
+
+        summary = snapshot['summary']
+        if summary is None:
+            summary = snapshot_cache_module.create_snapshot_summary(self.particle_bin_domain.num_x_bins, self.particle_bin_domain.num_y_bins,
+                                                                    self.get_cache_diameter_resolution())
+            self.add_snapshot_to_accumulators(snapshot, summary)
+            time_stamp = snapshot['time_stamp']
+            snapshot_cache.save(time_stamp, self.get_snapshot_signature(time_stamp), summary)
+
+        accumulators = self.create_bin_accumulators(snapshot['time_stamp'])
+        snapshot_cache_module.fold_snapshot_summary(accumulators, summary)
+        return accumulators
+
+    def add_snapshot_to_accumulators(self, snapshot, accumulators):
+        if 'particle_chunks' not in snapshot:
+            self.add_parcels_to_accumulators(snapshot['particle_data'], snapshot['parcel_y'], accumulators)
+            return
+
+        bin_time = 0.0
+        num_parcels = 0
+        for particle_data, parcel_y in snapshot['particle_chunks']:
+            start = time.time()
+            self.add_parcels_to_accumulators(particle_data, parcel_y, accumulators)
+            bin_time += time.time() - start
+            num_parcels += len(particle_data)
+        self.instrumentation.add_record('bin', bin_time, num_parcels, 0, snapshot['time_stamp'])
+
+    def add_parcels_to_accumulators(self, particle_data, parcel_y, accumulators):
+        """Fold parcels (a whole time step or a chunk of one) into the accumulators."""
+        bin_indices = self.particle_bin_domain.compute_flat_bin_indices(particle_data['x'], parcel_y)
+        inside = bin_indices >= 0
+        logger.debug("Number of parcels inside of the binning domain:\t%d"%(np.count_nonzero(inside)))
+        accumulators.add_parcels(bin_indices[inside], particle_data['diameter'][inside], particle_data['particles_per_parcel'][inside])
+
+    def get_snapshot_signature(self, time_stamp):
+        """Identifies the parcel data of a time step, for the snapshot cache and the state file manifest."""
+        parcel_store_file_name = self.get_parcel_store_file_name()
+        if parcel_store_file_name is not None:
+            return parcel_store.ParcelStore(parcel_store_file_name).get_time_step_signature(time_stamp)
+        return utilities.get_file_signature(self.get_snapshot_file_names(time_stamp))
+
+    def get_snapshot_file_names(self, time_stamp):
+        parcel_store_file_name = self.get_parcel_store_file_name()
+        if parcel_store_file_name is not None:
+            return [parcel_store_file_name]
+        try:
+            case_name = self.user_input_data['case_name']
+        except KeyError:
+            logger.error('case_name missing from input file. The prefix on the lagrangian files that signify the case name that generated them.')
+            raise 
+        return [prefix + '.' + str(time_stamp) + '_' + case_name for prefix in self.particle_file_prefixes]
+
+    def get_cache_diameter_resolution(self):
+        try:
+            cache_diameter_resolution = float(self.user_input_data['cache_diameter_resolution'])
+        except KeyError:
+            cache_diameter_resolution = 0.1e-6
+        return cache_diameter_resolution
+
+    def create_snapshot_cache(self):
+        """Snapshot cache in the user's cache_directory, or None if no cache directory was given."""
+        if 'cache_directory' not in self.user_input_data:
+            return None
+        return snapshot_cache_module.SnapshotCache(os.path.abspath(self.user_input_data['cache_directory']), self.get_spatial_binning_parameters())
+
+    def get_spatial_binning_parameters(self):
+        """The settings that decide which spatial bin every parcel falls into and the fine diameter bins of the cache."""
+        return {'x_min': self.particle_bin_domain.x_min,
+                'x_max': self.particle_bin_domain.x_max,
+                'y_min': self.particle_bin_domain.y_min,
+                'y_max': self.particle_bin_domain.y_max,
+                'num_x_bins': self.particle_bin_domain.num_x_bins,
+                'num_y_bins': self.particle_bin_domain.num_y_bins,
+                'radial_bin_flag': self.get_radial_bin_flag(),
+                'parcel_precision': self.get_parcel_dtype().name,
+                'cache_diameter_resolution': self.get_cache_diameter_resolution()}
+
+    def get_accumulator_parameters(self):
+        """Everything the running statistics of a state file depend on, besides the time steps folded into them."""
+        accumulator_parameters = self.get_spatial_binning_parameters()
+        accumulator_parameters['analyzer'] = type(self).__name__
+        accumulator_parameters['snapshot_cache'] = 'cache_directory' in self.user_input_data
+        for key in ['diameter_bin_flag', 'd_min', 'd_max', 'num_dia_bins', 'histogram_cube_flag', 'quantile_relative_accuracy',
+                    'quantile_min_diameter', 'quantile_max_diameter']:
+            accumulator_parameters[key] = self.user_input_data.get(key)
+        accumulator_parameters['accumulators'] = sorted(self.create_bin_accumulators().accumulators)
+        return accumulator_parameters
+
+    def get_state_file_name(self):
+        try:
+            state_file_name = self.user_input_data['state_file']
+        except KeyError:
+            return None
+        return os.path.join(self.run_directory, state_file_name)
+
+    def create_accumulator_manifest(self):
+        """The record of the settings and the time steps that went into a set of running statistics."""
+        return {'version': state_file_version, 'accumulator_parameters': self.get_accumulator_parameters(), 'time_steps': {}}
+
+    def load_accumulator_state(self, file_indices):
+        """
+        Return the accumulators and the manifest saved in the state file by an earlier run, or a new set of
+        accumulators and an empty manifest if the saved state can not be reused. The state is only reused when it
+        was built with the same settings from time steps that are all still selected and unchanged, because the
+        contribution of a single time step can not be taken back out of the running statistics.
+        """
+        manifest = self.create_accumulator_manifest()
+        state_file_name = self.get_state_file_name()
+        if not os.path.exists(state_file_name):
+            logger.info("No state file %s yet. Processing all time steps."%(state_file_name))
+            return self.create_bin_accumulators(), manifest
+
+        saved_manifest = bin_accumulators.BinAccumulatorSet.load_metadata(state_file_name)
+        if saved_manifest is None or saved_manifest.get('version') != state_file_version:
+            logger.warning("The state file %s was not written by this version of the analyzer. Rebuilding it."%(state_file_name))
+            return self.create_bin_accumulators(), manifest
+        if saved_manifest['accumulator_parameters'] != manifest['accumulator_parameters']:
+            logger.warning("The binning settings changed since the state file %s was written. Rebuilding it."%(state_file_name))
+            return self.create_bin_accumulators(), manifest
+
+        selected_time_steps = set(str(time_stamp) for time_stamp in file_indices)
+        for time_stamp, signature in sorted(saved_manifest['time_steps'].items()):
+            if time_stamp not in selected_time_steps:
+                logger.warning("Time step %s of the state file %s is no longer selected. Rebuilding it."%(time_stamp, state_file_name))
+                return self.create_bin_accumulators(), manifest
+            if self.get_snapshot_signature(time_stamp) != signature:
+                logger.warning("Time step %s changed since the state file %s was written. Rebuilding it."%(time_stamp, state_file_name))
+                return self.create_bin_accumulators(), manifest
+
+        logger.info("Loading the statistics of %d time steps from the state file %s"%(len(saved_manifest['time_steps']), state_file_name))
+        return bin_accumulators.BinAccumulatorSet.load(state_file_name), saved_manifest
+
+    def save_accumulator_state(self, accumulators, manifest):
+        state_file_name = self.get_state_file_name()
+        #Write to a temporary file first so that an interrupted run keeps the previous state file
+        temporary_file_name = '%s.%d.tmp'%(state_file_name, os.getpid())
+        accumulators.save(temporary_file_name, manifest)
+        os.replace(temporary_file_name, state_file_name)
+        logger.info("Saved the statistics of %d time steps in the state file %s"%(len(manifest['time_steps']), state_file_name))
+
+    def accumulate_snapshots(self):
+        """
+        Stream over all time steps, folding each one into running per-bin statistics as soon as it is read. With a
+        state_file only the time steps that are not in the state file yet are read, and the state file is updated.
+        """
+        if self.communicator is not None:
+            return self.accumulate_distributed_snapshots()
+
+        file_indices = self.get_file_indices()
+        if self.get_state_file_name() is None:
+            accumulators, manifest = self.create_bin_accumulators(), self.create_accumulator_manifest()
+        else:
+            accumulators, manifest = self.load_accumulator_state(file_indices)
+        self.fold_new_snapshots(accumulators, manifest, file_indices)
+        return accumulators
+
+    def accumulate_distributed_snapshots(self):
+        """
+        MPI version of accumulate_snapshots. The root rank finds the time steps and reads the state file, every rank
+        folds its share of the new time steps into its own accumulators, and those are reduced onto the root rank,
+        which updates the state file. Returns the accumulators on the root rank and None on the other ranks.
+        """
+        accumulators = None
+        manifest = None
+        new_time_steps = None
+        if self.is_root_rank():
+            file_indices = self.get_file_indices()
+            if self.get_state_file_name() is None:
+                accumulators, manifest = self.create_bin_accumulators(), self.create_accumulator_manifest()
+            else:
+                accumulators, manifest = self.load_accumulator_state(file_indices)
+            new_time_steps = [time_stamp for time_stamp in file_indices if str(time_stamp) not in manifest['time_steps']]
+            #Record the signatures before reading, so that a time step rewritten during the run is read again next time
+            new_signatures = dict((str(time_stamp), self.get_snapshot_signature(time_stamp)) for time_stamp in new_time_steps)
+        new_time_steps = self.communicator.bcast(new_time_steps, root=mpi_distribution.root_rank)
+
+        rank_accumulators = self.create_bin_accumulators()
+        logger.info('Streaming Data from timesteps on MPI rank %d:'%(self.communicator.Get_rank()))
+        self.fold_snapshots(rank_accumulators, self.get_rank_time_steps(new_time_steps))
+        with self.instrumentation.time_stage('mpi_reduce'):
+            rank_accumulators = mpi_distribution.reduce_accumulators(self.communicator, rank_accumulators)
+        if not self.is_root_rank():
+            return None
+
+        accumulators += rank_accumulators
+        manifest['time_steps'].update(new_signatures)
+        if self.get_state_file_name() is not None and new_time_steps:
+            self.save_accumulator_state(accumulators, manifest)
+        return accumulators
+
+    def fold_new_snapshots(self, accumulators, manifest, file_indices):
+        """
+        Fold the time steps that are not in the manifest yet into the accumulators and add them to the manifest.
+        The state file is updated if the user gave one. Returns the time steps that were folded in.
+        """
+        file_indices = [time_stamp for time_stamp in file_indices if str(time_stamp) not in manifest['time_steps']]
+        #Record the signatures before reading, so that a time step rewritten during the run is read again next time
+        new_signatures = dict((str(time_stamp), self.get_snapshot_signature(time_stamp)) for time_stamp in file_indices)
+
+        logger.info('Streaming Data from timesteps:')
+        self.fold_snapshots(accumulators, file_indices)
+
+        manifest['time_steps'].update(new_signatures)
+        if self.get_state_file_name() is not None and file_indices:
+            self.save_accumulator_state(accumulators, manifest)
+        return file_indices
+
+    def fold_snapshots(self, accumulators, file_indices):
+        """Read the given time steps and fold them into the accumulators."""
+        logger.info(file_indices)
+        for i, snapshot_accumulators in enumerate(self.iterate_snapshots(file_indices, 'read_and_accumulate_snapshot')):
+            with self.instrumentation.time_stage('merge', file_indices[i]):
+                accumulators += snapshot_accumulators
+            logger.info("Data file %d successfully accumulated"%(i + 1))
+
+    def check_streaming_settings(self):
+        """Raise an error if the analysis can not be computed from running per-bin statistics."""
+        pass
+
+    def write_streamed_output(self, accumulators):
+        """Write the results of the analysis computed from running per-bin statistics."""
+        raise NotImplementedError
+
+    def get_follow_settings(self):
+        """
+        Settings of follow mode: how often to look for new files when inotify is not used, how often to rewrite the
+        results, how long the files of a time step must stay unchanged to be complete, and how long to wait for new
+        time steps before stopping (None to follow until interrupted).
+        """
+        follow_settings = {}
+        for key, default in [('follow_poll_interval', 10.0), ('follow_write_interval', 60.0), ('follow_settle_time', 2.0), ('follow_idle_timeout', None)]:
             try:
-                radial_bin_flag = int(self.user_input_data['radial_bin_flag'])
+                follow_settings[key] = float(self.user_input_data[key])
             except KeyError:
-                logger.error('radial_bin_flag missing from input file. 0 for cartesian y bins, 1 for cylindrical R bins. If 1, treats y variable as r in code. Defaulting to 0 .')
-                radial_bin_flag = 0
-
-            #Loop over all bins and store data about particles within the bin
-            x_bin_coords = self.particle_bin_domain.compute_x_bin_coords()
-            y_bin_coords = self.particle_bin_domain.compute_y_bin_coords()
-
-            #Loop over Y bins & sweep over the X bins and store particle information
-            logger.info("Counting Particles for File: %d"%(i + 1))
-            num_parcels = len(particle_data)
-            num_x_bins = self.particle_bin_domain.num_x_bins
-            num_y_bins = self.particle_bin_domain.num_y_bins
-            for j in range(0, num_x_bins):
-                logger.info("Placing parcels into X-bin:\t%d"%(j + 1))
-                for k in range(0, num_y_bins):
-                    logger.info("\tPlacing parcels into Y-bin:\t%d"%(k + 1))
-                    parcels_in_bin = 0
-                    for parcel in particle_data:  #Loop over all parcels to find which are in the current bin
-                        parcel_x = parcel['x']
-                        if radial_bin_flag == 1:
-                            parcel_y = math.sqrt(parcel['y']**2 + parcel['z']**2)
-                        else:
-                            parcel_y = parcel['y']
-                        if parcel_x < x_bin_coords[1][j] and parcel_x >= x_bin_coords[0][j] and parcel_y < y_bin_coords[1][k] and parcel_y >= y_bin_coords[0][k]:
-                            #logger.debug("i = %d\tj = %d\tk = %d\n"%(i+1,m+1,k+1))
-                            spatially_binned_parcels[i][j][k].add_data(parcel['diameter'], parcel['particles_per_parcel'])
-                            parcels_in_bin += 1
-                    logger.info("\t\tNumber of Parcels in X Bin(%d) & Y Bin(%d) is:\t %d"%(j + 1, k + 1, parcels_in_bin))
-        return spatially_binned_parcels      
+                follow_settings[key] = default
+        return follow_settings
+
+    def find_new_complete_time_steps(self, manifest, completion_tracker):
+        """The time steps that are not in the manifest yet and whose files have been completely written."""
+        i_start, i_end, i_step = self.get_time_step_range()
+        parcel_store_file_name = self.get_parcel_store_file_name()
+        if parcel_store_file_name is not None:
+            #The index of a parcel store is only extended after the parcels of a time step were written
+            parcel_store_file_name = os.path.join(self.run_directory, parcel_store_file_name)
+            if not os.path.exists(parcel_store_file_name):
+                return []
+            time_steps = utilities.select_time_steps(parcel_store.ParcelStore(parcel_store_file_name).get_time_steps(), i_start, i_end, i_step)
+            return [time_stamp for time_stamp in time_steps if str(time_stamp) not in manifest['time_steps']]
+
+        try:
+            case_name = self.user_input_data['case_name']
+        except KeyError:
+            logger.error('case_name missing from input file. The prefix on the lagrangian files that signify the case name that generated them.')
+            raise 
+        time_steps = utilities.discover_time_steps(case_name, self.particle_file_prefixes, i_start, i_end, i_step, self.run_directory)
+        complete_time_steps = []
+        for time_stamp in time_steps:
+            if str(time_stamp) in manifest['time_steps']:
+                continue
+            file_names = self.get_snapshot_file_names(time_stamp)
+            if completion_tracker.is_complete(time_stamp, file_names) and all(h5py.is_hdf5(file_name) for file_name in file_names):
+                complete_time_steps.append(time_stamp)
+        return complete_time_steps
+
+    def follow_data(self):
+        """
+        Follow a running simulation: fold every time step into the running per-bin statistics as soon as its files
+        are complete, and rewrite the results every follow_write_interval seconds while new time steps come in.
+        Stops after follow_idle_timeout seconds without new time steps or when interrupted, and writes the final
+        results.
+        """
+        self.particle_bin_domain = self.create_particle_bin_domain()
+        self.check_streaming_settings()
+        follow_settings = self.get_follow_settings()
+        if self.get_state_file_name() is None:
+            accumulators, manifest = self.create_bin_accumulators(), self.create_accumulator_manifest()
+        else:
+            accumulators, manifest = self.load_accumulator_state(self.find_new_complete_time_steps(self.create_accumulator_manifest(),
+                                                                                                  directory_watcher.FileCompletionTracker(0.0)))
+        self.followed_time_steps = sorted(int(time_stamp) for time_stamp in manifest['time_steps'])
+
+        watcher = directory_watcher.DirectoryWatcher(self.run_directory)
+        completion_tracker = directory_watcher.FileCompletionTracker(follow_settings['follow_settle_time'])
+        results_outdated = len(self.followed_time_steps) > 0
+        last_write_time = None
+        last_new_data_time = time.time()
+        logger.info("Following the time steps written to %s"%(self.run_directory))
+        try:
+            while True:
+                new_time_steps = self.fold_new_snapshots(accumulators, manifest, self.find_new_complete_time_steps(manifest, completion_tracker))
+                if new_time_steps:
+                    self.followed_time_steps = sorted(int(time_stamp) for time_stamp in manifest['time_steps'])
+                    results_outdated = True
+                    last_new_data_time = time.time()
+                    logger.info("Folded in %d new time steps, %d in total"%(len(new_time_steps), len(self.followed_time_steps)))
+
+                if results_outdated and (last_write_time is None or time.time() - last_write_time >= follow_settings['follow_write_interval']):
+                    self.write_followed_output(accumulators)
+                    results_outdated = False
+                    last_write_time = time.time()
+
+                idle_timeout = follow_settings['follow_idle_timeout']
+                if idle_timeout is not None and time.time() - last_new_data_time >= idle_timeout:
+                    logger.info("No new time steps for %g s. Stopping."%(idle_timeout))
+                    break
+                #Look again soon when the files of a time step are still being written
+                if completion_tracker.has_pending():
+                    watcher.wait(min(follow_settings['follow_poll_interval'], max(follow_settings['follow_settle_time'], 0.1)))
+                else:
+                    watcher.wait(follow_settings['follow_poll_interval'])
+        except KeyboardInterrupt:
+            logger.info("Interrupted after folding in %d time steps"%(len(self.followed_time_steps)))
+        finally:
+            watcher.close()
+
+        if results_outdated:
+            self.write_followed_output(accumulators)
+        logger.info("\n Program has finished... \n")
+
+    def write_followed_output(self, accumulators):
+        if not self.followed_time_steps:
+            return
+        logger.info("Writing the results of %d time steps"%(len(self.followed_time_steps)))
+        self.write_streamed_output(accumulators)
+        #The output writers change the working directory
+        os.chdir(self.run_directory)
+
+    def create_diameter_histogram_accumulator(self):
+        diameter_bin_edges = particle_bins.compute_diameter_bin_edges(self.compute_user_defined_bins())
+        return bin_accumulators.DiameterHistogramAccumulator(self.particle_bin_domain.num_x_bins,
+                                                             self.particle_bin_domain.num_y_bins, diameter_bin_edges)
+
+    def convert_diameter_histogram_to_particle_bin_cells(self, diameter_histogram):
+        """Store a diameter histogram in the same form as the output of remap_particle_diameters_to_custom_bins."""
+        diameter_histogram.log_out_of_range_counts()
+        centers = diameter_histogram.compute_diameter_bin_centers()
+        parcel_dtype = self.get_parcel_dtype()
+        avg_pdf = []
+        for j in range(0, diameter_histogram.num_x_bins):
+            avg_pdf.append([])
+            for k in range(0, diameter_histogram.num_y_bins):
+                parcels = parcel_table.ParcelTable({'diameter': centers, 'particles_per_parcel': diameter_histogram.counts[j][k]}, parcel_dtype)
+                avg_pdf[j].append(particle_bins.ParticleBinCell(parcels))
+        return avg_pdf
 
     def remap_particle_diameters_to_custom_bins(self, particle_data):
         logger.info("Re-Mapping Particle Diameter data to user-defined bins")
         user_defined_bins = self.compute_user_defined_bins()
         #Re-Bin all of the diameter data using the newly defined diameters
-        for i in range(0, len(particle_data)):
-            for j in range(0, len(particle_data[0])):
-                particle_data[i][j].sort_particles_per_parcel()
-                particle_data[i][j].custom_bins(user_defined_bins)
-                particle_data[i][j].sort_diameters()
-
-    def inplace_sort_particle_data_by_diameter(self, particle_data):
-        """Sort diameter data in the data structure to speed up the merging process."""
-        logger.info("Performing a Sort on the particle diameter data to improve performance")
-        num_files = len(particle_data)
-        num_x_bins = self.particle_bin_domain.num_x_bins 
-        num_y_bins = self.particle_bin_domain.num_y_bins 
-        for i in range(0, num_files):
-            for j in range(0, num_x_bins):
-                logger.info("\nSorting X Bin: %d"%(j + 1))
-                for k in range(0, num_y_bins):
-                    logger.info("\tSorting Y Bin: %d"%(k + 1))
-                    particle_data[i][j][k].sort_diameters()
-    
-    def inplace_merge_particle_data_over_all_files(self, particle_data):
-        """Compute a time averaged PDF by averaging over all time entries"""
+        with self.instrumentation.time_stage('remap') as counts:
+            for i in range(0, len(particle_data)):
+                for j in range(0, len(particle_data[0])):
+                    counts['parcels'] += particle_data[i][j].num_parcels
+                    particle_data[i][j].custom_bins(user_defined_bins)
+                    particle_data[i][j].sort_diameters()
+
+    def inplace_merge_particle_data_over_all_files(self, particle_data, sort_diameters=True):
+        """
+        Compute a time averaged PDF by averaging over all time entries
+
+        The parcels of each bin are concatenated over all files in one pass and sorted by diameter once at the end.
+        The sort can be skipped when the merged data is only going to be histogrammed.
+        """
         logger.info("Merging data over all files")
         num_files = len(particle_data)
         num_x_bins = self.particle_bin_domain.num_x_bins 
         num_y_bins = self.particle_bin_domain.num_y_bins
-        avg = [[particle_bins.ParticleBinCell() for j in range(num_y_bins) ]for i in range(num_x_bins)]
-        for i in range(0, num_files):
-            logger.info("Merging Data from File: %d"%(i + 1))
+        avg = [[None for j in range(num_y_bins) ]for i in range(num_x_bins)]
+        with self.instrumentation.time_stage('merge') as counts:
             for j in range(0, num_x_bins):
-                logger.info("\tMerging X Bin: %d"%(j + 1))
+                logger.debug("Merging X Bin: %d"%(j + 1))
                 for k in range(0, num_y_bins):
-                    logger.info("\t\tMerging Y Bin: %d"%(k + 1))
-                    if i == 0:
-                        avg[j][k] = particle_data[i][j][k]
-                    else:
-                        avg[j][k] =  avg[j][k] + particle_data[i][j][k]
-                        #Sort the new output
-                        avg[j][k].sort_diameters()
-            logger.info("Data file %d successfully merged\n"%(i+1))
+                    avg[j][k] = particle_bins.ParticleBinCell.merge([particle_data[i][j][k] for i in range(0, num_files)], sort_diameters)
+                    counts['parcels'] += avg[j][k].num_parcels
+        logger.info("Data from %d files successfully merged\n"%(num_files))
         #Debugging 
         #for i in range(0, num_x_bins):
         #   for j in range(0, num_y_bins):
@@ -265,8 +1083,8 @@ class LagrangianParticleDataAnalyzer(object):
 
 
 class LagrangianParticleSMDDataAnalyzer(LagrangianParticleDataAnalyzer):
-    def __init__(self, input_parser):
-        super(LagrangianParticleSMDDataAnalyzer, self).__init__(input_parser)
+    def __init__(self, input_parser, num_workers=1):
+        super(LagrangianParticleSMDDataAnalyzer, self).__init__(input_parser, num_workers)
         self.particle_bin_domain = None
 
     def process_data(self):
@@ -280,39 +1098,83 @@ class LagrangianParticleSMDDataAnalyzer(LagrangianParticleDataAnalyzer):
         self.particle_bin_domain.print_x_bin_coords(d_liq)
         self.particle_bin_domain.print_y_bin_coords(d_liq)
 
-        pdf_data = self.read_data_and_place_parcels_into_spatial_bins()
-        
-        self.inplace_sort_particle_data_by_diameter(pdf_data)
-        avg_pdf = self.inplace_merge_particle_data_over_all_files(pdf_data)
-        
-        try:
-            diameter_bin_flag = int(self.user_input_data['diameter_bin_flag'])
-        except KeyError:
-            logger.error('diameter_bin_flag missing from input file. #1 for using diameter bins and 0 for no diameter bins. Defaulting to 0 .')
-            diameter_bin_flag = 0
-        
-        if diameter_bin_flag == 1: #Use the user defined bins
-            self.remap_particle_diameters_to_custom_bins(avg_pdf)
-        self.write_output(avg_pdf)
+        diameter_bin_flag = self.get_diameter_bin_flag()
+        if self.is_streaming() or diameter_bin_flag == 0:
+            #Without diameter bins only the per-bin diameter moments are needed, and those are computed in a single pass
+            self.check_streaming_settings()
+            accumulators = self.accumulate_snapshots()
+            if self.is_root_rank():
+                self.write_streamed_output(accumulators)
+        else:
+            pdf_data = self.read_data_and_place_parcels_into_spatial_bins()
+            if not self.is_root_rank():
+                return #The results are written by the root MPI rank
+            
+            #Only the diameter histogram of the merged data is needed when diameter bins are used
+            avg_pdf = self.inplace_merge_particle_data_over_all_files(pdf_data, diameter_bin_flag != 1)
+            
+            if diameter_bin_flag == 1: #Use the user defined bins
+                self.remap_particle_diameters_to_custom_bins(avg_pdf)
+            smd = self.compute_sauter_mean_diameter(avg_pdf)
+            with self.instrumentation.time_stage('write'):
+                self.write_output(smd)
         logger.info("\n Program has finished... \n")
 
-    def compute_sauter_mean_diameter(self, avg_pdf):
+    def check_streaming_settings(self):
+        if self.get_diameter_bin_flag() == 1:
+            logger.error('streaming_flag 1, cache_directory, state_file, histogram_cube_flag 1 and follow mode need diameter_bin_flag 0 in smd mode. The D32 of diameter_bin_flag 1 uses Freedman-Diaconis bins that need every parcel diameter at once.')
+            raise ValueError('streaming_flag 1, cache_directory, state_file, histogram_cube_flag 1 and follow mode need diameter_bin_flag 0 in smd mode')
+
+    def write_streamed_output(self, accumulators):
+        smd = self.compute_streamed_sauter_mean_diameter(accumulators)
+        with self.instrumentation.time_stage('write'):
+            self.write_output(smd, accumulators['diameter_moments'], accumulators['diameter_quantiles'])
+        self.write_histogram_cube_file(accumulators)
+
+    def create_bin_accumulators(self, time_stamp=None):
+        num_x_bins = self.particle_bin_domain.num_x_bins
+        num_y_bins = self.particle_bin_domain.num_y_bins
+        accumulators = {'diameter_moments': bin_accumulators.DiameterMomentAccumulator(num_x_bins, num_y_bins),
+                        'diameter_quantiles': self.create_diameter_quantile_sketch_accumulator()}
+        self.add_histogram_cube_accumulator(accumulators, time_stamp)
+        return bin_accumulators.BinAccumulatorSet(accumulators)
+
+    def create_diameter_quantile_sketch_accumulator(self):
+        """Log histogram sketch of every spatial bin for the Dn10/Dn50/Dn90 and Dv10/Dv50/Dv90 percentile diameters."""
         try:
-            diameter_bin_flag = int(self.user_input_data['diameter_bin_flag'])
+            relative_accuracy = float(self.user_input_data['quantile_relative_accuracy'])
         except KeyError:
-            logger.error('diameter_bin_flag missing from input file. #1 for using diameter bins and 0 for no diameter bins. Defaulting to 0 .')
-            diameter_bin_flag = 0
+            relative_accuracy = 0.01
+        try:
+            min_diameter = float(self.user_input_data['quantile_min_diameter'])
+        except KeyError:
+            min_diameter = 1e-7
+        try:
+            max_diameter = float(self.user_input_data['quantile_max_diameter'])
+        except KeyError:
+            max_diameter = 1e-2
+        return bin_accumulators.DiameterQuantileSketchAccumulator(self.particle_bin_domain.num_x_bins, self.particle_bin_domain.num_y_bins,
+                                                                  relative_accuracy, min_diameter, max_diameter)
+
+    def compute_streamed_sauter_mean_diameter(self, accumulators):
+        """D32 from the running diameter moments, the same definition as the diameter_bin_flag 0 path."""
+        return accumulators['diameter_moments'].compute_sauter_mean_diameter()
+
+    def compute_sauter_mean_diameter(self, avg_pdf):
+        diameter_bin_flag = self.get_diameter_bin_flag()
         num_x_bins = self.particle_bin_domain.num_x_bins
         num_y_bins = self.particle_bin_domain.num_y_bins
-        smd = np.zeros((num_x_bins, num_y_bins))
         smd_calculator_factory = particle_statistics.SauterMeanDiameterCalculatorFactory(diameter_bin_flag)
         smd_calculator = smd_calculator_factory.get_sauter_mean_diameter_class()
-        for i in range(num_x_bins):
-            for j in range(num_y_bins):
-                smd[i][j] = smd_calculator.compute_sauter_mean_diameter(avg_pdf[i][j])
-        return smd
 
-    def write_output(self, avg_pdf):
+        #Gather the parcels of all bins into grouped arrays and compute the whole field at once
+        cells = [avg_pdf[i][j] for i in range(num_x_bins) for j in range(num_y_bins)]
+        bin_indices = np.repeat(np.arange(len(cells)), [cell.num_parcels for cell in cells])
+        diameters = np.concatenate([cell.parcels['diameter'] for cell in cells])
+        particles_per_parcel = np.concatenate([cell.parcels['particles_per_parcel'] for cell in cells])
+        return smd_calculator.compute_sauter_mean_diameter_field(bin_indices, diameters, particles_per_parcel, num_x_bins, num_y_bins)
+
+    def write_output(self, smd, diameter_moments=None, diameter_quantiles=None):
         logger.info("Writing Output Data")
 
         #Create output directory and enter the directory
@@ -324,9 +1186,79 @@ class LagrangianParticleSMDDataAnalyzer(LagrangianParticleDataAnalyzer):
         else:
             os.chdir(output_dir)
         
-        self.write_smd_data(avg_pdf)
+        output_format = self.get_output_format()
+        if output_format in ('hdf5', 'both'):
+            self.write_smd_result_file(smd, diameter_moments, diameter_quantiles)
+        if output_format in ('text', 'both'):
+            if diameter_moments is not None:
+                self.write_mean_diameter_data(diameter_moments, diameter_quantiles)
+            self.write_smd_data(smd)
+        self.write_smd_plots(smd)
 
-    def write_smd_data(self, avg_pdf):
+    def write_smd_result_file(self, smd, diameter_moments=None, diameter_quantiles=None):
+        """
+        Write the SMD field, and the diameter moments and percentile diameters when they were computed, into
+        <case>_SMD_Results.h5.
+        """
+        try:
+            case_name = self.user_input_data['case_name']
+        except KeyError:
+            logger.error('case_name missing from input file. The prefix on the lagrangian files that signify the case name that generated them.')
+            raise KeyError
+        datasets = self.create_spatial_bin_datasets()
+        datasets['smd'] = smd
+        if diameter_moments is not None:
+            datasets['moment_sums'] = diameter_moments.moment_sums
+            datasets['parcel_counts'] = diameter_moments.parcel_counts
+            datasets['min_diameters'] = diameter_moments.min_diameters
+            datasets['max_diameters'] = diameter_moments.max_diameters
+            for name, mean_diameter in diameter_moments.compute_mean_diameters().items():
+                datasets[name] = mean_diameter
+        if diameter_quantiles is not None:
+            for name, percentile_diameter in diameter_quantiles.compute_percentile_diameters().items():
+                datasets[name] = percentile_diameter
+        result_file.write_result_file(case_name + '_SMD_Results.h5', datasets, self.create_result_metadata('smd'))
+
+    def write_mean_diameter_data(self, diameter_moments, diameter_quantiles=None):
+        try:
+            case_name = self.user_input_data['case_name']
+        except KeyError:
+            logger.error('case_name missing from input file. The prefix on the lagrangian files that signify the case name that generated them.')
+            raise KeyError
+        
+        try:
+            d_liq = float(self.user_input_data['d_liq'])
+        except KeyError:
+            logger.error('d_liq missing from input file. Needed to nondimensionalize data.')
+            raise KeyError
+        #Write all of the standard mean diameters of the bins at each Y station to one file
+        pdf_x_coords = self.particle_bin_domain.compute_x_bin_center_coords() 
+        pdf_y_coords = self.particle_bin_domain.compute_y_bin_center_coords()
+        num_x_bins = self.particle_bin_domain.num_x_bins
+        num_y_bins = self.particle_bin_domain.num_y_bins
+        mean_diameters = diameter_moments.compute_mean_diameters()
+        mean_diameter_names = ['D10', 'D20', 'D30', 'D32', 'D43']
+        if diameter_quantiles is not None:
+            #The volume weighted percentile diameters are reported alongside the mean diameters
+            mean_diameters.update(diameter_quantiles.compute_percentile_diameters())
+            mean_diameter_names += ['Dv10', 'Dv50', 'Dv90']
+        for m in range(0, num_y_bins):
+            output_file_name = case_name + "_MeanDiameters_" + '%s_%4.2f_Data'%('Y', pdf_y_coords[m] / d_liq) + ".txt"
+            f_output = open(output_file_name,"w")
+            f_output.write("X(m)\t%s\tParcel Count\tMin Diameter(m)\tMax Diameter(m)\n"%("\t".join(name + "(m)" for name in mean_diameter_names)))
+            for k in range(0, num_x_bins):
+                f_output.write("%10.6E\t"%(pdf_x_coords[k]))
+                for name in mean_diameter_names:
+                    f_output.write("%10.6E\t"%(mean_diameters[name][k][m]))
+                f_output.write("%d\t"%(diameter_moments.parcel_counts[k][m]))
+                if diameter_moments.parcel_counts[k][m] > 0:
+                    f_output.write("%10.6E\t%10.6E\t"%(diameter_moments.min_diameters[k][m], diameter_moments.max_diameters[k][m]))
+                else:
+                    f_output.write("%10.6E\t%10.6E\t"%(0, 0))
+                f_output.write("\n\n")
+            f_output.close()
+
+    def write_smd_data(self, smd):
         try:
             case_name = self.user_input_data['case_name']
         except KeyError:
@@ -343,7 +1275,6 @@ class LagrangianParticleSMDDataAnalyzer(LagrangianParticleDataAnalyzer):
         pdf_y_coords = self.particle_bin_domain.compute_y_bin_center_coords()
         num_x_bins = self.particle_bin_domain.num_x_bins
         num_y_bins = self.particle_bin_domain.num_y_bins
-        smd = self.compute_sauter_mean_diameter(avg_pdf)
         for m in range(0, num_y_bins):
             output_file_name = case_name + "_SMD_" + '%s_%4.2f_Data'%('Y', pdf_y_coords[m] / d_liq) + ".txt"
             f_output = open(output_file_name,"w")
@@ -354,8 +1285,6 @@ class LagrangianParticleSMDDataAnalyzer(LagrangianParticleDataAnalyzer):
                 f_output.write("\n\n")
             f_output.close()
 
-        self.write_smd_plots(smd)
-
     def write_smd_plots(self, smd_data):
         try:
             case_name = self.user_input_data['case_name']
@@ -385,6 +1314,7 @@ class LagrangianParticleSMDDataAnalyzer(LagrangianParticleDataAnalyzer):
 
         #Plot SMD variable over space
         DiameterFactor = 1e6 #For expressing diameters in micrometers
+        plot_jobs = []
         for m in range(0, num_y_bins):
             #Find the maximum value of the variable about to be plotted so that the 
             #plot vertical axis can be scaled appropriately
@@ -395,15 +1325,11 @@ class LagrangianParticleSMDDataAnalyzer(LagrangianParticleDataAnalyzer):
             max_val = max_val + 0.05*abs(max_val)
             min_val = min_val - 0.05*abs(min_val)
 
-            plt.plot(pdf_x_coords / d_liq, smd_data[:, m] * DiameterFactor, marker='o')
-            plt.xlabel('Non-Dimensional X Coordinate (X/DL)')
-            plt.ylabel('Sauter Mean Diameter D32(micrometers)')
-            plt.ylim([min_val, max_val])
-
             output_file_name = case_name + "_SMD_" + '%s%4.2f'%('Y',pdf_y_coords[m] / d_liq) + ".png"
-            logger.info("Saving a figure to:%s"%(output_file_name))
-            plt.savefig(output_file_name, bbox_inches='tight')
-            plt.close()
+            plot_jobs.append(plot_renderer.LinePlotJob(os.path.join(output_dir, output_file_name), pdf_x_coords / d_liq, smd_data[:, m] * DiameterFactor,
+                                                       'Non-Dimensional X Coordinate (X/DL)', 'Sauter Mean Diameter D32(micrometers)',
+                                                       [min_val, max_val], marker='o'))
+        self.create_plot_renderer().render(plot_jobs)
 
         #Go back to the original data directory
         os.chdir("..")
@@ -411,8 +1337,8 @@ class LagrangianParticleSMDDataAnalyzer(LagrangianParticleDataAnalyzer):
 
 
 class LagrangianParticlePDFDataAnalyzer(LagrangianParticleDataAnalyzer):
-    def __init__(self, input_parser):
-        super(LagrangianParticlePDFDataAnalyzer, self).__init__(input_parser)
+    def __init__(self, input_parser, num_workers=1):
+        super(LagrangianParticlePDFDataAnalyzer, self).__init__(input_parser, num_workers)
         self.particle_bin_domain = None
 
     def process_data(self):
@@ -426,23 +1352,43 @@ class LagrangianParticlePDFDataAnalyzer(LagrangianParticleDataAnalyzer):
         self.particle_bin_domain.print_x_bin_coords(d_liq)
         self.particle_bin_domain.print_y_bin_coords(d_liq)
 
-        #Initialize 3D array of objects to hold particle data for all bins in each data file. Creates NumFiles x nXBins x nYBins array
-        pdf_data = self.read_data_and_place_parcels_into_spatial_bins() 
+        diameter_bin_flag = self.get_diameter_bin_flag()
+        if self.is_streaming():
+            self.check_streaming_settings()
+            accumulators = self.accumulate_snapshots()
+            if self.is_root_rank():
+                self.write_streamed_output(accumulators)
+        else:
+            #Initialize 3D array of objects to hold particle data for all bins in each data file. Creates NumFiles x nXBins x nYBins array
+            pdf_data = self.read_data_and_place_parcels_into_spatial_bins() 
+            if not self.is_root_rank():
+                return #The results are written by the root MPI rank
 
-        self.inplace_sort_particle_data_by_diameter(pdf_data)
-        avg_pdf = self.inplace_merge_particle_data_over_all_files(pdf_data)
-        
-        try:
-            diameter_bin_flag = int(self.user_input_data['diameter_bin_flag'])
-        except KeyError:
-            logger.error('diameter_bin_flag missing from input file. #1 for using diameter bins and 0 for no diameter bins. Defaulting to 0 .')
-            diameter_bin_flag = 0
-        
-        if diameter_bin_flag == 1: #Use the user defined bins
-            self.remap_particle_diameters_to_custom_bins(avg_pdf)
-        self.write_output(diameter_bin_flag, avg_pdf)
+            #Only the diameter histogram of the merged data is needed when diameter bins are used
+            avg_pdf = self.inplace_merge_particle_data_over_all_files(pdf_data, diameter_bin_flag != 1)
+            
+            if diameter_bin_flag == 1: #Use the user defined bins
+                self.remap_particle_diameters_to_custom_bins(avg_pdf)
+            with self.instrumentation.time_stage('write'):
+                self.write_output(diameter_bin_flag, avg_pdf)
         logger.info("\n Program has finished... \n")
 
+    def check_streaming_settings(self):
+        if self.get_diameter_bin_flag() != 1:
+            logger.error('streaming_flag 1, cache_directory, state_file, histogram_cube_flag 1 and follow mode need diameter_bin_flag 1 in pdf mode. The individual parcels are not kept when streaming.')
+            raise ValueError('streaming_flag 1, cache_directory, state_file, histogram_cube_flag 1 and follow mode need diameter_bin_flag 1 in pdf mode')
+
+    def write_streamed_output(self, accumulators):
+        avg_pdf = self.convert_diameter_histogram_to_particle_bin_cells(accumulators['diameter_histogram'])
+        with self.instrumentation.time_stage('write'):
+            self.write_output(1, avg_pdf)
+        self.write_histogram_cube_file(accumulators)
+
+    def create_bin_accumulators(self, time_stamp=None):
+        accumulators = {'diameter_histogram': self.create_diameter_histogram_accumulator()}
+        self.add_histogram_cube_accumulator(accumulators, time_stamp)
+        return bin_accumulators.BinAccumulatorSet(accumulators)
+
     def write_output(self, BinFlag, avg_pdf):
         logger.info("Writing Output Data")
         #Create output directory and enter the directory
@@ -454,6 +1400,42 @@ class LagrangianParticlePDFDataAnalyzer(LagrangianParticleDataAnalyzer):
         else:
             os.chdir(output_dir)
 
+        output_format = self.get_output_format()
+        if output_format in ('hdf5', 'both'):
+            self.write_pdf_result_file(BinFlag, avg_pdf)
+        if output_format in ('text', 'both'):
+            self.write_pdf_data(BinFlag, avg_pdf)
+        self.write_pdf_plots(avg_pdf)
+
+    def write_pdf_result_file(self, BinFlag, avg_pdf):
+        """
+        Write the PDF of every spatial bin into <case>_PDF_Results.h5. With diameter bins the particle counts are stored
+        as one nXBins x nYBins x nDiameterBins array, otherwise the parcels of all bins are stored back to back with
+        the offsets of each bin.
+        """
+        try:
+            case_name = self.user_input_data['case_name']
+        except KeyError:
+            logger.error('case_name missing from input file. The prefix on the lagrangian files that signify the case name that generated them.')
+            raise KeyError
+        num_x_bins = self.particle_bin_domain.num_x_bins
+        num_y_bins = self.particle_bin_domain.num_y_bins
+        cells = [avg_pdf[i][j] for i in range(num_x_bins) for j in range(num_y_bins)]
+        datasets = self.create_spatial_bin_datasets()
+        if BinFlag == 1:
+            user_defined_bins = self.compute_user_defined_bins()
+            datasets['diameter_bin_edges'] = particle_bins.compute_diameter_bin_edges(user_defined_bins)
+            datasets['diameter_bin_centers'] = np.array([0.5*(diameter_bin['d_min'] + diameter_bin['d_max']) for diameter_bin in user_defined_bins])
+            datasets['pdf'] = np.array([cell.parcels['particles_per_parcel'] for cell in cells]).reshape(num_x_bins, num_y_bins, len(user_defined_bins))
+            datasets['particle_counts'] = datasets['pdf'].sum(axis=2)
+        else:
+            datasets['bin_offsets'] = np.concatenate([[0], np.cumsum([cell.num_parcels for cell in cells])]).astype(np.int64)
+            datasets['diameters'] = np.concatenate([cell.parcels['diameter'] for cell in cells])
+            datasets['particles_per_parcel'] = np.concatenate([cell.parcels['particles_per_parcel'] for cell in cells])
+            datasets['particle_counts'] = np.array([np.sum(cell.parcels['particles_per_parcel']) for cell in cells]).reshape(num_x_bins, num_y_bins)
+        result_file.write_result_file(case_name + '_PDF_Results.h5', datasets, self.create_result_metadata('pdf'))
+
+    def write_pdf_data(self, BinFlag, avg_pdf):
         try:
             case_name = self.user_input_data['case_name']
         except KeyError:
@@ -505,12 +1487,25 @@ class LagrangianParticlePDFDataAnalyzer(LagrangianParticleDataAnalyzer):
                     f_output.write("%10.6E\t"%( 0.5*(user_defined_bins[m]['d_min'] + user_defined_bins[m]['d_max'])))
                     for j in range(0, num_y_bins):   #used to be nYBins
                         #logger.debug("\tWriting data for Transverse bin ",j+1," located at: ",PDF_Y_Coords[j])
-                        f_output.write("%10.6E\t"%(avg_pdf[i][j].parcels[m]['particles_per_parcel']))
+                        f_output.write("%10.6E\t"%(avg_pdf[i][j].parcels['particles_per_parcel'][m]))
                     f_output.write("\n")
                     f_output.write("\n")
             f_output.close()
 
-
+    def write_pdf_plots(self, avg_pdf):
+        try:
+            case_name = self.user_input_data['case_name']
+        except KeyError:
+            logger.error('case_name missing from input file. The prefix on the lagrangian files that signify the case name that generated them.')
+            raise KeyError
+        
+        try:
+            d_liq = float(self.user_input_data['d_liq'])
+        except KeyError:
+            logger.error('d_liq missing from input file. Needed to nondimensionalize data.')
+            raise KeyError
+        pdf_x_coords = self.particle_bin_domain.compute_x_bin_center_coords() 
+        pdf_y_coords = self.particle_bin_domain.compute_y_bin_center_coords()
 
         #####Plot output data##########
         #Create output directory and enter the directory
@@ -529,35 +1524,20 @@ class LagrangianParticlePDFDataAnalyzer(LagrangianParticleDataAnalyzer):
         #Plot data about radial distribution of particles at each X coordinate
         num_x_bins = self.particle_bin_domain.num_x_bins
         num_y_bins = self.particle_bin_domain.num_y_bins
+        plot_jobs = []
         for i in range(0, num_x_bins):
             for j in range(0, num_y_bins):
                 #Find the maximum value of the variable about to be plotted so that the 
                 #plot vertical axis can be scaled appropriately
-                MaxVal = 0
-                MinVal = 0
-                for k, parcel in enumerate(avg_pdf[i][j].parcels):
-                    if k == 0:
-                        MaxVal = parcel['particles_per_parcel']
-                        MinVal = parcel['particles_per_parcel']
-                    elif parcel['particles_per_parcel'] > MaxVal:
-                        MaxVal = parcel['particles_per_parcel']
-                    elif parcel['particles_per_parcel'] < MinVal:
-                        MinVal = parcel['particles_per_parcel']
+                yValues = avg_pdf[i][j].parcels['particles_per_parcel']
+                MaxVal = np.amax(yValues) if avg_pdf[i][j].num_parcels > 0 else 0
+                MinVal = np.amin(yValues) if avg_pdf[i][j].num_parcels > 0 else 0
                         
                 #Change the min and max values a little bit so that all data lies within the bounds of the plots
                 MaxVal = MaxVal + 0.05*abs(MaxVal)
                 MinVal = MinVal - 0.05*abs(MinVal)
 
-                xValues = np.asarray([parcel['diameter'] for parcel in avg_pdf[i][j].parcels])
-                for m in range(0, avg_pdf[i][j].num_parcels):
-                    xValues[m] = xValues[m] * DiameterFactor
-                
-                yValues = np.asarray([parcel['particles_per_parcel'] for parcel in avg_pdf[i][j].parcels])
-
-                plt.plot(xValues,yValues, marker='o', linestyle='None')
-                plt.xlabel('Parcel Diameter, D micrometer')
-                plt.ylabel('Parcel Count, N')
-                plt.ylim([MinVal, MaxVal])
+                xValues = avg_pdf[i][j].parcels['diameter'] * DiameterFactor
 
                 try:
                     radial_bin_flag = int(self.user_input_data['radial_bin_flag'])
@@ -571,9 +1551,10 @@ class LagrangianParticlePDFDataAnalyzer(LagrangianParticleDataAnalyzer):
                     dimension_name = 'Y'
 
                 outputFileName = case_name + '_PDF_' + '%s%4.2f%s'%('XoverD', pdf_x_coords[i] / d_liq,'_') + '%soverD%4.2f'%(dimension_name, pdf_y_coords[j] / d_liq) + ".png"
-                logger.info("Saving a figure to:%s"%(outputFileName))
-                plt.savefig(outputFileName, bbox_inches='tight')
-                plt.close()
+                plot_jobs.append(plot_renderer.LinePlotJob(os.path.join(output_dir, outputFileName), xValues, yValues,
+                                                           'Parcel Diameter, D micrometer', 'Parcel Count, N',
+                                                           [MinVal, MaxVal], marker='o', linestyle='None'))
+        self.create_plot_renderer().render(plot_jobs)
 
 
         #Go back to the original data directory
@@ -583,3 +1564,249 @@ class LagrangianParticlePDFDataAnalyzer(LagrangianParticleDataAnalyzer):
 
 
 
+
+
+class LagrangianParticleJointPDFDataAnalyzer(LagrangianParticleDataAnalyzer):
+    """
+    Time-averaged joint PDFs of the parcel diameter and temperature, and of the diameter and the radial position
+    of the parcels inside of their spatial bin, with the mean temperature of every diameter class. The time steps
+    are always streamed into joint histograms, one np.histogramdd pass per joint PDF and time step.
+    """
+    particle_file_prefixes = ['ptdia_ptsca', 'particle_pos', 'ptnump_ptsca', 'pttemp_ptsca']
+    include_temperature = True
+
+    def __init__(self, input_parser, num_workers=1):
+        super(LagrangianParticleJointPDFDataAnalyzer, self).__init__(input_parser, num_workers)
+        self.particle_bin_domain = None
+
+    def process_data(self):
+        self.particle_bin_domain = self.create_particle_bin_domain()
+        try:
+            d_liq = float(self.user_input_data['d_liq'])
+        except KeyError:
+            logger.error('d_liq missing from input file. Needed to nondimensionalize data.')
+            raise KeyError
+
+        self.particle_bin_domain.print_x_bin_coords(d_liq)
+        self.particle_bin_domain.print_y_bin_coords(d_liq)
+
+        self.check_streaming_settings()
+        accumulators = self.accumulate_snapshots()
+        if self.is_root_rank():
+            self.write_streamed_output(accumulators)
+        logger.info("\n Program has finished... \n")
+
+    def check_streaming_settings(self):
+        if 'cache_directory' in self.user_input_data:
+            logger.error('cache_directory can not be used in joint mode. The cached summaries do not hold the parcel temperatures.')
+            raise ValueError('cache_directory can not be used in joint mode')
+
+    def compute_temperature_bin_edges(self):
+        try:
+            t_min = float(self.user_input_data['t_min'])
+        except KeyError:
+            logger.error('t_min missing from input file. Minimum temperature for binning parcels.')
+            raise KeyError
+        try:
+            t_max = float(self.user_input_data['t_max'])
+        except KeyError:
+            logger.error('t_max missing from input file. Maximum temperature for binning parcels.')
+            raise KeyError
+        try:
+            num_temperature_bins = int(self.user_input_data['num_temperature_bins'])
+        except KeyError:
+            num_temperature_bins = 50
+        return np.linspace(t_min, t_max, num_temperature_bins + 1)
+
+    def compute_radial_position_bin_edges(self):
+        """Edges of the bins of the position inside of a spatial bin, from 0 at its lower y (or R) edge to 1 at its upper one."""
+        try:
+            num_radial_position_bins = int(self.user_input_data['num_radial_position_bins'])
+        except KeyError:
+            num_radial_position_bins = 10
+        return np.linspace(0.0, 1.0, num_radial_position_bins + 1)
+
+    def create_bin_accumulators(self, time_stamp=None):
+        num_x_bins = self.particle_bin_domain.num_x_bins
+        num_y_bins = self.particle_bin_domain.num_y_bins
+        diameter_bin_edges = particle_bins.compute_diameter_bin_edges(self.compute_user_defined_bins())
+        accumulators = {'diameter_temperature': bin_accumulators.JointHistogramAccumulator(num_x_bins, num_y_bins, diameter_bin_edges,
+                                                                                            self.compute_temperature_bin_edges()),
+                        'diameter_radial_position': bin_accumulators.JointHistogramAccumulator(num_x_bins, num_y_bins, diameter_bin_edges,
+                                                                                                self.compute_radial_position_bin_edges())}
+        self.add_histogram_cube_accumulator(accumulators, time_stamp)
+        return bin_accumulators.BinAccumulatorSet(accumulators)
+
+    def add_parcels_to_accumulators(self, particle_data, parcel_y, accumulators):
+        bin_indices = self.particle_bin_domain.compute_flat_bin_indices(particle_data['x'], parcel_y)
+        inside = bin_indices >= 0
+        logger.debug("Number of parcels inside of the binning domain:\t%d"%(np.count_nonzero(inside)))
+        bin_indices = bin_indices[inside]
+        diameters = particle_data['diameter'][inside]
+        particles_per_parcel = particle_data['particles_per_parcel'][inside]
+
+        #Position of every parcel inside of its y (or R) bin, which is 0 at the lower edge and 1 at the upper edge
+        y_bin_edges = self.particle_bin_domain.compute_y_bin_edges()
+        y_indices = bin_indices % self.particle_bin_domain.num_y_bins
+        radial_positions = (parcel_y[inside] - y_bin_edges[y_indices]) / (y_bin_edges[y_indices + 1] - y_bin_edges[y_indices])
+
+        joint_variables = {'diameter_temperature': particle_data['temperature'][inside],
+                           'diameter_radial_position': radial_positions}
+        for name, accumulator in accumulators.accumulators.items():
+            if name in joint_variables:
+                accumulator.add_parcels(bin_indices, diameters, particles_per_parcel, joint_variables[name])
+            else:
+                accumulator.add_parcels(bin_indices, diameters, particles_per_parcel)
+
+    def write_streamed_output(self, accumulators):
+        with self.instrumentation.time_stage('write'):
+            self.write_output(accumulators)
+        self.write_histogram_cube_file(accumulators)
+
+    def write_output(self, accumulators):
+        logger.info("Writing Output Data")
+        #Create output directory and enter the directory
+        file_base_path = os.getcwd()
+        output_dir = file_base_path + '/particle_joint_pdf_data'
+        if not os.path.exists(output_dir):
+            os.makedirs(output_dir)
+        os.chdir(output_dir)
+
+        output_format = self.get_output_format()
+        if output_format in ('hdf5', 'both'):
+            self.write_joint_pdf_result_file(accumulators)
+        if output_format in ('text', 'both'):
+            self.write_mean_temperature_data(accumulators['diameter_temperature'])
+        self.write_mean_temperature_plots(accumulators['diameter_temperature'])
+
+        #Go back to the original data directory
+        os.chdir(file_base_path)
+
+    def write_joint_pdf_result_file(self, accumulators):
+        """
+        Write the joint PDFs (nXBins x nYBins x nDiameterBins x nValueBins), the weighted counts they were computed
+        from and the conditional means and standard deviations per diameter class into <case>_JointPDF_Results.h5.
+        """
+        try:
+            case_name = self.user_input_data['case_name']
+        except KeyError:
+            logger.error('case_name missing from input file. The prefix on the lagrangian files that signify the case name that generated them.')
+            raise KeyError
+        datasets = self.create_spatial_bin_datasets()
+        datasets['diameter_bin_edges'] = accumulators['diameter_temperature'].diameter_bin_edges
+        for name, variable_name in [('diameter_temperature', 'temperature'), ('diameter_radial_position', 'radial_position')]:
+            joint_histogram = accumulators[name]
+            datasets[variable_name + '_bin_edges'] = joint_histogram.value_bin_edges
+            datasets[name + '_counts'] = joint_histogram.counts
+            datasets[name + '_pdf'] = joint_histogram.compute_joint_pdfs()
+            datasets[name + '_out_of_range_counts'] = joint_histogram.out_of_range_counts
+            datasets['mean_' + variable_name + '_per_diameter'] = joint_histogram.compute_conditional_means()
+            datasets['std_' + variable_name + '_per_diameter'] = joint_histogram.compute_conditional_standard_deviations()
+        datasets['particle_counts_per_diameter'] = accumulators['diameter_temperature'].value_weights
+        result_file.write_result_file(case_name + '_JointPDF_Results.h5', datasets, self.create_result_metadata('joint'))
+
+    def write_mean_temperature_data(self, diameter_temperature):
+        """Write the mean temperature of every diameter class, one file per X station with a column per Y (or R) bin."""
+        try:
+            case_name = self.user_input_data['case_name']
+        except KeyError:
+            logger.error('case_name missing from input file. The prefix on the lagrangian files that signify the case name that generated them.')
+            raise KeyError
+        try:
+            d_liq = float(self.user_input_data['d_liq'])
+        except KeyError:
+            logger.error('d_liq missing from input file. Needed to nondimensionalize data.')
+            raise KeyError
+        pdf_x_coords = self.particle_bin_domain.compute_x_bin_center_coords()
+        pdf_y_coords = self.particle_bin_domain.compute_y_bin_center_coords()
+        dimension_name = 'R' if self.get_radial_bin_flag() == 1 else 'Y'
+        diameter_centers = 0.5*(diameter_temperature.diameter_bin_edges[:-1] + diameter_temperature.diameter_bin_edges[1:])
+        mean_temperatures = diameter_temperature.compute_conditional_means()
+        for i in range(0, len(pdf_x_coords)):
+            output_file_name = case_name + "_MeanTemperature_" + '%s_%4.2f_Data'%('XOverD', pdf_x_coords[i] / d_liq) + ".txt"
+            f_output = open(output_file_name, "w")
+            f_output.write("%s\t%s %10.6E\n"%("X Coordinate", "X/D = ", pdf_x_coords[i] / d_liq))
+            f_output.write("Diameter(m)\t%s\n"%("\t".join("T(K) at %s/D=%10.6E"%(dimension_name, y / d_liq) for y in pdf_y_coords)))
+            for m in range(0, len(diameter_centers)):
+                f_output.write("%10.6E\t%s\n"%(diameter_centers[m], "\t".join("%10.6E"%(value) for value in mean_temperatures[i, :, m])))
+            f_output.close()
+
+    def write_mean_temperature_plots(self, diameter_temperature):
+        try:
+            case_name = self.user_input_data['case_name']
+        except KeyError:
+            logger.error('case_name missing from input file. The prefix on the lagrangian files that signify the case name that generated them.')
+            raise KeyError
+        try:
+            d_liq = float(self.user_input_data['d_liq'])
+        except KeyError:
+            logger.error('d_liq missing from input file. Needed to nondimensionalize data.')
+            raise KeyError
+        pdf_x_coords = self.particle_bin_domain.compute_x_bin_center_coords()
+        pdf_y_coords = self.particle_bin_domain.compute_y_bin_center_coords()
+        output_dir = os.path.join(os.getcwd(), 'JointPDFPlots')
+        if not os.path.exists(output_dir):
+            os.makedirs(output_dir)
+
+        DiameterFactor = 1e6 #For expressing diameters in micrometers
+        dimension_name = 'R' if self.get_radial_bin_flag() == 1 else 'Y'
+        diameter_centers = 0.5*(diameter_temperature.diameter_bin_edges[:-1] + diameter_temperature.diameter_bin_edges[1:])
+        mean_temperatures = diameter_temperature.compute_conditional_means()
+        plot_jobs = []
+        for i in range(0, len(pdf_x_coords)):
+            for j in range(0, len(pdf_y_coords)):
+                #Only the diameter classes that hold particles are plotted
+                occupied = diameter_temperature.value_weights[i, j] > 0
+                if not np.any(occupied):
+                    continue
+                output_file_name = case_name + '_MeanTemperature_' + '%s%4.2f%s'%('XoverD', pdf_x_coords[i] / d_liq, '_') + '%soverD%4.2f'%(dimension_name, pdf_y_coords[j] / d_liq) + ".png"
+                plot_jobs.append(plot_renderer.LinePlotJob(os.path.join(output_dir, output_file_name), diameter_centers[occupied] * DiameterFactor,
+                                                           mean_temperatures[i, j][occupied], 'Diameter(micrometers)', 'Mean Temperature(K)'))
+        self.create_plot_renderer().render(plot_jobs)
+
+
+class LagrangianParticleDataIngester(LagrangianParticleDataAnalyzer):
+    """
+    Packs the Loci-Stream files of a time series into a single parcel store, so that later analyses open one file
+    and read only the columns and time steps they need. Time steps that are already in the store are skipped, so
+    running the ingester again after the simulation has written more files only appends the new time steps.
+    """
+    def __init__(self, input_parser, num_workers=1):
+        super(LagrangianParticleDataIngester, self).__init__(input_parser, num_workers)
+
+    def get_file_indices(self):
+        """The time steps of the lagrangian files on disk, which are the ones to pack into the parcel store."""
+        return self.discover_file_time_steps()
+
+    def process_data(self):
+        parcel_store_file_name = self.get_parcel_store_file_name()
+        if parcel_store_file_name is None:
+            logger.error('parcel_store missing from input file. The name of the HDF5 file that the time steps are packed into.')
+            raise KeyError('parcel_store')
+
+        store = parcel_store.ParcelStore(parcel_store_file_name)
+        stored_time_steps = set(store.get_time_steps()) if os.path.exists(parcel_store_file_name) else set()
+        file_indices = self.get_file_indices()
+        logger.info('Ingesting timesteps into the parcel store %s:'%(parcel_store_file_name))
+        logger.info(file_indices)
+        for time_stamp in file_indices:
+            if int(time_stamp) in stored_time_steps:
+                logger.info("Time step %s is already in the parcel store. Skipping it."%(str(time_stamp)))
+                continue
+            with self.instrumentation.time_stage('read', time_stamp) as counts:
+                particle_data = self.read_time_step_for_ingest(time_stamp)
+                counts['parcels'] = len(particle_data)
+                counts['bytes_read'] = particle_data.nbytes()
+            with self.instrumentation.time_stage('write', time_stamp) as counts:
+                store.append_time_step(time_stamp, particle_data)
+                counts['parcels'] = len(particle_data)
+            logger.info("Appended time step %s to the parcel store"%(str(time_stamp)))
+
+    def read_time_step_for_ingest(self, time_stamp):
+        """All parcel columns of one time step, with the temperature column when the time step has a temperature file."""
+        #The store keeps the full precision of the files, whatever parcel_precision the analyses use
+        data_reader = self.create_loci_stream_reader(time_stamp, dtype=np.float64)
+        particle_data = data_reader.read_hdf_particle_data()
+        if os.path.exists('pttemp_ptsca.' + str(time_stamp) + '_' + data_reader.case_name):
+            particle_data['temperature'] = data_reader.read_particle_temperature_data()
+        return particle_data
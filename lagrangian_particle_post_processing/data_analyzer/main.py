@@ -1,20 +1,37 @@
-import sys
+import argparse
 import logging
 
 import input_parser as ip
 import lagrangian_analyzer as analyzers
+import mpi_distribution
 
 logger = logging.getLogger(__name__)
 
 class Main(object):
-    def __init__(self, input_file_name):
+    def __init__(self, input_file_name, num_workers=1, follow=False, use_mpi=False):
         self.input_file_name = input_file_name
+        self.num_workers = num_workers
+        self.follow = follow
+        self.communicator = mpi_distribution.get_world_communicator() if use_mpi else None
+        self.input_parser = ip.InputFileParser(self.input_file_name)
         self.setup_logger()
     
+    def get_logging_level(self):
+        """The user's log_level (debug, info, warning or error). Defaults to info, since debug output slows down large runs."""
+        log_level = self.input_parser.user_input_data.get('log_level', 'info')
+        desired_logging_level = getattr(logging, log_level.upper(), None)
+        if not isinstance(desired_logging_level, int):
+            raise ValueError('log_level must be debug, info, warning or error, not: %s'%(log_level))
+        return desired_logging_level
+
     def setup_logger(self):
-        desired_logging_level = logging.DEBUG
+        desired_logging_level = self.get_logging_level()
 
-        logging.basicConfig(format='%(asctime)s %(name)-12s %(levelname)-8s: %(message)s', datefmt='%m/%d/%Y %H:%M %p', filename='out.log', filemode='w', level=desired_logging_level)
+        #Every MPI rank other than the root writes its own log file
+        log_file_name = 'out.log'
+        if self.communicator is not None and self.communicator.Get_rank() != mpi_distribution.root_rank:
+            log_file_name = 'out.rank%d.log'%(self.communicator.Get_rank())
+        logging.basicConfig(format='%(asctime)s %(name)-12s %(levelname)-8s: %(message)s', datefmt='%m/%d/%Y %H:%M %p', filename=log_file_name, filemode='w', level=desired_logging_level)
 
         #For console output from logging
         console = logging.StreamHandler()
@@ -24,22 +41,47 @@ class Main(object):
         logging.getLogger('').addHandler(console)
 
     def run(self):
-        input_parser = ip.InputFileParser(self.input_file_name)
+        input_parser = self.input_parser
         
         lagrangian_analyzer = None
         if input_parser.user_input_data['mode'].lower() == 'pdf':
             logger.debug('PDF Analyzer selected')
-            lagrangian_analyzer = analyzers.LagrangianParticlePDFDataAnalyzer(input_parser)
+            lagrangian_analyzer = analyzers.LagrangianParticlePDFDataAnalyzer(input_parser, self.num_workers)
         elif input_parser.user_input_data['mode'].lower() == 'smd':
             logger.debug('SMD Analyzer selected')
-            lagrangian_analyzer = analyzers.LagrangianParticleSMDDataAnalyzer(input_parser)
+            lagrangian_analyzer = analyzers.LagrangianParticleSMDDataAnalyzer(input_parser, self.num_workers)
+        elif input_parser.user_input_data['mode'].lower() == 'joint':
+            logger.debug('Joint PDF Analyzer selected')
+            lagrangian_analyzer = analyzers.LagrangianParticleJointPDFDataAnalyzer(input_parser, self.num_workers)
+        elif input_parser.user_input_data['mode'].lower() == 'ingest':
+            logger.debug('Parcel store ingester selected')
+            lagrangian_analyzer = analyzers.LagrangianParticleDataIngester(input_parser, self.num_workers)
         else:
-            raise KeyError('mode setting needs to be pdf or smd')
+            raise KeyError('mode setting needs to be pdf, smd, joint or ingest')
+
+        if self.communicator is not None:
+            if isinstance(lagrangian_analyzer, analyzers.LagrangianParticleDataIngester) or self.follow:
+                raise ValueError('--mpi needs the pdf, smd or joint mode and can not be combined with --follow')
+            logger.info('Splitting the time steps over %d MPI ranks'%(self.communicator.Get_size()))
+            lagrangian_analyzer.communicator = self.communicator
 
-        lagrangian_analyzer.process_data()
+        if self.follow:
+            if isinstance(lagrangian_analyzer, analyzers.LagrangianParticleDataIngester):
+                raise ValueError('--follow needs the pdf, smd or joint mode')
+            lagrangian_analyzer.follow_data()
+        else:
+            lagrangian_analyzer.process_data()
+        lagrangian_analyzer.write_instrumentation_report()
 
 if __name__ == "__main__":
-    program = Main(sys.argv[1])
+    parser = argparse.ArgumentParser(description='Time-averaged droplet statistics from Loci-Stream lagrangian particle data')
+    parser.add_argument('input_file', help='input file with the analyzer settings')
+    parser.add_argument('--workers', type=int, default=1, help='number of processes used to read and bin time steps')
+    parser.add_argument('--follow', action='store_true', help='keep running and update the results as the simulation writes new time steps')
+    parser.add_argument('--mpi', action='store_true', help='split the time steps over the ranks of an MPI job (needs mpi4py), e.g. mpiexec -n 4 python -m mpi4py main.py input_file --mpi')
+    args = parser.parse_args()
+
+    program = Main(args.input_file, args.workers, args.follow, args.mpi)
     program.run()
 
             
@@ -0,0 +1,42 @@
+import logging
+
+try:
+    from mpi4py import MPI
+except ImportError:
+    MPI = None
+
+logger = logging.getLogger(__name__)
+
+#Rank that finds the time steps, owns the state file and writes the results
+root_rank = 0
+
+
+def get_world_communicator():
+    """The communicator of all ranks started by mpiexec/mpirun. Needs the mpi4py package."""
+    if MPI is None:
+        logger.error('--mpi needs the mpi4py package and an MPI library, e.g. pip install mpi4py')
+        raise ImportError('mpi4py is not installed')
+    return MPI.COMM_WORLD
+
+
+def split_time_steps(time_steps, rank, num_ranks):
+    """
+    The time steps processed by one rank. They are dealt out in turn, so every rank gets early and late time steps
+    (which hold more parcels as the spray develops) alike.
+    """
+    return list(time_steps)[rank::num_ranks]
+
+
+def merge_accumulator_sets(accumulators, other_accumulators):
+    accumulators.merge(other_accumulators)
+    return accumulators
+
+
+def reduce_accumulators(communicator, accumulators):
+    """
+    Merge the accumulators of all ranks into the ones of the root rank, which are returned there (None on the other
+    ranks). The merges run as a tree reduction, so no rank receives more than log2(ranks) accumulator sets. The
+    accumulators are merged with their own merge method, since not every statistic is reduced by a sum (the
+    histogram cube is concatenated and the diameter extremes are reduced by min and max).
+    """
+    return communicator.reduce(accumulators, op=merge_accumulator_sets, root=root_rank)
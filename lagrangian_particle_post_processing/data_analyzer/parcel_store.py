@@ -0,0 +1,178 @@
+import h5py
+import logging
+import numpy as np
+import uuid
+
+import utilities
+from parcel_table import ParcelTable
+
+logger = logging.getLogger(__name__)
+
+
+class ParcelStore(object):
+    """
+    A whole time series of parcel data packed into one HDF5 file.
+
+    Every parcel column (diameter, x, y, z, particles_per_parcel and optionally temperature) is one chunked and
+    compressed dataset in the 'columns' group that holds the parcels of all time steps back to back. The 'index'
+    group maps each time step to its rows: the parcels of time_steps[n] are rows offsets[n]:offsets[n+1] of every
+    column. New time steps are appended at the end, so the data of the time steps already in the store is never
+    rewritten, and a reader only touches the columns and rows of the time steps it asks for. The store_id attribute
+    identifies the store, so the rows of a time step can be recognised after other time steps were appended.
+    """
+    chunk_rows = 65536
+
+    def __init__(self, file_name):
+        self.file_name = file_name
+
+    def open(self, mode='r'):
+        return h5py.File(self.file_name, mode)
+
+    def get_time_steps(self):
+        with self.open() as f:
+            if 'index' not in f:
+                return []
+            return [int(time_step) for time_step in f['index/time_steps'][()]]
+
+    def get_column_names(self):
+        with self.open() as f:
+            if 'columns' not in f:
+                return []
+            return list(f['columns'].keys())
+
+    def create_layout(self, f, column_names):
+        f.attrs['store_id'] = uuid.uuid4().hex
+        index = f.create_group('index')
+        index.create_dataset('time_steps', shape=(0,), maxshape=(None,), dtype=np.int64, chunks=(1024,))
+        index.create_dataset('offsets', data=np.zeros(1, dtype=np.int64), maxshape=(None,), chunks=(1024,))
+        columns = f.create_group('columns')
+        for name in column_names:
+            columns.create_dataset(name, shape=(0,), maxshape=(None,), dtype=np.float64, chunks=(self.chunk_rows,),
+                                   compression='gzip', compression_opts=4, shuffle=True)
+
+    def append_time_step(self, time_step, particle_data):
+        """Append the parcels of one time step (a ParcelTable) at the end of the store."""
+        with self.open('a') as f:
+            if 'index' not in f:
+                self.create_layout(f, particle_data.column_names())
+
+            column_names = list(f['columns'].keys())
+            if set(column_names) != set(particle_data.column_names()):
+                logger.error('Time step %s has the columns %s, but the parcel store holds the columns %s'%(str(time_step), particle_data.column_names(), column_names))
+                raise ValueError('Time step %s does not have the columns of the parcel store'%(str(time_step)))
+
+            time_steps = f['index/time_steps']
+            offsets = f['index/offsets']
+            if int(time_step) in time_steps[()]:
+                raise ValueError('Time step %s is already in the parcel store'%(str(time_step)))
+
+            start = int(offsets[-1])
+            stop = start + len(particle_data)
+            for name in column_names:
+                dataset = f['columns'][name]
+                dataset.resize((stop,))
+                dataset[start:stop] = particle_data[name]
+
+            #Extend the index last, so that an interrupted append leaves the time steps already in the store intact
+            time_steps.resize((len(time_steps) + 1,))
+            time_steps[-1] = int(time_step)
+            offsets.resize((len(offsets) + 1,))
+            offsets[-1] = stop
+
+    def get_row_range(self, f, time_step):
+        time_steps = f['index/time_steps'][()]
+        matches = np.flatnonzero(time_steps == int(time_step))
+        if len(matches) == 0:
+            logger.error('Time step %s is not in the parcel store %s. Run the analyzer in ingest mode to add it.'%(str(time_step), self.file_name))
+            raise KeyError(time_step)
+        n = matches[-1]
+        offsets = f['index/offsets']
+        return int(offsets[n]), int(offsets[n + 1])
+
+    def get_time_step_signature(self, time_step):
+        """
+        Identifies the parcels of one time step. Appending other time steps leaves it unchanged, while re-creating
+        the store gives it a new store_id.
+        """
+        with self.open() as f:
+            start, stop = self.get_row_range(f, time_step)
+            store_id = f.attrs.get('store_id')
+        if store_id is None:
+            #Stores written before the store_id was added are identified by the file itself
+            store_id = utilities.get_file_signature([self.file_name])
+        elif isinstance(store_id, bytes):
+            store_id = store_id.decode('utf-8')
+        return [store_id, int(time_step), start, stop]
+
+    def read_time_step(self, time_step, column_names=None, dtype=np.float64):
+        """Read the selected columns (default all) of one time step into a ParcelTable."""
+        with self.open() as f:
+            start, stop = self.get_row_range(f, time_step)
+            if column_names is None:
+                column_names = list(f['columns'].keys())
+            return ParcelTable(dict((name, f['columns'][name][start:stop]) for name in column_names), dtype)
+
+
+class ParcelStoreReader(object):
+    """
+    Reads the parcels of one time step from a ParcelStore. It offers the read_hdf_particle_data interface of
+    HDF5ParticlePDFPlotterDataReader, so the analyzers can use a parcel store in place of the Loci-Stream files.
+    """
+    def __init__(self, store_file_name, time_stamp, dtype=np.float64, include_temperature=False):
+        self.parcel_store = ParcelStore(store_file_name)
+        self.include_temperature = include_temperature
+        self.column_names = ['diameter', 'x', 'y', 'z', 'particles_per_parcel'] + (['temperature'] if include_temperature else [])
+        self.time_stamp = time_stamp
+        self.dtype = np.dtype(dtype)
+        self.num_parcels = 0
+        self.bytes_read = 0 #Bytes of particle data read from the store so far
+
+    def read_rows(self, dataset, start, stop):
+        data = dataset[start:stop]
+        self.bytes_read += data.nbytes
+        return data
+
+    def read_hdf_particle_data(self, parcel_filter=None, chunk_size=None):
+        """
+        Read the parcels of the time step.
+
+        Args:
+            parcel_filter: optional callable taking x, y, z arrays and returning a boolean mask of the parcels to keep.
+            chunk_size: optional number of rows to read at a time. The diameter and particles per parcel of a chunk
+                        are only read if the chunk holds parcels that pass the filter.
+        """
+        chunks = list(self.iterate_particle_data_chunks(parcel_filter, chunk_size))
+        if not chunks:
+            chunks.append(ParcelTable(dict((name, []) for name in self.column_names), self.dtype))
+        particle_data = ParcelTable.concatenate(chunks)
+        logger.info("Detected %d parcels of time step %s in the parcel store, %d of which passed the parcel filter"%(self.num_parcels, str(self.time_stamp), len(particle_data)))
+        return particle_data
+
+    def iterate_particle_data_chunks(self, parcel_filter=None, chunk_size=None):
+        """Yield the parcels of the time step that pass the filter as one ParcelTable per chunk_size rows of the store."""
+        with self.parcel_store.open() as f:
+            start, stop = self.parcel_store.get_row_range(f, self.time_stamp)
+            columns = f['columns']
+            if self.include_temperature and 'temperature' not in columns:
+                logger.error('The parcel store %s has no temperature column. Ingest time steps that have pttemp_ptsca files.'%(self.parcel_store.file_name))
+                raise KeyError('temperature')
+            self.num_parcels = stop - start
+            if chunk_size is None or chunk_size <= 0:
+                chunk_size = max(self.num_parcels, 1)
+
+            for chunk_start in range(start, stop, chunk_size):
+                chunk_stop = min(chunk_start + chunk_size, stop)
+                x = np.asarray(self.read_rows(columns['x'], chunk_start, chunk_stop), dtype=self.dtype)
+                y = np.asarray(self.read_rows(columns['y'], chunk_start, chunk_stop), dtype=self.dtype)
+                z = np.asarray(self.read_rows(columns['z'], chunk_start, chunk_stop), dtype=self.dtype)
+                keep = np.ones(len(x), dtype=bool) if parcel_filter is None else parcel_filter(x, y, z)
+                if not np.any(keep):
+                    continue #Nothing of interest in this chunk, so skip reading the rest of its data
+                chunk = ParcelTable({'diameter': self.read_rows(columns['diameter'], chunk_start, chunk_stop)[keep],
+                                     'x': x[keep],
+                                     'y': y[keep],
+                                     'z': z[keep],
+                                     'particles_per_parcel': self.read_rows(columns['particles_per_parcel'], chunk_start, chunk_stop)[keep]}, self.dtype)
+                if self.include_temperature:
+                    chunk['temperature'] = self.read_rows(columns['temperature'], chunk_start, chunk_stop)[keep]
+                yield chunk
@@ -0,0 +1,81 @@
+import logging
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+def get_parcel_dtype(precision):
+    """Convert the user's parcel_precision setting (float64 or float32) into a NumPy dtype."""
+    if str(precision).lower() in ('float64', 'double', '64'):
+        return np.dtype(np.float64)
+    if str(precision).lower() in ('float32', 'single', '32'):
+        return np.dtype(np.float32)
+    raise ValueError('parcel_precision must be float64 or float32, not: %s'%(precision))
+
+
+class ParcelTable(object):
+    """A columnar (structure-of-arrays) container of parcel data.
+
+    Every column is a 1D NumPy array of the table dtype and all columns have the same length, so the ith parcel
+    is made of the ith entry of every column. Columns that already have the table dtype are stored without a copy,
+    which lets a table hold views of the arrays returned by the readers. Columns are accessed by the same keys that
+    were used for the per-parcel dictionaries, e.g. table['diameter'] or table['particles_per_parcel'].
+    """
+    def __init__(self, columns=None, dtype=np.float64):
+        self.dtype = np.dtype(dtype)
+        self.columns = {}
+        if columns is not None:
+            for name, values in columns.items():
+                self[name] = values
+
+    def __len__(self):
+        if not self.columns:
+            return 0
+        return len(next(iter(self.columns.values())))
+
+    def __contains__(self, name):
+        return name in self.columns
+
+    def __getitem__(self, name):
+        return self.columns[name]
+
+    def __setitem__(self, name, values):
+        values = np.asarray(values, dtype=self.dtype)
+        if values.ndim != 1:
+            raise ValueError('Column %s must be one dimensional'%(name))
+        if self.columns and name not in self.columns and len(values) != len(self):
+            raise ValueError('Column %s has %d entries but the table has %d parcels'%(name, len(values), len(self)))
+        self.columns[name] = values
+
+    def column_names(self):
+        return list(self.columns.keys())
+
+    def nbytes(self):
+        return sum(values.nbytes for values in self.columns.values())
+
+    def take(self, indices, column_names=None):
+        """Return a new table holding the selected parcels (and optionally only the selected columns)."""
+        if column_names is None:
+            column_names = self.column_names()
+        return ParcelTable(dict((name, self.columns[name][indices]) for name in column_names), self.dtype)
+
+    def argsort(self, name):
+        """Stable sort order of the parcels by the given column."""
+        return np.argsort(self.columns[name], kind='stable')
+
+    def sort_by(self, name):
+        """Sort all columns in place by the given column, keeping the relative order of equal entries."""
+        order = self.argsort(name)
+        for column_name in self.columns:
+            self.columns[column_name] = self.columns[column_name][order]
+
+    @staticmethod
+    def concatenate(tables, dtype=None):
+        """Concatenate tables that share the same columns into a new table."""
+        tables = [table for table in tables if table.columns]
+        if dtype is None:
+            dtype = tables[0].dtype if tables else np.float64
+        if not tables:
+            return ParcelTable(dtype=dtype)
+        column_names = tables[0].column_names()
+        return ParcelTable(dict((name, np.concatenate([table[name] for table in tables])) for name in column_names), dtype)
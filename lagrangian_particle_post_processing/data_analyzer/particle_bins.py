@@ -3,9 +3,41 @@ import time
 from operator import itemgetter
 import numpy as np
 
+from parcel_table import ParcelTable
+
 logger = logging.getLogger(__name__)
 
 
+def compute_diameter_bin_edges(custom_diameter_bins):
+    """Convert a list of contiguous {'d_min', 'd_max'} diameter bins into an array of bin edges."""
+    return np.array([dia_bin['d_min'] for dia_bin in custom_diameter_bins] + [custom_diameter_bins[-1]['d_max']], dtype=np.float64)
+
+
+def compute_diameter_bin_indices(diameters, diameter_bin_edges):
+    """
+    Index of the diameter bin edge[m] <= d < edge[m+1] of every diameter. Diameters outside of the bins are given
+    an index of -1.
+    """
+    diameter_indices = np.searchsorted(diameter_bin_edges, diameters, side='right') - 1
+    diameter_indices[diameter_indices >= len(diameter_bin_edges) - 1] = -1
+    return diameter_indices
+
+
+def compute_weighted_diameter_histogram(diameters, particles_per_parcel, diameter_bin_edges):
+    """
+    Sum the particles per parcel that fall into each diameter bin.
+
+    Returns:
+        Tuple (counts, out_of_range) with the particle count of every diameter bin and a boolean mask of the parcels
+        that are outside of the bins.
+    """
+    diameter_indices = compute_diameter_bin_indices(diameters, diameter_bin_edges)
+    out_of_range = diameter_indices < 0
+    counts = np.bincount(diameter_indices[~out_of_range], weights=np.asarray(particles_per_parcel, dtype=np.float64)[~out_of_range],
+                         minlength=len(diameter_bin_edges) - 1)
+    return counts, out_of_range
+
+
 class ParticleBinDomain:
     """A class to represent the spatial domain over which parcel data is collected."""
     def __init__(self, x_max=1, x_min=0, y_max=1, y_min=0, num_x_bins=1, num_y_bins=1):
@@ -92,42 +124,123 @@ class ParticleBinDomain:
             center_y_coords[j] =  0.5*( y_bin_coords[1][j] + y_bin_coords[0][j] )  #Between edges of a bin
         return center_y_coords
 
+    def compute_x_bin_edges(self):
+        """Return the num_x_bins + 1 monotonic edges of the x bins."""
+        x_bin_coords = self.compute_x_bin_coords()
+        return np.append(x_bin_coords[0], x_bin_coords[1][-1])
+
+    def compute_y_bin_edges(self):
+        """Return the num_y_bins + 1 monotonic edges of the y bins."""
+        y_bin_coords = self.compute_y_bin_coords()
+        return np.append(y_bin_coords[0], y_bin_coords[1][-1])
+
+    def compute_bin_indices(self, x, y):
+        """
+        Locate the spatial bin of every parcel in a single pass.
+
+        A parcel belongs to bin i when edge[i] <= coordinate < edge[i+1], which is the same membership
+        test used by the original per-bin loops.
+
+        Args:
+            x: array of parcel x coordinates
+            y: array of parcel y (or radial) coordinates
+
+        Returns:
+            Tuple of integer arrays (x_indices, y_indices). Parcels outside of the domain are given an index of -1.
+        """
+        x_indices = np.searchsorted(self.compute_x_bin_edges(), x, side='right') - 1
+        y_indices = np.searchsorted(self.compute_y_bin_edges(), y, side='right') - 1
+        outside = (x_indices < 0) | (x_indices >= self.num_x_bins) | (y_indices < 0) | (y_indices >= self.num_y_bins)
+        x_indices[outside] = -1
+        y_indices[outside] = -1
+        return x_indices, y_indices
+
+    def compute_flat_bin_indices(self, x, y):
+        """Return the flat bin index x_index*num_y_bins + y_index of every parcel, or -1 if it is outside the domain."""
+        x_indices, y_indices = self.compute_bin_indices(np.asarray(x), np.asarray(y))
+        flat_indices = x_indices * self.num_y_bins + y_indices
+        flat_indices[x_indices < 0] = -1
+        return flat_indices
+
+    def group_parcels_by_bin(self, x, y):
+        """
+        Group parcels by spatial bin with a single stable argsort.
+
+        Returns:
+            Tuple (order, bin_offsets). The parcels of bin (j, k) are order[bin_offsets[n]:bin_offsets[n+1]] with
+            n = j*num_y_bins + k, listed in the order in which they appear in the input arrays. Parcels outside the
+            domain are not part of order.
+        """
+        flat_indices = self.compute_flat_bin_indices(x, y)
+        inside = np.flatnonzero(flat_indices >= 0)
+        order = inside[np.argsort(flat_indices[inside], kind='stable')]
+        counts = np.bincount(flat_indices[inside], minlength=self.num_x_bins*self.num_y_bins)
+        bin_offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+        np.cumsum(counts, out=bin_offsets[1:])
+        return order, bin_offsets
+
+
+class BoundingBoxFilter(object):
+    """
+    Parcel filter that keeps the parcels inside of the outer edges of a ParticleBinDomain. With radial bins the
+    y extent is applied to r = sqrt(y**2 + z**2). Parcels kept by the filter are exactly the ones that
+    ParticleBinDomain.compute_bin_indices places into a bin.
+    """
+    def __init__(self, particle_bin_domain, radial_bin_flag=0):
+        x_bin_edges = particle_bin_domain.compute_x_bin_edges()
+        y_bin_edges = particle_bin_domain.compute_y_bin_edges()
+        self.x_min = x_bin_edges[0]
+        self.x_max = x_bin_edges[-1]
+        self.y_min = y_bin_edges[0]
+        self.y_max = y_bin_edges[-1]
+        self.radial_bin_flag = radial_bin_flag
+
+    def __call__(self, x, y, z):
+        if self.radial_bin_flag == 1:
+            y = np.sqrt(y**2 + z**2)
+        return (x >= self.x_min) & (x < self.x_max) & (y >= self.y_min) & (y < self.y_max)
+
 
 class ParticleBinCell:
     """A representation of a single spatial bin
     
     The fundamental information about a bin cell is simply the parcels that are contained within in. The class
-    holds a list of parcel objects, and has methods to perform operations on this list of parcels.
+    holds a columnar ParcelTable with 'diameter' and 'particles_per_parcel' columns, and has methods to perform
+    operations on these parcels.
     """
-    def __init__(self, parcels=None):
-        self.parcels = [] if parcels is None else parcels[:] #List of dictionaries with string keys and float values
-        self.num_parcels = len(self.parcels)
+    def __init__(self, parcels=None, dtype=np.float64):
+        if parcels is None:
+            parcels = ParcelTable({'diameter': [], 'particles_per_parcel': []}, dtype)
+        self.parcels = parcels.take(slice(None), ['diameter', 'particles_per_parcel'])
+
+    @property
+    def num_parcels(self):
+        return len(self.parcels)
 
     def add_data(self, diameter, particles_per_parcel):
         #User wants to add a single piece of information about a parcel found in a bin
-        new_parcel = {'diameter': diameter, 'particles_per_parcel': particles_per_parcel}
-        self.parcels.append(new_parcel)
-        self.num_parcels += 1
+        self.add_parcels([diameter], [particles_per_parcel])
+
+    def add_parcels(self, diameters, particles_per_parcel):
+        #User wants to add a group of parcels found in a bin
+        new_parcels = ParcelTable({'diameter': diameters, 'particles_per_parcel': particles_per_parcel}, self.parcels.dtype)
+        self.parcels = ParcelTable.concatenate([self.parcels, new_parcels])
 
     def print_data(self):
         logger.info("Data set has %d elements."%(self.num_parcels))
         logger.info('Diameter  ->  Particles Per Parcel')
         for i in range(0, self.num_parcels):
-            logger.info("%10.6E\t%10.6E"%(self.parcels[i]['diameter'], self.parcels[i]['particles_per_parcel']))
+            logger.info("%10.6E\t%10.6E"%(self.parcels['diameter'][i], self.parcels['particles_per_parcel'][i]))
 
     def sort_diameters(self):
         if self.num_parcels > 0: #Only sort if there are actually any elements to sort
             #CheckSum for error checking
-            check_sum_1 = 0.0
-            for parcel in self.parcels:
-                check_sum_1 += parcel['particles_per_parcel']
+            check_sum_1 = np.sum(self.parcels['particles_per_parcel'])
 
-            self.parcels.sort(key = lambda parcel: parcel['diameter'])
+            self.parcels.sort_by('diameter')
 
             #CheckSum for error checking
-            check_sum_2 = 0.0
-            for parcel in self.parcels:
-                check_sum_2 += parcel['particles_per_parcel']
+            check_sum_2 = np.sum(self.parcels['particles_per_parcel'])
 
             if abs(check_sum_1 - check_sum_2) >= 1e-6:
                 logger.error("ERROR - Sorting process has lost data!")
@@ -135,12 +248,12 @@ class ParticleBinCell:
     def sort_particles_per_parcel(self):
         if self.num_parcels > 0: #Only sort if there are actually any elements to sort
             #CheckSum for error checking
-            check_sum_1 = sum([parcel['particles_per_parcel'] for parcel in self.parcels])
+            check_sum_1 = np.sum(self.parcels['particles_per_parcel'])
 
-            self.parcels.sort(key = lambda parcel: parcel['particles_per_parcel'])
+            self.parcels.sort_by('particles_per_parcel')
 
             #CheckSum for error checking
-            check_sum_2 = sum([parcel['particles_per_parcel'] for parcel in self.parcels])
+            check_sum_2 = np.sum(self.parcels['particles_per_parcel'])
             if abs(check_sum_1 - check_sum_2) >= 1e-7:
                 logger.error("ERROR - Sorting by parcels process has lost data!")
 
@@ -153,60 +266,48 @@ class ParticleBinCell:
             custom_diameter_bins: list of dictionaries with keys 'd_min' and 'd_max'. List is assumed to be sorted
                                   by increasing values of 'd_min'. And values are strings.
         """ 
-        check_sum_1 = sum([parcel['particles_per_parcel'] for parcel in self.parcels])
-        #Create new lists for holding data
-        new_parcels = []
-        for i, dia_bin in enumerate(custom_diameter_bins):
-            #Store the center values of the bins
-            entry = {'diameter': 0.5*(custom_diameter_bins[i]['d_min'] + custom_diameter_bins[i]['d_max']),
-                     'particles_per_parcel': 0}
-            new_parcels.append(entry) 
-
-        #sort into the new bins
-        for parcel in self.parcels:
-            #Find out which bin the ith diameter belongs in
-            found = False #Flag for marking if the particular value falls into one of the provided bins
-            for j, dia_bin in enumerate(custom_diameter_bins):
-                if (parcel['diameter'] >= dia_bin['d_min']) and (parcel['diameter'] < dia_bin['d_max']):
-                    new_parcels[j]['particles_per_parcel'] = new_parcels[j]['particles_per_parcel'] + parcel['particles_per_parcel'] 
-                    logger.debug("L: %10.6E \t R: %10.6E \t D: %f \t PPC: %f"%(dia_bin['d_min'], dia_bin['d_max'], parcel['diameter'], parcel['particles_per_parcel']))
-                    found = True #Value has been placed into the new bin structure
-                    break
-
-            if found == False:# A value in the original data set was not able to be placed into the bins
-                logger.warning("Warning: The value: %10.6E  in the original data set was unable to be placed into the user defined bins"%(parcel['diameter']))
-
-        self.parcels = new_parcels
-        self.num_parcels = len(new_parcels) 
-
-        check_sum_2 = sum([parcel['particles_per_parcel'] for parcel in self.parcels])
+        check_sum_1 = np.sum(self.parcels['particles_per_parcel'])
+        diameter_bin_edges = compute_diameter_bin_edges(custom_diameter_bins)
+        new_diameters = 0.5*(diameter_bin_edges[:-1] + diameter_bin_edges[1:]) #Store the center values of the bins
+        new_particles_per_parcel, out_of_range = compute_weighted_diameter_histogram(self.parcels['diameter'], self.parcels['particles_per_parcel'], diameter_bin_edges)
+
+        if np.any(out_of_range): # Values in the original data set were not able to be placed into the bins
+            out_of_range_diameters = self.parcels['diameter'][out_of_range]
+            logger.warning("Warning: %d values between %10.6E and %10.6E in the original data set were unable to be placed into the user defined bins"%(len(out_of_range_diameters), np.amin(out_of_range_diameters), np.amax(out_of_range_diameters)))
+
+        self.parcels = ParcelTable({'diameter': new_diameters, 'particles_per_parcel': new_particles_per_parcel}, self.parcels.dtype)
+
+        check_sum_2 = np.sum(self.parcels['particles_per_parcel'])
         if abs(check_sum_1 - check_sum_2) >= 1e-6:
             logger.warning("Warning - Customizing Bins process has lost data, which may be due to existing data being outside of user-defined bin values")
             logger.warning("Magnitude of Error: %10.6E"%(abs(check_sum_1 - check_sum_2)))
 
     def __add__(self, other):
         """
-        Combine the data contained in two instances of the class into a new class
+        Combine the data contained in two instances of the class into a new class. The parcels are concatenated
+        and left unsorted.
         """
-        if len(other.parcels) > 0:  #Only add the new data if it actually exists
-            self.sort_particles_per_parcel()
-            other.sort_particles_per_parcel()
-            check_sum_1 = sum([parcel['particles_per_parcel'] for parcel in self.parcels] + [parcel['particles_per_parcel'] for parcel in other.parcels])
-    
-            new_parcels = self.parcels + other.parcels #concatenate the internal lists
-            combined_data = ParticleBinCell(new_parcels)
-            combined_data.sort_particles_per_parcel()
-
-            check_sum_2 = sum([parcel['particles_per_parcel'] for parcel in combined_data.parcels])
-            if abs(check_sum_1 - check_sum_2) >= 1e-9:
-                logger.error("ERROR - Addition process has lost data! Discrepancy is: %10.6E"%(abs(check_sum_1 - check_sum_2)))
-                logger.error("Input Sum of particles_per_parcel: %10.6E"%(check_sum_1))
-                logger.error("Output Sum of particles_per_parcel: %10.6E"%(check_sum_2))
-        else:
-            combined_data = ParticleBinCell(self.parcels)
-
-        return ParticleBinCell(combined_data.parcels)
-
-
+        return ParticleBinCell.merge([self, other], sort_diameters=False)
 
+    @staticmethod
+    def merge(cells, sort_diameters=True):
+        """
+        Combine the data contained in any number of instances of the class into a new class.
 
+        All parcel arrays are concatenated in a single pass and, if asked, sorted by diameter once at the end.
+        """
+        cells = list(cells)
+        if not cells:
+            return ParticleBinCell()
+        check_sum_1 = sum([np.sum(cell.parcels['particles_per_parcel']) for cell in cells])
+
+        combined_data = ParticleBinCell(ParcelTable.concatenate([cell.parcels for cell in cells]))
+        if sort_diameters:
+            combined_data.sort_diameters()
+
+        check_sum_2 = np.sum(combined_data.parcels['particles_per_parcel'])
+        if abs(check_sum_1 - check_sum_2) >= 1e-9 * max(1.0, abs(check_sum_1)):
+            logger.error("ERROR - Addition process has lost data! Discrepancy is: %10.6E"%(abs(check_sum_1 - check_sum_2)))
+            logger.error("Input Sum of particles_per_parcel: %10.6E"%(check_sum_1))
+            logger.error("Output Sum of particles_per_parcel: %10.6E"%(check_sum_2))
+        return combined_data
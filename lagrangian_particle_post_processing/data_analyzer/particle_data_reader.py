@@ -1,66 +1,79 @@
-import itertools
 import h5py
 import logging
-import os
+import numpy as np
+
+from parcel_table import ParcelTable
 
 logger = logging.getLogger(__name__)
 
+class ReadBufferPool(object):
+    """
+    Preallocated arrays that the HDF5 readers fill with read_direct. A pool is created once for a time series
+    and handed to the reader of every time step, so the same memory is reused instead of allocating new arrays
+    for each snapshot. Arrays returned by a reader that uses a pool are overwritten by the next read.
+    """
+    def __init__(self):
+        self.buffers = {}
+
+    def get_buffer(self, name, num_rows, dtype):
+        buffer = self.buffers.get(name)
+        if buffer is None or buffer.dtype != dtype or len(buffer) < num_rows:
+            buffer = np.empty(num_rows, dtype=dtype)
+            self.buffers[name] = buffer
+        return buffer[:num_rows]
+
+
 class HDF5ParticleDataReader(object):
     """
     The purpose of this module is to read the particle data that is stored in HDF5 format
-    and return an array that is filled with particle data information.
+    and return NumPy arrays that are filled with particle data information.
     """
-    def __init__(self, case_name, time_stamp):
+    def __init__(self, case_name, time_stamp, dtype=np.float64, buffer_pool=None):
         self.case_name = case_name
         self.time_stamp = time_stamp
+        self.dtype = np.dtype(dtype)
+        self.buffer_pool = buffer_pool
         self.num_parcels = 0
+        self.bytes_read = 0 #Bytes of particle data read from disk so far
 
-    def read_particle_diameter_data(self):
-        file_name = 'ptdia_ptsca.' + str(self.time_stamp) + '_' + self.case_name
-
+    def read_dataset(self, file_name, dataset_name, empty_dtype=np.float64):
+        """Read a whole dataset into a NumPy array, directly into a pooled buffer when a buffer pool is used."""
         f = h5py.File(file_name, 'r')
         
         #Make sure the group is in the dataset
-        if 'ptdia' in f.keys():
-            particles = f['ptdia'][:]
+        if dataset_name not in f.keys():
+            f.close()
+            return np.zeros(0, dtype=empty_dtype)
+
+        dataset = f[dataset_name]
+        if self.buffer_pool is None:
+            data = dataset[()]
         else:
-            particles = []
+            data = self.buffer_pool.get_buffer(dataset_name, dataset.shape[0], dataset.dtype)
+            if len(data) > 0:
+                dataset.read_direct(data)
+        f.close()
+        self.bytes_read += data.nbytes
+        return data
 
-        logger.info('Storing diameter data from file: %s'%(file_name))
-        diameter_data = []
-        for particle in particles:
-            diameter_data.append(particle)
+    def read_particle_diameter_data(self):
+        file_name = 'ptdia_ptsca.' + str(self.time_stamp) + '_' + self.case_name
 
-        logger.info("Detected %d parcels in data file"%(len(particles)))
-        self.num_parcels = len(particles)
+        logger.info('Storing diameter data from file: %s'%(file_name))
+        diameter_data = self.read_dataset(file_name, 'ptdia')
 
-        f.close()
+        logger.info("Detected %d parcels in data file"%(len(diameter_data)))
+        self.num_parcels = len(diameter_data)
         return diameter_data
 
     def read_particle_coordinate_data(self):
         file_name = 'particle_pos.' + str(self.time_stamp) + '_' + self.case_name
         
-        f = h5py.File(file_name, 'r')
-        
-        #Make sure the group is in the dataset
-        if 'particle position' in f.keys():
-            positions = f['particle position'][:]
-        else:
-            positions = []
-
         logger.info("Storing parcel coordinate data from file: %s"%(file_name))
+        positions = self.read_dataset(file_name, 'particle position', [('x', np.float64), ('y', np.float64), ('z', np.float64)])
         
-        #Store data in a 3xN list
-        position_data = []
-        position_data.append([])
-        position_data.append([])
-        position_data.append([])
-
-        for position in positions:
-            position_data[0].append(position['x'])
-            position_data[1].append(position['y'])
-            position_data[2].append(position['z'])
-        f.close()
+        #Store data as a 3xN list of views into the compound x/y/z data
+        position_data = [positions['x'], positions['y'], positions['z']]
         
         logger.info("Number of rows in parcel position data set:%d"%(len(position_data)))
         logger.info("Number of columns in parcel position data set: %d"%(len(position_data[0])))
@@ -69,20 +82,8 @@ class HDF5ParticleDataReader(object):
     def read_particle_parcel_data(self):
         file_name = 'ptnump_ptsca.' + str(self.time_stamp) + '_' + self.case_name
         
-        f = h5py.File(file_name, 'r')
-        
-        #Make sure the group is in the dataset
-        if 'ptnump' in f.keys():
-            particles_per_parcel_data = f['ptnump'][:]
-        else:
-            particles_per_parcel_data = [] 
-
         logger.info("Storing particles per parcel data from file: %s"%(file_name))
-        particles_per_parcel = []
-        parcel_check_counter = 0 #For checking that all data is actually being read from file
-        for parcel in particles_per_parcel_data:
-            particles_per_parcel.append(parcel)
-        f.close()
+        particles_per_parcel = self.read_dataset(file_name, 'ptnump')
 
         logger.info("Number of particles per parcel data read: %d"%(len(particles_per_parcel)))
         return particles_per_parcel
@@ -90,124 +91,230 @@ class HDF5ParticleDataReader(object):
     def read_particle_temperature_data(self):
         file_name = 'pttemp_ptsca.' + str(self.time_stamp) + '_' + self.case_name
         
-        f = h5py.File(file_name, 'r')
-        
-        #Make sure the group is in the dataset
-        if 'pttemp' in f.keys():
-            temperatures = f['pttemp'][:]
-        else:
-            temperatures = [] 
-
         logger.info("Storing temperature data from file: %s"%(file_name))
-        temperature_data = []
-        ready_to_read = False
-        for temperature in temperatures:
-            temperature_data.append(temperature)
-        f.close()
+        temperature_data = self.read_dataset(file_name, 'pttemp')
         return temperature_data
 
 
 class HDF5ParticlePropertyPlotterDataReader(HDF5ParticleDataReader):
     """
     The purpose of this module is to read the particle data that is stored in HDF5 format
-    and return an array to the caller that is filled with particle data information.
+    and return a ParcelTable to the caller with 'diameter' and 'temperature' columns.
     """
-    def __init__(self,case_name,time_stamp):
-        super(HDF5ParticlePropertyPlotterDataReader, self).__init__(case_name, time_stamp)
+    def __init__(self, case_name, time_stamp, dtype=np.float64, buffer_pool=None):
+        super(HDF5ParticlePropertyPlotterDataReader, self).__init__(case_name, time_stamp, dtype, buffer_pool)
     
     def read_hdf_particle_data(self):
         #Store all of the particle data that is currently in a list format into one large list
         diameter_data = self.read_particle_diameter_data()
         particle_temperature_data = self.read_particle_temperature_data()
 
-        particle_data = []
-        for i in range(0, self.num_parcels):
-            particle_data.append([])
-            particle_data[i].append(diameter_data[i])
-            particle_data[i].append(particle_temperature_data[i])
+        particle_data = ParcelTable({'diameter': diameter_data,
+                                     'temperature': particle_temperature_data}, self.dtype)
         return particle_data
 
 
 class HDF5ParticlePDFPlotterDataReader(HDF5ParticleDataReader):
     """
     The purpose of this module is to read the particle data that is stored in HDF5 format
-    and return an array to the caller that is filled with particle data information.
+    and return a ParcelTable to the caller with 'diameter', 'x', 'y', 'z' and 'particles_per_parcel' columns, and a
+    'temperature' column when include_temperature is set.
     """
-    def __init__(self,case_name,time_stamp):
-        super(HDF5ParticlePDFPlotterDataReader, self).__init__(case_name, time_stamp)
-    
-    def read_hdf_particle_data(self):
+    def __init__(self, case_name, time_stamp, dtype=np.float64, buffer_pool=None, include_temperature=False):
+        super(HDF5ParticlePDFPlotterDataReader, self).__init__(case_name, time_stamp, dtype, buffer_pool)
+        self.include_temperature = include_temperature
+        self.column_names = ['diameter', 'x', 'y', 'z', 'particles_per_parcel'] + (['temperature'] if include_temperature else [])
+
+    def read_hdf_particle_data(self, parcel_filter=None, chunk_size=None):
+        """
+        Read the parcels of the time step.
+
+        Args:
+            parcel_filter: optional callable taking x, y, z arrays and returning a boolean mask of the parcels to keep.
+                           Parcels that fail the filter are dropped as soon as their coordinates are read.
+            chunk_size: optional number of rows to read at a time when a filter is used. The diameter and particles
+                        per parcel of a chunk are only read from disk if the chunk holds parcels that pass the filter.
+        """
+        if parcel_filter is not None:
+            return self.read_filtered_hdf_particle_data(parcel_filter, chunk_size)
+
         #Store all of the particle data that is currently in a list format into one large list
         diameter_data = self.read_particle_diameter_data()
         position_data = self.read_particle_coordinate_data()
         particles_per_parcel_data = self.read_particle_parcel_data()
 
-        particle_data = []
-        for i in range(0, self.num_parcels):
-            entry = {'diameter': diameter_data[i],
-                     'x': position_data[0][i],
-                     'y': position_data[1][i],
-                     'z': position_data[2][i],
-                     'particles_per_parcel': particles_per_parcel_data[i]}
-            particle_data.append(entry)
+        particle_data = ParcelTable({'diameter': diameter_data,
+                                     'x': position_data[0],
+                                     'y': position_data[1],
+                                     'z': position_data[2],
+                                     'particles_per_parcel': particles_per_parcel_data}, self.dtype)
+        if self.include_temperature:
+            particle_data['temperature'] = self.read_particle_temperature_data()
         return particle_data
 
+    def read_rows(self, dataset, start, stop):
+        """Read rows start:stop of a dataset, into a pooled buffer when a buffer pool is used."""
+        if self.buffer_pool is None:
+            data = dataset[start:stop]
+        else:
+            data = self.buffer_pool.get_buffer(dataset.name, stop - start, dataset.dtype)
+            if stop > start:
+                dataset.read_direct(data, source_sel=np.s_[start:stop])
+        self.bytes_read += data.nbytes
+        return data
+
+    def read_filtered_hdf_particle_data(self, parcel_filter, chunk_size=None):
+        chunks = list(self.iterate_particle_data_chunks(parcel_filter, chunk_size))
+        if not chunks:
+            chunks.append(ParcelTable(dict((name, []) for name in self.column_names), self.dtype))
+        particle_data = ParcelTable.concatenate(chunks)
+        logger.info("Detected %d parcels in data files, %d of which passed the parcel filter"%(self.num_parcels, len(particle_data)))
+        return particle_data
 
-class VOFDataReader(object):
-    def __init__(self, case_name, time_stamp):
-        self.case_name = case_name
-        self.time_stamp = time_stamp
-
-    def read_particle_diameter_data(self):
-        file_name = 'dropletSDF_' + str(self.time_stamp) + '.dat'
+    def iterate_particle_data_chunks(self, parcel_filter=None, chunk_size=None):
+        """
+        Yield the parcels of the time step as ParcelTables of the parcels that pass the filter in every chunk_size
+        rows of the diameter, position and parcel datasets, so a time step never has to be held in memory as a whole.
+        Chunks without any parcel that passes the filter are skipped.
+        """
+        diameter_file = h5py.File('ptdia_ptsca.' + str(self.time_stamp) + '_' + self.case_name, 'r')
+        position_file = h5py.File('particle_pos.' + str(self.time_stamp) + '_' + self.case_name, 'r')
+        parcel_file = h5py.File('ptnump_ptsca.' + str(self.time_stamp) + '_' + self.case_name, 'r')
+        temperature_file = h5py.File('pttemp_ptsca.' + str(self.time_stamp) + '_' + self.case_name, 'r') if self.include_temperature else None
 
+        self.num_parcels = 0
         try:
-            f = open(file_name,'r')
-        except IOError as e:
-            logger.error('Unable to open file') #Does not exist OR no read permissions
-            raise IOError
-
-        logger.info('Storing diameter data from file: %s'%(file_name))
-        diameter_data = []
-        ready_to_read = False
-        num_entries = 0
-        for Line in f:
-            #Stop when we have been reading data and we encounter a brace character on the line
-            if ready_to_read == True  and '}' in Line :
-                break
+            if 'ptdia' in diameter_file.keys() and 'particle position' in position_file.keys() and 'ptnump' in parcel_file.keys():
+                diameter_dataset = diameter_file['ptdia']
+                position_dataset = position_file['particle position']
+                parcel_dataset = parcel_file['ptnump']
+                self.num_parcels = diameter_dataset.shape[0]
+                if chunk_size is None or chunk_size <= 0:
+                    chunk_size = max(self.num_parcels, 1)
+
+                for start in range(0, self.num_parcels, chunk_size):
+                    stop = min(start + chunk_size, self.num_parcels)
+                    positions = self.read_rows(position_dataset, start, stop)
+                    x = np.asarray(positions['x'], dtype=self.dtype)
+                    y = np.asarray(positions['y'], dtype=self.dtype)
+                    z = np.asarray(positions['z'], dtype=self.dtype)
+                    keep = np.ones(len(x), dtype=bool) if parcel_filter is None else parcel_filter(x, y, z)
+                    if not np.any(keep):
+                        continue #Nothing of interest in this chunk, so skip reading the rest of its data
+                    chunk = ParcelTable({'diameter': self.read_rows(diameter_dataset, start, stop)[keep],
+                                         'x': x[keep],
+                                         'y': y[keep],
+                                         'z': z[keep],
+                                         'particles_per_parcel': self.read_rows(parcel_dataset, start, stop)[keep]}, self.dtype)
+                    if temperature_file is not None:
+                        chunk['temperature'] = self.read_rows(temperature_file['pttemp'], start, stop)[keep]
+                    yield chunk
+        finally:
+            diameter_file.close()
+            position_file.close()
+            parcel_file.close()
+            if temperature_file is not None:
+                temperature_file.close()
 
-            if ready_to_read == True:
-                #Parse line
-                LineData = Line.rstrip()
-                LineData = LineData.replace(',', ' ')
-                LineData = LineData.split()
 
-                diameter_data.append(LineData)
+class VOFDataReader(object):
+    """
+    Reads the droplets that a VOF simulation writes to dropletSDF_<time step>.dat. The values of the file are stored
+    in DATA { ... } blocks of comma or whitespace separated numbers, which start on the line after the DATA { marker:
+    the droplet diameters, followed by the x, y and z coordinates of the droplet centroids when the file has them.
+    """
+    data_block_start = 'DATA {'
+    data_block_end = '}'
 
-                #Count number of entries on this line
-                num_entries += len(LineData)
+    def __init__(self, case_name, time_stamp, dtype=np.float64):
+        self.case_name = case_name
+        self.time_stamp = time_stamp
+        self.dtype = np.dtype(dtype)
+        self.num_parcels = 0
+        self.bytes_read = 0 #Bytes of the data file read so far
+        self.data_blocks = None
 
-            if 'DATA {' in Line:    #Real data is on next line. Prepare to read
-                ready_to_read = True
+    def get_file_name(self):
+        return 'dropletSDF_' + str(self.time_stamp) + '.dat'
 
-        logger.info("Detected %d parcels in data file"%(num_entries))
-        self.num_parcels = num_entries
+    def read_data_blocks(self):
+        """
+        Return the DATA blocks of the file as arrays. The file is read in one piece, and every block is converted with
+        a single bulk parse instead of splitting it line by line. The blocks are only read once by each reader.
+        """
+        if self.data_blocks is not None:
+            return self.data_blocks
 
-        #Close and delete the data file
-        f.close()
-        os.remove('tempPythonFile.txt')
+        file_name = self.get_file_name()
+        try:
+            with open(file_name, 'r') as f:
+                text = f.read()
+        except IOError:
+            logger.error('Unable to open file %s'%(file_name)) #Does not exist OR no read permissions
+            raise
+        self.bytes_read += len(text)
+
+        data_blocks = []
+        position = text.find(self.data_block_start)
+        while position >= 0:
+            line_end = text.find('\n', position)
+            start = len(text) if line_end < 0 else line_end + 1
+            stop = text.find(self.data_block_end, start)
+            if stop < 0:
+                logger.error('The DATA block at character %d of %s is not closed by a brace'%(position, file_name))
+                raise ValueError('Unterminated DATA block in %s'%(file_name))
+            data_blocks.append(np.fromstring(text[start:stop].replace(',', ' '), dtype=self.dtype, sep=' '))
+            position = text.find(self.data_block_start, stop)
+        self.data_blocks = data_blocks
+        return data_blocks
 
-        #Perform list comprehension to un-nest the list that was made(not sure why it is nested, but it is)
-        diameter_data = list(itertools.chain.from_iterable(diameter_data))
+    def read_particle_diameter_data(self):
+        logger.info('Storing diameter data from file: %s'%(self.get_file_name()))
+        data_blocks = self.read_data_blocks()
+        diameter_data = data_blocks[0] if data_blocks else np.zeros(0, dtype=self.dtype)
+        logger.info("Detected %d parcels in data file"%(len(diameter_data)))
+        self.num_parcels = len(diameter_data)
         return diameter_data
 
+    def read_particle_position_data(self):
+        """The x, y and z coordinates of the droplet centroids, from the three DATA blocks after the diameters."""
+        data_blocks = self.read_data_blocks()
+        if len(data_blocks) < 4:
+            logger.error('%s has no droplet centroids. Expected DATA blocks of the diameters and of the x, y and z coordinates.'%(self.get_file_name()))
+            raise ValueError('No droplet positions in %s'%(self.get_file_name()))
+        if any(len(coordinates) != len(data_blocks[0]) for coordinates in data_blocks[1:4]):
+            logger.error('The DATA blocks of %s hold different numbers of droplets: %s'%(self.get_file_name(), [len(data_block) for data_block in data_blocks]))
+            raise ValueError('Inconsistent DATA blocks in %s'%(self.get_file_name()))
+        return data_blocks[1:4]
+
 
 class VOFASCIIDataReader(VOFDataReader):
-    def __init__(self):
-        super(VOFASCIIDataReader, self).__init__()
+    """
+    Returns the droplets of a dropletSDF file as a ParcelTable with the columns of HDF5ParticlePDFPlotterDataReader,
+    so that they are binned like the lagrangian parcels. Every droplet is a parcel of one particle.
+    """
+    def __init__(self, case_name, time_stamp, dtype=np.float64):
+        super(VOFASCIIDataReader, self).__init__(case_name, time_stamp, dtype)
+
+    def read_particle_data(self, parcel_filter=None):
+        """
+        Read the droplets of the time step.
 
-    def read_particle_data(self):
+        Args:
+            parcel_filter: optional callable taking x, y, z arrays and returning a boolean mask of the droplets to keep.
+        """
         diameter_data = self.read_particle_diameter_data()
         position_data = self.read_particle_position_data()
-        pass
+        particle_data = ParcelTable({'diameter': diameter_data,
+                                     'x': position_data[0],
+                                     'y': position_data[1],
+                                     'z': position_data[2],
+                                     'particles_per_parcel': np.ones(len(diameter_data), dtype=self.dtype)}, self.dtype)
+        if parcel_filter is not None:
+            particle_data = particle_data.take(np.flatnonzero(parcel_filter(particle_data['x'], particle_data['y'], particle_data['z'])))
+            logger.info("%d of the droplets passed the parcel filter"%(len(particle_data)))
+        return particle_data
 
+    def read_hdf_particle_data(self, parcel_filter=None, chunk_size=None):
+        """The read_hdf_particle_data interface of the HDF5 readers. The file is always parsed in one piece."""
+        return self.read_particle_data(parcel_filter)
@@ -32,6 +32,32 @@ class SauterMeanDiameterCalculator(object):
         pass
 
     def compute_sauter_mean_diameter(self, particle_bin_cell):
+        if particle_bin_cell.num_parcels == 0:
+            logger.debug("No Particles in Bin. Nothing will be output for this data set")
+            smd = 0 
+            return smd 
+        return self.compute_sauter_mean_diameter_from_arrays(particle_bin_cell.parcels['diameter'], particle_bin_cell.parcels['particles_per_parcel'])
+
+    def compute_sauter_mean_diameter_from_arrays(self, diameters, particles_per_parcel):
+        """Sauter mean diameter of a single group of parcels given as arrays."""
+        diameters = np.asarray(diameters)
+        smd = self.compute_sauter_mean_diameter_field(np.zeros(len(diameters), dtype=np.int64), diameters, particles_per_parcel, 1, 1)
+        return smd[0][0]
+
+    def compute_sauter_mean_diameter_field(self, bin_indices, diameters, particles_per_parcel, num_x_bins, num_y_bins):
+        """
+        Compute the Sauter mean diameter of every spatial bin in one call.
+
+        Args:
+            bin_indices: flat spatial bin index (x_index*num_y_bins + y_index) of every parcel
+            diameters: parcel diameters
+            particles_per_parcel: number of particles in each parcel
+            num_x_bins: number of x bins
+            num_y_bins: number of y bins
+
+        Returns:
+            num_x_bins x num_y_bins array of D32 values. Bins without particles are given a value of 0.
+        """
         raise NotImplementedError
     
     def IQR(self, data):
@@ -46,95 +72,109 @@ class SauterMeanDiameterCalculatorNoBins(SauterMeanDiameterCalculator):
     def __init__(self):
         super(SauterMeanDiameterCalculatorNoBins, self).__init__()
     
-    def compute_sauter_mean_diameter(self, particle_bin_cell):
-        if particle_bin_cell.num_parcels == 0:
-            logger.debug("No Particles in Bin. Nothing will be output for this data set")
-            smd = 0 
-            return smd 
-        
-        numerator = 0
-        denominator = 0
-        for parcel in particle_bin_cell.parcels:
-            numerator += parcel['particles_per_parcel'] * parcel['diameter']**3
-            denominator += parcel['particles_per_parcel'] * parcel['diameter']**2
-        
-        smd = numerator/denominator
-        return smd
+    def compute_sauter_mean_diameter_field(self, bin_indices, diameters, particles_per_parcel, num_x_bins, num_y_bins):
+        diameters = np.asarray(diameters, dtype=np.float64)
+        particles_per_parcel = np.asarray(particles_per_parcel, dtype=np.float64)
+        numerator = np.bincount(bin_indices, weights=particles_per_parcel * diameters**3, minlength=num_x_bins*num_y_bins)
+        denominator = np.bincount(bin_indices, weights=particles_per_parcel * diameters**2, minlength=num_x_bins*num_y_bins)
+
+        smd = np.zeros(num_x_bins*num_y_bins)
+        np.divide(numerator, denominator, out=smd, where=denominator != 0)
+        return smd.reshape(num_x_bins, num_y_bins)
+
 
 class SauterMeanDiameterCalculatorDiameterBins(SauterMeanDiameterCalculator):
+    """
+    Computes the Sauter mean diameter from a histogram of the parcel diameters of each spatial bin. The diameter bin
+    width follows the Freedman-Diaconis rule, the bins start at the smallest diameter of the spatial bin, and every
+    parcel counts once regardless of its particles per parcel. The center of a diameter bin is used as the diameter
+    of all of the parcels in it.
+    """
     def __init__(self):
         super(SauterMeanDiameterCalculatorDiameterBins, self).__init__()
         
+    def compute_diameter_bin_width(self, iqr, num_samples):
+        #Freedman-Diaconis bin size estimation
+        return 2 * iqr * num_samples**(-1.0/3.0)
+
+    def compute_num_diameter_bins(self, d_min, d_max, h):
+        """Number of bins of width h needed so that the last bin covers d_max. A zero width gives a single bin."""
+        num_bins = np.ones(np.shape(h), dtype=np.int64)
+        valid = h > 0
+        num_bins[valid] = np.floor((np.asarray(d_max - d_min)[valid]) / h[valid]).astype(np.int64) + 1
+        return num_bins
+
     def compute_diameter_bins(self, diameters):
         """
         Takes in a list of diameters and returns a list of bin
         min and max coordinates for creating a histogram of
         the diameter data.
         """
-        #Freedman-Diaconis bin size estimation
-        h = 2 * self.IQR(diameters) * len(diameters)**(-1.0/3.0)
+        h = self.compute_diameter_bin_width(self.IQR(diameters), len(diameters))
         logger.debug("Diameter Bin size(based on %d samples) is: %10.2E"%(len(diameters), h))
 
         d_min = np.amin(diameters)
         d_max = np.amax(diameters)
         logger.debug("Minimum Particle Diameter: %10.2E"%(d_min))
         logger.debug("Maximum Particle Diameter: %10.2E"%(d_max))
-    
 
-        num_bins = 1
-        d_bins = [d_min]
-        d_start = d_min
-        all_bins_found = False
-        while all_bins_found == False:
-            d_bins.append(d_bins[-1] + h)
-            if d_bins[-1] <= d_max:
-                num_bins += 1
-            else:
-                all_bins_found = True
+        num_bins = int(self.compute_num_diameter_bins(d_min, d_max, np.array([h]))[0])
         logger.debug("Number of diameter bins is: %d"%(num_bins))
 
         #Create vector of particle diameter bin coordinates
-        bin_coords = [{'d_min': d_min, 'd_max': d_min + h}]
-        for i in range(1, num_bins):
-            entry = {'d_min': bin_coords[-1]['d_max'] , 'd_max': bin_coords[-1]['d_max'] + h}
-            bin_coords.append(entry) 
+        bin_coords = [{'d_min': d_min + i*h, 'd_max': d_min + (i + 1)*h} for i in range(0, num_bins)]
 
         for i, bin_coord in enumerate(bin_coords):
             logger.debug("Diameter Bin %d \t%10.2E\t%10.2E\n"%(i + 1, bin_coord['d_min'], bin_coord['d_max']))
         
         return bin_coords
-        
-    def compute_sauter_mean_diameter(self, particle_bin_cell):
-        if particle_bin_cell.num_parcels == 0:
-            logger.debug("No Particles in Bin. Nothing will be output for this data set")
-            smd = 0 
-            return smd 
-        
-        particle_diameters = [parcel['diameter'] for parcel in particle_bin_cell.parcels]
-        logger.debug('Parcel Diameters')
-        logger.debug(particle_diameters)
-        diameter_bin_coords = self.compute_diameter_bins(particle_diameters)
-
-        #Sort the particles into Bins
-        logger.debug('Sorting parcels into diameter bins')
-        dia_bin_counts = np.zeros(len(diameter_bin_coords))
-        for parcel in particle_bin_cell.parcels:
-            for i, dia_bin in enumerate(diameter_bin_coords):
-                if parcel['diameter']  <= dia_bin['d_max'] and parcel['diameter'] >= dia_bin['d_min']:
-                    dia_bin_counts[i] += 1
-    
-        logger.debug("Bin Counts:")
-        logger.debug(dia_bin_counts)
-        logger.debug("Sum of particles in bins: %d\n"%(np.sum(dia_bin_counts)))
 
-        #Now tha the bins are constructed we compute the Sauter mean diameter using the bins
+    def compute_grouped_percentile(self, sorted_diameters, group_starts, group_sizes, q):
+        """Percentile (linear interpolation, as in np.percentile) of every group of an array sorted within groups."""
+        position = (q / 100.0) * (group_sizes - 1)
+        lower = np.floor(position).astype(np.int64)
+        fraction = position - lower
+        upper = np.minimum(lower + 1, group_sizes - 1)
+        lower_values = sorted_diameters[group_starts + lower]
+        upper_values = sorted_diameters[group_starts + upper]
+        return lower_values + fraction * (upper_values - lower_values)
+
+    def compute_sauter_mean_diameter_field(self, bin_indices, diameters, particles_per_parcel, num_x_bins, num_y_bins):
+        num_bins = num_x_bins*num_y_bins
+        diameters = np.asarray(diameters, dtype=np.float64)
+        bin_indices = np.asarray(bin_indices, dtype=np.int64)
+        smd = np.zeros(num_bins)
+        if len(diameters) == 0:
+            return smd.reshape(num_x_bins, num_y_bins)
+
+        #Sort the diameters within each spatial bin so that percentiles, minima and maxima are simple lookups
+        order = np.lexsort((diameters, bin_indices))
+        sorted_diameters = diameters[order]
+        sorted_bin_indices = bin_indices[order]
+        group_sizes = np.bincount(bin_indices, minlength=num_bins)
+        occupied = np.flatnonzero(group_sizes)
+        group_starts = (np.cumsum(group_sizes) - group_sizes)[occupied]
+        group_sizes = group_sizes[occupied]
+
+        iqr = self.compute_grouped_percentile(sorted_diameters, group_starts, group_sizes, 75) - self.compute_grouped_percentile(sorted_diameters, group_starts, group_sizes, 25)
+        h = self.compute_diameter_bin_width(iqr, group_sizes)
+        d_min = sorted_diameters[group_starts]
+        d_max = sorted_diameters[group_starts + group_sizes - 1]
+        logger.debug("Number of diameter bins per spatial bin:")
+        logger.debug(self.compute_num_diameter_bins(d_min, d_max, h))
+
+        #Diameter bin of every parcel. A diameter on the edge between two bins belongs to the lower one.
+        group_of_parcel = np.repeat(np.arange(len(occupied)), group_sizes)
+        parcel_h = h[group_of_parcel]
+        parcel_d_min = d_min[group_of_parcel]
+        diameter_indices = np.zeros(len(sorted_diameters), dtype=np.int64)
+        valid = parcel_h > 0
+        diameter_indices[valid] = np.maximum(np.ceil((sorted_diameters[valid] - parcel_d_min[valid]) / parcel_h[valid]).astype(np.int64) - 1, 0)
+
+        #Now that the bins are constructed we compute the Sauter mean diameter using the bins
         #we use the mean diameter in the bin as the representative value of the diameter for all particles in a bin.
-        numerator = 0
-        denominator = 0
-        for i, dia_bin in enumerate(diameter_bin_coords):
-            numerator +=  dia_bin_counts[i] * (0.5 * (dia_bin['d_max'] + dia_bin['d_min']))**3
-            denominator +=  dia_bin_counts[i] * (0.5 * (dia_bin['d_max'] + dia_bin['d_min']))**2
-        smd = numerator/denominator
-        
-        return smd
-
+        bin_centers = parcel_d_min + (diameter_indices + 0.5) * parcel_h
+        numerator = np.bincount(sorted_bin_indices, weights=bin_centers**3, minlength=num_bins)
+        denominator = np.bincount(sorted_bin_indices, weights=bin_centers**2, minlength=num_bins)
+        np.divide(numerator, denominator, out=smd, where=denominator != 0)
+        return smd.reshape(num_x_bins, num_y_bins)
@@ -0,0 +1,76 @@
+import concurrent.futures
+import logging
+import numpy as np
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+
+logger = logging.getLogger(__name__)
+
+#Figures of this process that are reused by every plot with the same axis labels
+_figure_templates = {}
+
+
+class LinePlotJob(object):
+    """Everything needed to render one line plot to a PNG file, in a form that can be sent to a worker process."""
+    def __init__(self, output_file_name, x_values, y_values, x_label, y_label, y_limits=None, marker='o', linestyle='-'):
+        self.output_file_name = output_file_name
+        self.x_values = np.asarray(x_values)
+        self.y_values = np.asarray(y_values)
+        self.x_label = x_label
+        self.y_label = y_label
+        self.y_limits = y_limits
+        self.marker = marker
+        self.linestyle = linestyle
+
+
+def get_figure_template(x_label, y_label):
+    """Return a figure with an Agg canvas and labelled axes, created once per process for every pair of labels."""
+    key = (x_label, y_label)
+    if key not in _figure_templates:
+        figure = Figure()
+        FigureCanvasAgg(figure)
+        axes = figure.add_subplot(111)
+        axes.set_xlabel(x_label)
+        axes.set_ylabel(y_label)
+        _figure_templates[key] = (figure, axes)
+    return _figure_templates[key]
+
+
+def render_line_plot(job):
+    """Draw the job on the template figure of its labels and save it. Only the data of the previous plot is replaced."""
+    figure, axes = get_figure_template(job.x_label, job.y_label)
+    for line in list(axes.lines):
+        line.remove()
+    axes.plot(job.x_values, job.y_values, marker=job.marker, linestyle=job.linestyle, color='C0')
+    axes.relim()
+    axes.autoscale_view()
+    if job.y_limits is not None:
+        axes.set_ylim(job.y_limits)
+    figure.savefig(job.output_file_name, bbox_inches='tight')
+    return job.output_file_name
+
+
+class PlotRenderer(object):
+    """
+    Renders batches of plot jobs, in a process pool when more than one worker is used. At most max_plots jobs of a
+    batch are rendered, which allows plotting to be limited or (with max_plots 0) skipped altogether.
+    """
+    def __init__(self, num_workers=1, max_plots=None):
+        self.num_workers = num_workers
+        self.max_plots = max_plots
+
+    def render(self, jobs):
+        if self.max_plots is not None and len(jobs) > self.max_plots:
+            logger.info("Rendering %d of %d plots"%(self.max_plots, len(jobs)))
+            jobs = jobs[:self.max_plots]
+        if not jobs:
+            return []
+
+        if self.num_workers <= 1 or len(jobs) == 1:
+            file_names = [render_line_plot(job) for job in jobs]
+        else:
+            chunk_size = max(1, len(jobs) // (4 * self.num_workers))
+            with concurrent.futures.ProcessPoolExecutor(max_workers=self.num_workers) as executor:
+                file_names = list(executor.map(render_line_plot, jobs, chunksize=chunk_size))
+        logger.info("Saved %d figures, e.g. %s"%(len(file_names), file_names[0]))
+        return file_names
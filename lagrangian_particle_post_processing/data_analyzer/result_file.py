@@ -0,0 +1,36 @@
+import datetime
+import h5py
+import logging
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+result_file_version = 1
+
+
+def write_result_file(file_name, datasets, metadata):
+    """
+    Write the results of an analysis into a single HDF5 file. Every array is stored as one dataset, written with a
+    single call, and the run metadata (input settings, time steps, ...) is stored as attributes of the file.
+    """
+    with h5py.File(file_name, 'w') as f:
+        for name, values in datasets.items():
+            f.create_dataset(name, data=np.asarray(values))
+        f.attrs['result_file_version'] = result_file_version
+        f.attrs['created'] = datetime.datetime.now().isoformat()
+        for key, value in metadata.items():
+            f.attrs[key] = value
+    logger.info("Wrote the results to: %s"%(file_name))
+
+
+def read_result_file(file_name, dataset_names=None):
+    """
+    Read a result file written by write_result_file. Returns a dictionary of the selected datasets (default all)
+    and a dictionary of the metadata.
+    """
+    with h5py.File(file_name, 'r') as f:
+        if dataset_names is None:
+            dataset_names = list(f.keys())
+        datasets = dict((name, f[name][()]) for name in dataset_names)
+        metadata = dict(f.attrs.items())
+    return datasets, metadata
@@ -0,0 +1,74 @@
+import hashlib
+import json
+import logging
+import os
+
+import bin_accumulators
+
+logger = logging.getLogger(__name__)
+
+
+class SnapshotCache(object):
+    """
+    On-disk cache of the per spatial bin summary of each time step.
+
+    A summary holds a fine weighted diameter histogram and the diameter moments of every spatial bin, which is enough
+    to rebuild PDFs for any diameter bins and exact mean diameters without reading the particle files again. A cache
+    entry is keyed by the signature of the time step (see utilities.get_file_signature) and by the binning parameters, so
+    changing the files or the spatial bins creates a new entry.
+    """
+    version = 2
+
+    def __init__(self, cache_directory, binning_parameters):
+        self.cache_directory = cache_directory
+        self.binning_parameters = dict(binning_parameters)
+        if not os.path.exists(self.cache_directory):
+            try:
+                os.makedirs(self.cache_directory)
+            except OSError:
+                #Another process (e.g. an MPI rank) may have created it in the meantime
+                if not os.path.isdir(self.cache_directory):
+                    raise
+
+    def compute_key(self, snapshot_signature):
+        key_data = {'version': self.version, 'snapshot': snapshot_signature, 'binning_parameters': self.binning_parameters}
+        return hashlib.sha1(json.dumps(key_data, sort_keys=True).encode('utf-8')).hexdigest()
+
+    def get_cache_file_name(self, time_stamp, snapshot_signature):
+        return os.path.join(self.cache_directory, 'snapshot_%s_%s.npz'%(str(time_stamp), self.compute_key(snapshot_signature)))
+
+    def load(self, time_stamp, snapshot_signature):
+        """Return the cached summary of the time step, or None if there is no valid entry."""
+        cache_file_name = self.get_cache_file_name(time_stamp, snapshot_signature)
+        if not os.path.exists(cache_file_name):
+            return None
+        logger.info("Loading cached summary of time step %s from: %s"%(str(time_stamp), cache_file_name))
+        return bin_accumulators.BinAccumulatorSet.load(cache_file_name)
+
+    def save(self, time_stamp, snapshot_signature, summary):
+        cache_file_name = self.get_cache_file_name(time_stamp, snapshot_signature)
+        #Write to a temporary file first so that an interrupted run never leaves a partial entry behind
+        temporary_file_name = '%s.%d.tmp'%(cache_file_name, os.getpid())
+        summary.save(temporary_file_name)
+        os.replace(temporary_file_name, cache_file_name)
+        logger.info("Cached summary of time step %s in: %s"%(str(time_stamp), cache_file_name))
+
+
+def create_snapshot_summary(num_x_bins, num_y_bins, diameter_resolution):
+    """The accumulators that make up a cached summary of one time step."""
+    return bin_accumulators.BinAccumulatorSet({
+        'fine_diameter_histogram': bin_accumulators.FineDiameterHistogramAccumulator(num_x_bins, num_y_bins, diameter_resolution),
+        'diameter_moments': bin_accumulators.DiameterMomentAccumulator(num_x_bins, num_y_bins)})
+
+
+def fold_snapshot_summary(accumulators, summary):
+    """
+    Fold a time step summary into a set of accumulators. Diameter moments are merged exactly. All other statistics
+    are fed one pseudo-parcel at the center of every occupied fine diameter bin.
+    """
+    bin_indices, diameters, particles_per_parcel = summary['fine_diameter_histogram'].get_fine_parcels()
+    for accumulator in accumulators.accumulators.values():
+        if isinstance(accumulator, bin_accumulators.DiameterMomentAccumulator):
+            accumulator.merge(summary['diameter_moments'])
+        else:
+            accumulator.add_parcels(bin_indices, diameters, particles_per_parcel)
@@ -0,0 +1,64 @@
+import logging
+import queue
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class PrefetchingIterator(object):
+    """
+    Iterates over load_function(item) for every item, loading the items ahead of time on a background thread.
+
+    At most depth loaded items wait in the queue, and one more is being loaded while the caller works on the
+    current one, so no more than depth + 2 items are alive at any time. Exceptions raised by load_function are
+    raised again in the caller when the item that failed is reached.
+    """
+    _end_of_items = object()
+
+    def __init__(self, load_function, items, depth=1):
+        self.queue = queue.Queue(maxsize=max(int(depth), 1))
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.load_items, args=(load_function, list(items)), name='prefetch')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def load_items(self, load_function, items):
+        try:
+            for item in items:
+                if not self.put((True, load_function(item))):
+                    return
+        except Exception as e:
+            self.put((False, e))
+            return
+        self.put(self._end_of_items)
+
+    def put(self, entry):
+        """Wait for room in the queue, giving up when the iterator is closed. Returns False if it was closed."""
+        while not self.stop_event.is_set():
+            try:
+                self.queue.put(entry, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        entry = self.queue.get()
+        if entry is self._end_of_items:
+            self.thread.join()
+            raise StopIteration
+        loaded, value = entry
+        if not loaded:
+            self.close()
+            raise value
+        return value
+
+    next = __next__
+
+    def close(self):
+        """Stop loading items. Called when the caller stops iterating early."""
+        self.stop_event.set()
+        self.thread.join()
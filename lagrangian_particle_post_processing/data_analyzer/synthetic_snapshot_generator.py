@@ -0,0 +1,101 @@
+#! /usr/bin/env python
+
+# Purpose:  Writes synthetic Loci-Stream lagrangian particle files (ptdia_ptsca, particle_pos, ptnump_ptsca and
+#       pttemp_ptsca) for a spray-like parcel distribution, so that the data analyzer can be run and benchmarked
+#       without simulation output.
+#
+# Usage:    python synthetic_snapshot_generator.py --parcels 100000 --time-steps 8000 8100 8200 --case-name acetone
+#
+########################################################################
+import argparse
+import logging
+import os
+import h5py
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+class SyntheticSpray(object):
+    """
+    A round jet of droplets injected along the x axis at x = 0.
+
+    The parcels are spread uniformly over [0, x_length] in x. Their radial distance from the axis is half-normal
+    with a width that grows linearly with x from nozzle_radius at the inlet with the spread angle, and their
+    azimuth is uniform. Diameters are lognormal around median_diameter, shrinking linearly by evaporation_fraction
+    towards the end of the jet, and the temperature of the droplets rises linearly along the jet.
+    """
+    def __init__(self, x_length=0.3675, nozzle_radius=5.25e-3, spread_angle=5.0, median_diameter=30e-6,
+                 diameter_sigma=0.5, evaporation_fraction=0.3, max_particles_per_parcel=50.0,
+                 inlet_temperature=280.0, outlet_temperature=330.0):
+        self.x_length = x_length
+        self.nozzle_radius = nozzle_radius
+        self.spread_angle = spread_angle
+        self.median_diameter = median_diameter
+        self.diameter_sigma = diameter_sigma
+        self.evaporation_fraction = evaporation_fraction
+        self.max_particles_per_parcel = max_particles_per_parcel
+        self.inlet_temperature = inlet_temperature
+        self.outlet_temperature = outlet_temperature
+
+    def generate_parcels(self, num_parcels, rng):
+        """Return a dictionary of the diameter, x, y, z, particles_per_parcel and temperature arrays of the parcels."""
+        x = rng.uniform(0.0, self.x_length, num_parcels)
+        jet_width = self.nozzle_radius + x * np.tan(np.radians(self.spread_angle))
+        r = np.abs(rng.normal(0.0, 1.0, num_parcels)) * jet_width
+        theta = rng.uniform(0.0, 2.0 * np.pi, num_parcels)
+        distance_fraction = x / self.x_length
+        median_diameter = self.median_diameter * (1.0 - self.evaporation_fraction * distance_fraction)
+        return {'diameter': median_diameter * rng.lognormal(0.0, self.diameter_sigma, num_parcels),
+                'x': x,
+                'y': r * np.cos(theta),
+                'z': r * np.sin(theta),
+                'particles_per_parcel': np.floor(rng.uniform(1.0, self.max_particles_per_parcel + 1.0, num_parcels)),
+                'temperature': self.inlet_temperature + (self.outlet_temperature - self.inlet_temperature) * distance_fraction}
+
+
+def write_snapshot(parcels, case_name, time_stamp, output_directory='.', write_temperature=True):
+    """Write the parcels of one time step in the layout of the Loci-Stream HDF5 particle files."""
+    suffix = '.' + str(time_stamp) + '_' + case_name
+    with h5py.File(os.path.join(output_directory, 'ptdia_ptsca' + suffix), 'w') as f:
+        f['ptdia'] = parcels['diameter']
+    with h5py.File(os.path.join(output_directory, 'ptnump_ptsca' + suffix), 'w') as f:
+        f['ptnump'] = parcels['particles_per_parcel']
+
+    positions = np.empty(len(parcels['x']), dtype=[('x', np.float64), ('y', np.float64), ('z', np.float64)])
+    positions['x'] = parcels['x']
+    positions['y'] = parcels['y']
+    positions['z'] = parcels['z']
+    with h5py.File(os.path.join(output_directory, 'particle_pos' + suffix), 'w') as f:
+        f['particle position'] = positions
+
+    if write_temperature:
+        with h5py.File(os.path.join(output_directory, 'pttemp_ptsca' + suffix), 'w') as f:
+            f['pttemp'] = parcels['temperature']
+
+
+def write_time_series(num_parcels, time_stamps, case_name, output_directory='.', seed=0, spray=None, write_temperature=True):
+    """Write one synthetic snapshot per time stamp. The same seed always gives the same files."""
+    if spray is None:
+        spray = SyntheticSpray()
+    if not os.path.exists(output_directory):
+        os.makedirs(output_directory)
+    rng = np.random.default_rng(seed)
+    for time_stamp in time_stamps:
+        logger.info("Writing %d synthetic parcels for time step %s"%(num_parcels, str(time_stamp)))
+        write_snapshot(spray.generate_parcels(num_parcels, rng), case_name, time_stamp, output_directory, write_temperature)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Write synthetic Loci-Stream lagrangian particle files of a droplet spray')
+    parser.add_argument('--parcels', type=float, default=1e5, help='number of parcels in each time step')
+    parser.add_argument('--time-steps', type=int, nargs='+', default=[8000, 8100, 8200], help='time stamps of the files')
+    parser.add_argument('--case-name', default='acetone', help='case name suffix of the files')
+    parser.add_argument('--output-directory', default='.', help='directory the files are written to')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the random number generator')
+    parser.add_argument('--no-temperature', action='store_true', help='do not write the pttemp_ptsca files')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(name)-12s: %(levelname)-8s %(message)s')
+    write_time_series(int(args.parcels), args.time_steps, args.case_name, args.output_directory, args.seed,
+                      write_temperature=not args.no_temperature)
@@ -1,4 +1,5 @@
 import logging
+import os
 
 logger = logging.getLogger(__name__)
 
@@ -28,13 +29,42 @@ class user_input_parser(object):
         f.close()
         return input_data
 
-def compute_filename_numbers(start, stop, step):
-    num_files = (stop - start)/step
-    file_indicies = []
-    iterate = start
-    for i in range(0, num_files):   #make list of timestamps
-        file_indicies.append(iterate)
-        iterate = iterate + step
-    return file_indicies
+def discover_time_steps(case_name, required_prefixes, i_start=None, i_end=None, i_step=None, directory='.'):
+    """
+    Find the time steps that have a complete set of lagrangian particle files on disk.
 
+    A time step t is found when a <prefix>.<t>_<case_name> file exists for every one of the required prefixes. The
+    optional i_start, i_end and i_step select the time steps i_start <= t < i_end with (t - i_start) divisible by
+    i_step, the same time steps that were listed from these settings before the files were discovered.
+    """
+    suffix = '_' + case_name
+    time_step_sets = dict((prefix, set()) for prefix in required_prefixes)
+    for file_name in os.listdir(directory):
+        if not file_name.endswith(suffix):
+            continue
+        prefix, separator, time_stamp = file_name[:len(file_name) - len(suffix)].rpartition('.')
+        if prefix in time_step_sets and time_stamp.isdigit():
+            time_step_sets[prefix].add(int(time_stamp))
+    time_steps = set.intersection(*time_step_sets.values()) if time_step_sets else set()
+    return select_time_steps(time_steps, i_start, i_end, i_step)
 
+def select_time_steps(time_steps, i_start=None, i_end=None, i_step=None):
+    """Sorted time steps within the optional i_start <= t < i_end range and i_step stride."""
+    selected = []
+    for time_step in sorted(time_steps):
+        if i_start is not None and time_step < i_start:
+            continue
+        if i_end is not None and time_step >= i_end:
+            continue
+        if i_step is not None and i_start is not None and (time_step - i_start) % i_step != 0:
+            continue
+        selected.append(time_step)
+    return selected
+
+def get_file_signature(file_names):
+    """The real path, size and modification time of every file, which changes whenever one of the files is rewritten."""
+    signature = []
+    for file_name in file_names:
+        file_stat = os.stat(file_name)
+        signature.append([os.path.realpath(file_name), file_stat.st_size, file_stat.st_mtime_ns])
+    return signature
@@ -10,6 +10,9 @@
 # Updated: 05-18-2016
 #
 #######################################################################################
+import h5py
+import numpy as np
+
 class particle_histogram:
     """A class to combine methods to process data about particle histogram information"""
 
@@ -129,6 +132,35 @@ class particle_histogram:
                     self.pdf[i] = DataArray[i][1] #Store first PDF value
 
 
+    def read_result_file(self,FilePath,XOverD,DebugFlag=0):
+        """Read the PDF at the x station closest to XOverD from a <case>_PDF_Results.h5 file of the data analyzer."""
+        print("Reading Data From: %s"%(FilePath))
+        with h5py.File(FilePath, "r") as f:
+            if 'pdf' not in f:
+                raise ValueError('%s holds no diameter PDF. Run the data analyzer in pdf mode with diameter_bin_flag 1 to write one.'%(FilePath))
+            d_liq = f['d_liq'][()]
+            xOverD = f['x_bin_centers'][()] / d_liq
+            XIndex = int(np.argmin(np.abs(xOverD - XOverD)))
+            print("X/D Coordinate is: %f"%(xOverD[XIndex]))
+
+            #Only the requested station is read from the file
+            DataArray = f['pdf'][XIndex]  #NumRadii x NumDiameterBins
+            self.horizontal_bins = list(f['diameter_bin_centers'][()])
+
+        NumRadii = DataArray.shape[0]
+        print("Number of Radii at which particle PDF is measured: %d"%(NumRadii))
+        self.num_bins = len(self.horizontal_bins)
+        print("Number of particle diameter bins: %d"%(self.num_bins))
+
+        #For Debugging purposes - print DataArray
+        if DebugFlag == 1:
+            print("%s\n"%(str(DataArray)))
+
+        if self.RadiusAverageFlag == 1:
+            self.pdf = list(np.sum(DataArray, axis=0))
+        else:
+            self.pdf = list(DataArray[0]) #Store first PDF value
+
     def compute_widths(self):
         #Integrate data assuming that points are bin heights and widths are variable
         #Make sure to initialize to zero